@@ -164,6 +164,7 @@ module "package_dir_uv" {
   runtime         = "python3.12"
   docker_image    = "build-python-uv"
   docker_file     = "${path.module}/../fixtures/python-app-uv/docker/Dockerfile"
+  docker_uv_cache = true
 
   source_path = [
     {
@@ -12,7 +12,9 @@ locals {
   # filename - to get package from local
   filename = var.local_existing_package != null ? var.local_existing_package : (var.store_on_s3 ? null : local.archive_filename)
 
-  source_code_hash = var.ignore_source_code_hash ? null : (terraform_data.package_filename_for_hash[0].output.filename != null ? try(filebase64sha256(terraform_data.package_filename_for_hash[0].output.filename), null) : null)
+  # Built packages have a <filename>.sha256 sidecar with a digest computed while they were written
+  package_filename_for_hash = var.ignore_source_code_hash ? null : terraform_data.package_filename_for_hash[0].output.filename
+  source_code_hash          = local.package_filename_for_hash != null ? (var.local_existing_package == null ? try(jsondecode(file("${local.package_filename_for_hash}.sha256")).base64sha256, filebase64sha256(local.package_filename_for_hash), null) : try(filebase64sha256(local.package_filename_for_hash), null)) : null
 
   # s3_* - to get package from S3
   s3_bucket         = var.s3_existing_package != null ? try(var.s3_existing_package.bucket, null) : (var.store_on_s3 ? var.s3_bucket : null)
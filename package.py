@@ -9,20 +9,32 @@ import os
 import re
 import time
 import stat
+import struct
 import json
 import shlex
 import shutil
+import signal
+import socket
 import hashlib
 import zipfile
+import zlib
+import ctypes
+import ctypes.util
+import selectors
 import argparse
 import datetime
+import math
+import functools
+import fnmatch
 import tempfile
 import operator
 import platform
 import subprocess
 import threading
 from subprocess import check_call, check_output, CalledProcessError
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, deque
 from base64 import b64encode
 import logging
 
@@ -133,31 +145,150 @@ def tempdir(dir=None):
         shutil.rmtree(abs_path)
 
 
-def list_files(top_path, log=None):
+class SymlinkEntry:
+    """A directory entry of a symlink, which is kept as is."""
+
+    __slots__ = ("name", "path", "_entry")
+
+    def __init__(self, entry):
+        self.name = entry.name
+        self.path = entry.path
+        self._entry = entry
+
+    def is_dir(self):
+        return False
+
+    def is_symlink(self):
+        return True
+
+    def stat(self):
+        return self._entry.stat(follow_symlinks=False)
+
+
+def scan_dir(top_path, follow_symlinks=True):
     """
-    Returns a sorted list of all files in a directory.
+    Walks a directory tree the same way as os.walk(top_path, followlinks=True)
+    with sorted directories and files does it. Yields (root, dirs, files)
+    tuples, where dirs and files are lists of os.DirEntry objects, which
+    keep their stat results once they are requested.
+
+    A symlink to one of its own parent directories is listed, but isn't
+    walked into. If follow_symlinks is False, symlinks to files and
+    directories inside of the tree are listed in files as SymlinkEntry
+    objects instead of being followed.
+    """
+    try:
+        st = os.stat(top_path)
+    except OSError:
+        return
+    real_top = None if follow_symlinks else os.path.realpath(top_path)
+    stack = [(top_path, frozenset([(st.st_dev, st.st_ino)]))]
+    while stack:
+        root, parents = stack.pop()
+        try:
+            with os.scandir(root) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        dirs = []
+        files = []
+        for entry in entries:
+            if (
+                real_top
+                and entry.is_symlink()
+                and is_subpath(os.path.realpath(entry.path), real_top)
+            ):
+                files.append(SymlinkEntry(entry))
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            (dirs if is_dir else files).append(entry)
+        # Sort directories and files to ensure they are always processed in the same order
+        dirs.sort(key=operator.attrgetter("name"))
+        files.sort(key=operator.attrgetter("name"))
+        yield root, dirs, files
+
+        subdirs = []
+        for entry in dirs:
+            st = entry_stat(entry)
+            if st is None:
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key in parents:
+                logging.getLogger("walk").warning(
+                    "skipping symlink loop: %s", entry.path
+                )
+                continue
+            subdirs.append((entry.path, parents | {key}))
+        stack.extend(reversed(subdirs))
+
+
+def entry_stat(entry):
+    """Returns a stat result of a directory entry or None if it's missing."""
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+
+def symlink_target(path):
+    """
+    Returns a target of a symlink kept in a zip archive, absolute targets
+    are made relative to the directory of the symlink.
+    """
+    target = os.readlink(path)
+    if os.path.isabs(target):
+        target = os.path.relpath(
+            os.path.realpath(path), os.path.realpath(os.path.dirname(path))
+        )
+    return os.fsencode(target)
+
+
+def list_file_entries(top_path, log=None, follow_symlinks=True, walked=None):
+    """
+    Returns a sorted list of (relative path, stat result) of all files
+    in a directory.
+
+    If walked list is given, it's filled with (path, stat result) of
+    directories and files in the order emit_dir_entries yields them.
     """
 
     if log:
         log = log.getChild("ls")
 
     results = []
+    dir_entries = {}
 
-    for root, dirs, files in os.walk(top_path, followlinks=True):
-        # Sort directories and files to ensure they are always processed in the same order
-        dirs.sort()
-        files.sort()
-        for file_name in files:
-            file_path = os.path.join(root, file_name)
-            relative_path = os.path.relpath(file_path, top_path)
-            results.append(relative_path)
+    for root, dirs, files in scan_dir(top_path, follow_symlinks):
+        if walked is not None:
+            if root != top_path:
+                walked.append(
+                    (os.path.normpath(root), entry_stat(dir_entries.pop(root)))
+                )
+            for entry in dirs:
+                dir_entries[entry.path] = entry
+        for entry in files:
+            relative_path = os.path.relpath(entry.path, top_path)
+            st = entry_stat(entry)
+            results.append((relative_path, st))
+            if walked is not None:
+                walked.append((os.path.normpath(entry.path), st))
             if log:
                 log.debug(relative_path)
 
-    results.sort()
+    results.sort(key=operator.itemgetter(0))
     return results
 
 
+def list_files(top_path, log=None):
+    """
+    Returns a sorted list of all files in a directory.
+    """
+    return [path for path, _ in list_file_entries(top_path, log)]
+
+
 def dataclass(name):
     typ = type(
         name,
@@ -202,6 +333,37 @@ def source_code_hash(bytes):
     return b64encode(hashlib.sha256(bytes).digest()).decode()
 
 
+def file_source_code_hash(open_file):
+    """Same as source_code_hash() of a file content, read by chunks."""
+    hash_obj = hashlib.sha256()
+    if hasattr(hashlib, "file_digest"):
+        hashlib.file_digest(open_file, lambda: hash_obj)
+    else:
+        while True:
+            data = open_file.read(1024 * 1024)
+            if not data:
+                break
+            hash_obj.update(data)
+    return b64encode(hash_obj.digest()).decode()
+
+
+def write_sha256_sidecar(filename, hash_obj):
+    """
+    Writes a SHA-256 digest of a file next to it as <filename>.sha256,
+    so it's not read again to get its source code hash.
+    """
+    sidecar = {
+        "base64sha256": b64encode(hash_obj.digest()).decode(),
+        "sha256": hash_obj.hexdigest(),
+    }
+    tmp_filename = "{}.sha256.tmp".format(filename)
+    with open(tmp_filename, "w") as f:
+        json.dump(sidecar, f)
+        f.write("\n")
+    os.replace(tmp_filename, "{}.sha256".format(filename))
+    return sidecar
+
+
 def yesno_bool(val):
     if val is None:
         return
@@ -222,66 +384,227 @@ def yesno_bool(val):
     return False
 
 
+def is_subpath(path, top):
+    return path == top or path.startswith(os.path.join(top, ""))
+
+
 ################################################################################
 # Packaging functions
 
 
 def emit_dir_content(base_dir):
-    for root, dirs, files in os.walk(base_dir, followlinks=True):
-        # Sort directories and files to ensure they are always processed in the same order
-        dirs.sort()
-        files.sort()
-        if root != base_dir:
-            yield os.path.normpath(root)
-        for name in files:
-            yield os.path.normpath(os.path.join(root, name))
+    for path, _ in emit_dir_entries(base_dir):
+        yield path
+
+
+def manifest_stats(base_path, entries, mtimes=None, walked=None):
+    """
+    Returns (path, arcname, stat result) of files listed in a manifest.
+    Fails if any of them has been removed or its type, size or content
+    has been changed. Contents are compared with digests only for files
+    which mtimes differ from the known ones.
+
+    Stat results of a walk of the base path can be given as a mapping
+    of arcnames to (path, stat result), so files aren't stat again.
+    """
+    isdir = os.path.isdir(base_path)
+    mtimes = mtimes or {}
+    stats = []
+    for arcname, size, mode, digest in entries:
+        path = os.path.join(base_path, arcname) if isdir else base_path
+        if walked is not None:
+            st = walked.get(arcname, (None, None))[1]
+        else:
+            try:
+                st = os.lstat(path) if stat.S_ISLNK(mode) else os.stat(path)
+            except FileNotFoundError:
+                st = None
+        if st is None or stat.S_IFMT(st.st_mode) != stat.S_IFMT(mode):
+            changed = True
+        elif stat.S_ISDIR(mode):
+            # New files are detected by mtimes of manifest directories
+            changed = False
+        elif st.st_size != size:
+            changed = True
+        elif mtimes.get(arcname) == st.st_mtime_ns:
+            changed = False
+        else:
+            # A fresh checkout or a touched file
+            changed = not file_matches_digest(path, st, digest)
+        if changed:
+            raise RuntimeError(
+                "File has been changed since the build plan was prepared: {}".format(
+                    path
+                )
+            )
+        stats.append((path, arcname, st))
+    return stats
+
+
+def manifest_dirs(entries):
+    """
+    Returns sorted relative paths of a directory and of its subdirectories
+    which are listed in manifest entries or contain listed files.
+    """
+    dirs = {"."}
+    for arcname, _, mode, _ in entries:
+        path = arcname if stat.S_ISDIR(mode) else os.path.dirname(arcname)
+        while path and path not in dirs:
+            dirs.add(path)
+            path = os.path.dirname(path)
+    return sorted(dirs)
+
+
+def file_matches_digest(path, st, digest):
+    """
+    Checks a file content against a hex digest made by the prepare command,
+    which is a sha256 digest or a git blob id made by GitIndexDigests.
+    """
+    if not digest:
+        return False
+    digest = bytes.fromhex(digest)
+    if stat.S_ISLNK(st.st_mode):
+        return hashlib.sha256(b"symlink\0" + symlink_target(path)).digest() == digest
+
+    blob_header = b"blob %d\0" % st.st_size
+    if len(digest) == hashlib.sha1().digest_size:
+        hash_objs = [hashlib.sha1(blob_header)]
+    else:
+        hash_objs = [hashlib.sha256(), hashlib.sha256(blob_header)]
+    try:
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                for hash_obj in hash_objs:
+                    hash_obj.update(data)
+    except FileNotFoundError:
+        return False
+    return any(hash_obj.digest() == digest for hash_obj in hash_objs)
 
 
-def generate_content_hash(source_paths, hash_func=hashlib.sha256, log=None):
+def emit_dir_entries(base_dir, follow_symlinks=True):
+    """
+    Same as emit_dir_content, but yields paths with their stat results
+    (None for broken symlinks).
+    """
+    dir_entries = {}
+    for root, dirs, files in scan_dir(base_dir, follow_symlinks):
+        if root != base_dir:
+            yield os.path.normpath(root), entry_stat(dir_entries.pop(root))
+        for entry in dirs:
+            dir_entries[entry.path] = entry
+        for entry in files:
+            yield os.path.normpath(entry.path), entry_stat(entry)
+
+
+def generate_content_hash(
+    source_paths,
+    log=None,
+    digest_cache=None,
+    workers=None,
+    digests=None,
+    walked=None,
+):
     """
     Generate a content hash of the source paths.
+
+    Source paths are (path, filter, prefix[, follow_symlinks]) tuples.
+    The returned sha256 object covers paths of files and per-file digests
+    of their contents (sha256, or git blob ids from GitIndexDigests)
+    rather than raw file contents, so the digests can be cached.
+    When workers is greater than 1, file contents are digested concurrently
+    in a thread pool and then combined in the same order as serially.
+    If digests dict is given, it's filled with digests of hashed files.
+    If walked dict is given, it's filled with lists of (path, stat result)
+    of each source path by its index, in the order they are zipped.
     """
 
     if log:
         log = log.getChild("hash")
-    _log = log if log.isEnabledFor(DEBUG3) else None
-
-    hash_obj = hash_func()
 
-    for source_path, pf, prefix in source_paths:
-        if pf is not None:
-            for path_from_pattern in pf.filter(source_path, prefix):
-                if os.path.isdir(path_from_pattern):
-                    # Hash only the path of the directory
-                    source_dir = path_from_pattern
-                    source_file = None
-                else:
-                    source_dir = os.path.dirname(path_from_pattern)
-                    source_file = os.path.relpath(path_from_pattern, source_dir)
-                update_hash(hash_obj, source_dir, source_file)
-                if log:
-                    log.debug(path_from_pattern)
-        else:
-            if os.path.isdir(source_path):
-                source_dir = source_path
-                for source_file in list_files(source_dir, log=_log):
-                    update_hash(hash_obj, source_dir, source_file)
+    hash_obj = hashlib.sha256()
+    # Overlapping source paths list the same files several times
+    memo = DigestMemo()
+
+    def hash_entries():
+        _log = log if log.isEnabledFor(DEBUG3) else None
+        for index, source in enumerate(source_paths):
+            source_path, pf, prefix = source[:3]
+            follow_symlinks = source[3] if len(source) > 3 else True
+            source_walked = None
+            if walked is not None:
+                source_walked = walked[index] = []
+            if pf is not None:
+                for path_from_pattern, st in pf.filter_entries(
+                    source_path, prefix, follow_symlinks
+                ):
+                    if source_walked is not None:
+                        source_walked.append((path_from_pattern, st))
+                    if st is not None and stat.S_ISDIR(st.st_mode):
+                        # Hash only the path of the directory
+                        source_dir = path_from_pattern
+                        source_file = None
+                    else:
+                        source_dir = os.path.dirname(path_from_pattern)
+                        source_file = os.path.relpath(path_from_pattern, source_dir)
+                    yield source_dir, source_file, st
                     if log:
-                        log.debug(os.path.join(source_dir, source_file))
+                        log.debug(path_from_pattern)
             else:
-                source_dir = os.path.dirname(source_path)
-                source_file = os.path.relpath(source_path, source_dir)
-                update_hash(hash_obj, source_dir, source_file)
-                if log:
-                    log.debug(source_path)
+                if os.path.isdir(source_path):
+                    source_dir = source_path
+                    for source_file, st in list_file_entries(
+                        source_dir,
+                        log=_log,
+                        follow_symlinks=follow_symlinks,
+                        walked=source_walked,
+                    ):
+                        yield source_dir, source_file, st
+                        if log:
+                            log.debug(os.path.join(source_dir, source_file))
+                else:
+                    source_dir = os.path.dirname(source_path)
+                    source_file = os.path.relpath(source_path, source_dir)
+                    if source_walked is not None:
+                        source_walked.append((source_path, None))
+                    yield source_dir, source_file, None
+                    if log:
+                        log.debug(source_path)
+
+    def entry_digest(entry):
+        source_dir, source_file, st = entry
+        if source_file is None:
+            return None
+        path = os.path.join(source_dir, source_file)
+        if st is not None and stat.S_ISLNK(st.st_mode):
+            # A symlink kept in the archive as is
+            digest = hashlib.sha256(b"symlink\0" + symlink_target(path)).digest()
+        else:
+            digest = file_content_digest(path, digest_cache, memo, st=st)
+        if digests is not None:
+            digests[os.path.normpath(path)] = digest
+        return digest
+
+    if workers and workers > 1:
+        entries = list(hash_entries())
+        log.debug("Hashing %d files with %d workers", len(entries), workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Executor.map yields results in the order of entries
+            for entry, digest in zip(entries, executor.map(entry_digest, entries)):
+                update_hash(hash_obj, entry[0], entry[1], digest)
+    else:
+        for entry in hash_entries():
+            update_hash(hash_obj, entry[0], entry[1], entry_digest(entry))
 
     return hash_obj
 
 
-def update_hash(hash_obj, file_root, file_path=None):
+def update_hash(hash_obj, file_root, file_path=None, digest=None):
     """
     Update a hashlib object with the relative path and, if the given
-    file_path is not None, its content.
+    file_path is not None, a digest of its content.
     """
 
     if file_path is None:
@@ -291,21 +614,1188 @@ def update_hash(hash_obj, file_root, file_path=None):
     relative_path = os.path.join(file_root, file_path)
     hash_obj.update(relative_path.encode())
 
+    if digest is not None:
+        hash_obj.update(digest)
+
+
+def file_content_digest(file_path, digest_cache=None, memo=None, st=None):
+    """
+    Returns a sha256 digest of a file content or None
+    if the file doesn't exist (e.g. a broken symlink).
+
+    If a memo is given, a file reachable by several paths is read once.
+    A stat result of the file can be given if it's already known.
+    """
+
+    if st is None:
+        try:
+            st = os.stat(file_path)
+        # ignore broken symlinks content to don't fail on `terraform destroy` command
+        except FileNotFoundError:
+            return None
+
+    if memo is not None and st.st_ino:
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        computed = []
+
+        def compute():
+            computed.append(True)
+            return _file_content_digest(file_path, st, digest_cache)
+
+        digest = memo.get(key, compute)
+        if not computed and digest is not None and digest_cache is not None:
+            # Keep other paths of the same file (hardlinks or symlinks) in
+            # the digest cache too, as it keeps only paths seen by a run
+            digest_cache.put(file_path, st, digest)
+        return digest
+    return _file_content_digest(file_path, st, digest_cache)
+
+
+def _file_content_digest(file_path, st, digest_cache=None):
+    if digest_cache is not None:
+        digest = digest_cache.get(file_path, st)
+        if digest is not None:
+            return digest
+        hash_obj = digest_cache.new_hash(file_path, st)
+    else:
+        hash_obj = hashlib.sha256()
+
     try:
-        with open(relative_path, "rb") as open_file:
-            while True:
-                data = open_file.read(1024 * 8)
-                if not data:
-                    break
-                hash_obj.update(data)
-    # ignore broken symlinks content to don't fail on `terraform destroy` command
+        with open(file_path, "rb") as open_file:
+            if hasattr(hashlib, "file_digest"):
+                # Python 3.11+, reads into a buffer without copying chunks
+                hashlib.file_digest(open_file, lambda: hash_obj)
+            else:
+                while True:
+                    data = open_file.read(1024 * 1024)
+                    if not data:
+                        break
+                    hash_obj.update(data)
+            read_st = os.fstat(open_file.fileno())
     except FileNotFoundError:
+        return None
+
+    digest = hash_obj.digest()
+    # Don't cache a digest of a file modified while it was read
+    if digest_cache is not None and (
+        FileDigestCache.stat_key(read_st) == FileDigestCache.stat_key(st)
+    ):
+        digest_cache.put(file_path, st, digest)
+    return digest
+
+
+class DigestMemo:
+    """
+    Thread-safe memo of digests computed during a single run,
+    where each digest is computed once even if requested concurrently.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._digests = {}
+
+    def get(self, key, compute):
+        with self._lock:
+            entry = self._digests.get(key)
+            owner = entry is None
+            if owner:
+                entry = self._digests[key] = [threading.Event(), None]
+        if owner:
+            try:
+                entry[1] = compute()
+            finally:
+                entry[0].set()
+        else:
+            entry[0].wait()
+        return entry[1]
+
+
+class FileDigestCache:
+    """
+    Persistent cache of file content digests keyed by a file stat data.
+
+    A cached digest is used only while the size, mtime, inode and ctime of
+    a file are the same as they were when it was hashed, any mismatch drops
+    the entry.
+    """
+
+    version = 1
+    cache_dir = "hash"
+
+    # A file changed within this window before it was hashed can be changed
+    # again without a visible change of mtime on filesystems with a coarse
+    # timestamp resolution, so such files are never cached.
+    racy_window_ns = 2 * 10**9
+
+    def __init__(self, filename, log=None):
+        self.filename = filename
+        self._entries = {}
+        self._seen = {}
+        self._modified = False
+        self._log = log or logging.getLogger("hash")
+
+    @classmethod
+    def for_source_path(cls, artifacts_dir, source_path, log=None):
+        """
+        Returns a cache stored in the artifacts directory,
+        one per distinct source_path value.
+        """
+        key = hashlib.sha256(json.dumps(source_path, sort_keys=True).encode())
+        filename = os.path.join(
+            artifacts_dir, "cache", cls.cache_dir, "{}.json".format(key.hexdigest())
+        )
+        return cls(filename, log=log)
+
+    @staticmethod
+    def stat_key(st):
+        return [st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns]
+
+    def new_hash(self, path, st):
+        return hashlib.sha256()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return self
+        except (OSError, ValueError) as e:
+            self._log.warning("ignoring digest cache %s: %s", self.filename, e)
+            return self
+        if isinstance(data, dict) and data.get("version") == self.version:
+            self._load(data)
+        self._log.debug(
+            "loaded %d digest cache entries from %s", len(self._entries), self.filename
+        )
+        return self
+
+    def get(self, path, st):
+        path = os.path.abspath(path)
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if entry[:-1] != self.stat_key(st):
+            self._entries.pop(path, None)
+            self._modified = True
+            return None
+        self._seen[path] = entry
+        return bytes.fromhex(entry[-1])
+
+    def is_racy(self, st):
+        now_ns = int(time.time() * 10**9)
+        return max(st.st_mtime_ns, st.st_ctime_ns) >= now_ns - self.racy_window_ns
+
+    def put(self, path, st, digest):
+        if self.is_racy(st):
+            return
+        path = os.path.abspath(path)
+        entry = self.stat_key(st) + [digest.hex()]
+        self._entries[path] = entry
+        self._seen[path] = entry
+        self._modified = True
+
+    def discard(self, path):
+        path = os.path.abspath(path)
+        self._entries.pop(path, None)
+        self._seen.pop(path, None)
+
+    def entries(self, top):
+        """Yields (path, entry) pairs of cached files under a directory."""
+        top = os.path.join(os.path.abspath(top), "")
+        for path, entry in list(self._entries.items()):
+            if path.startswith(top):
+                yield path, entry
+
+    def save(self):
+        # Keep only entries used by this run to not grow the cache forever
+        if not self._modified and len(self._seen) == len(self._entries):
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            json.dump(self._dump(), f)
+        os.replace(tmp_filename, self.filename)
+        self._log.debug(
+            "saved %d digest cache entries to %s", len(self._seen), self.filename
+        )
+
+    def _load(self, data):
+        self._entries = data.get("entries", {})
+
+    def _dump(self):
+        return {"version": self.version, "entries": self._seen}
+
+
+class MerkleDigestTree(FileDigestCache):
+    """
+    A digest cache which also arranges hashed files into a Merkle tree of
+    per-directory subtree digests, to tell which subtrees of the sources
+    have changed since the previous run.
+    """
+
+    cache_dir = "tree"
+
+    def __init__(self, filename, log=None):
+        super().__init__(filename, log=log)
+        self._previous = {}
+        self._subtrees = None
+
+    def put(self, path, st, digest):
+        if not self.is_racy(st):
+            super().put(path, st, digest)
+            return
+        # Keep a racy file in the tree, but never trust its cached digest
+        self._seen[os.path.abspath(path)] = [None] * 4 + [digest.hex()]
+        self._modified = True
+
+    def subtree_digests(self):
+        """
+        Returns a mapping of every directory containing hashed files
+        to the digest of its subtree.
+        """
+        if self._subtrees is not None:
+            return self._subtrees
+        subtrees = {}
+        if not self._seen:
+            return subtrees
+
+        top = os.path.commonpath(list(self._seen))
+        if top in self._seen:
+            top = os.path.dirname(top)
+
+        children = {}
+        for path, entry in self._seen.items():
+            d = os.path.dirname(path)
+            children.setdefault(d, {})[os.path.basename(path)] = entry[-1]
+        for d in list(children):
+            while d != top:
+                d = os.path.dirname(d)
+                children.setdefault(d, {})
+
+        # Compute the deepest directories first to have all children ready
+        for d in sorted(children, key=lambda p: p.count(os.sep), reverse=True):
+            hash_obj = hashlib.sha256()
+            for name, digest in sorted(children[d].items()):
+                hash_obj.update(name.encode())
+                hash_obj.update(b"\0")
+                hash_obj.update(digest.encode())
+            subtrees[d] = hash_obj.hexdigest()
+            if d != top:
+                children[os.path.dirname(d)][os.path.basename(d) + "/"] = subtrees[d]
+
+        self._subtrees = subtrees
+        return subtrees
+
+    def changed_subtrees(self):
+        """
+        Returns a sorted list of directories which subtree digest changed
+        since the previous run and which directly contain added, removed
+        or modified files.
+        """
+        if not self._previous:
+            return []
+        subtrees = self.subtree_digests()
+        previous = self._previous["tree"]
+        previous_files = self._previous["files"]
+
+        changed = set()
+        for path in set(previous_files).union(self._seen):
+            entry = self._seen.get(path)
+            if previous_files.get(path) != (entry and entry[-1]):
+                changed.add(os.path.dirname(path))
+        return sorted(d for d in changed if subtrees.get(d) != previous.get(d))
+
+    def _load(self, data):
+        super()._load(data)
+        self._previous = {
+            "tree": data.get("tree", {}),
+            "files": {path: entry[-1] for path, entry in self._entries.items()},
+        }
+
+    def _dump(self):
+        data = super()._dump()
+        data["tree"] = self.subtree_digests()
+        return data
+
+
+class GitIndexDigests:
+    """
+    Digests of files tracked in git work trees taken from the blob ids
+    stored in their index files, without running git.
+
+    A blob id is used only for a regular file which stat data matches its
+    index entry, other files are hashed as git blobs, so a digest of a file
+    doesn't depend on whether it has been committed or not.
+    """
+
+    # Index entry flags
+    ENTRY_EXTENDED = 0x4000
+    ENTRY_SKIP_WORKTREE = 0x4000
+    ENTRY_INTENT_TO_ADD = 0x2000
+
+    def __init__(self, log=None):
+        self._lock = threading.Lock()
+        self._dirs = {}
+        self._indexes = {}
+        self._log = log or logging.getLogger("hash")
+
+    def get(self, path, st):
+        repo = self._repo_for(os.path.dirname(os.path.abspath(path)))
+        if repo is None:
+            return None
+        worktree, real_dir, hash_name, entries = repo
+        name = os.path.relpath(os.path.join(real_dir, os.path.basename(path)), worktree)
+        entry = entries.get(name.replace(os.sep, "/"))
+        if entry is None or entry[:-1] != self.stat_key(st):
+            return None
+        return entry[-1]
+
+    def put(self, path, st, digest):
         pass
 
+    def new_hash(self, path, st):
+        repo = self._repo_for(os.path.dirname(os.path.abspath(path)))
+        hash_obj = hashlib.new(repo[2] if repo else "sha1")
+        hash_obj.update(b"blob %d\0" % st.st_size)
+        return hash_obj
+
+    @staticmethod
+    def stat_key(st):
+        # Git keeps only 32 lower bits of these values
+        return (
+            st.st_mtime_ns // 10**9 & 0xFFFFFFFF,
+            st.st_mtime_ns % 10**9,
+            st.st_ctime_ns // 10**9 & 0xFFFFFFFF,
+            st.st_ctime_ns % 10**9,
+            st.st_ino & 0xFFFFFFFF,
+            st.st_size & 0xFFFFFFFF,
+        )
+
+    def _repo_for(self, path):
+        """
+        Returns (worktree, real path, hash name, index entries)
+        for a directory inside of a git work tree or None.
+        """
+        try:
+            return self._dirs[path]
+        except KeyError:
+            pass
+        with self._lock:
+            real_dir = os.path.realpath(path)
+            worktree = real_dir
+            while not os.path.exists(os.path.join(worktree, ".git")):
+                parent = os.path.dirname(worktree)
+                if parent == worktree:
+                    worktree = None
+                    break
+                worktree = parent
+            repo = None
+            if worktree is not None:
+                index = self._indexes.get(worktree)
+                if index is None:
+                    index = self._indexes[worktree] = self._load(worktree)
+                if index[1] is not None:
+                    repo = (worktree, real_dir) + index
+            self._dirs[path] = repo
+            return repo
+
+    def _load(self, worktree):
+        git_dir = os.path.join(worktree, ".git")
+        try:
+            if os.path.isfile(git_dir):
+                # Linked work trees and submodules refer to their git dirs
+                with open(git_dir) as f:
+                    content = f.read().strip()
+                if not content.startswith("gitdir:"):
+                    raise ValueError("unsupported .git file")
+                git_dir = os.path.join(worktree, content[len("gitdir:") :].strip())
+
+            common_dir = git_dir
+            commondir_file = os.path.join(git_dir, "commondir")
+            if os.path.isfile(commondir_file):
+                with open(commondir_file) as f:
+                    common_dir = os.path.join(git_dir, f.read().strip())
+
+            hash_name = "sha1"
+            config_file = os.path.join(common_dir, "config")
+            if os.path.isfile(config_file):
+                with open(config_file) as f:
+                    if re.search(r"(?im)^\s*objectformat\s*=\s*sha256\s*$", f.read()):
+                        hash_name = "sha256"
+
+            index_file = os.path.join(git_dir, "index")
+            with open(index_file, "rb") as f:
+                index_st = os.fstat(f.fileno())
+                data = f.read()
+            entries = self.parse_index(
+                data, hashlib.new(hash_name).digest_size, index_st.st_mtime_ns
+            )
+        except (OSError, ValueError, struct.error) as e:
+            self._log.warning("ignoring git index of %s: %s", worktree, e)
+            return "sha1", None
+
+        self._log.debug("loaded %d git index entries of %s", len(entries), worktree)
+        return hash_name, entries
+
+    @classmethod
+    def parse_index(cls, data, oid_size=20, index_mtime_ns=None):
+        """
+        Parses a git index file of version 2, 3 or 4 and returns a mapping
+        of paths of regular files to their stat keys and blob ids.
+
+        Entries modified not before the index file itself was written are
+        skipped because git can't tell if they have been changed after.
+        """
+        if data[:4] != b"DIRC":
+            raise ValueError("not a git index file")
+        version, count = struct.unpack_from(">II", data, 4)
+        if version not in (2, 3, 4):
+            raise ValueError("unsupported git index version {}".format(version))
+
+        racy_s, racy_ns = None, None
+        if index_mtime_ns is not None:
+            racy_s, racy_ns = divmod(index_mtime_ns, 10**9)
+
+        entries = {}
+        pos = 12
+        path = b""
+        for _ in range(count):
+            (ctime_s, ctime_ns, mtime_s, mtime_ns, _, ino, mode, _, _, size) = (
+                struct.unpack_from(">10I", data, pos)
+            )
+            oid = data[pos + 40 : pos + 40 + oid_size]
+            (flags,) = struct.unpack_from(">H", data, pos + 40 + oid_size)
+            p = pos + 42 + oid_size
+            extended_flags = 0
+            if version >= 3 and flags & cls.ENTRY_EXTENDED:
+                (extended_flags,) = struct.unpack_from(">H", data, p)
+                p += 2
+
+            if version == 4:
+                # Paths are prefix-compressed relative to a previous entry
+                c = data[p]
+                p += 1
+                strip = c & 0x7F
+                while c & 0x80:
+                    c = data[p]
+                    p += 1
+                    strip = ((strip + 1) << 7) | (c & 0x7F)
+                end = data.index(b"\0", p)
+                path = path[: len(path) - strip] + data[p:end]
+                pos = end + 1
+            else:
+                end = data.index(b"\0", p)
+                path = data[p:end]
+                # Entries are padded by 1-8 NUL bytes to a multiple of 8 bytes
+                pos += (end - pos + 8) & ~7
+
+            if (flags >> 12) & 0x3:
+                continue  # a merge conflict
+            if extended_flags & (cls.ENTRY_SKIP_WORKTREE | cls.ENTRY_INTENT_TO_ADD):
+                continue
+            if stat.S_IFMT(mode) != stat.S_IFREG:
+                continue  # symlinks, gitlinks and sparse directories
+            if racy_s is not None and (mtime_s, mtime_ns) >= (racy_s, racy_ns):
+                continue
+            entries[os.fsdecode(path)] = (
+                mtime_s,
+                mtime_ns,
+                ctime_s,
+                ctime_ns,
+                ino,
+                size,
+                oid,
+            )
+
+        # A split index keeps a part of entries in a shared index file
+        while pos + 8 <= len(data) - oid_size:
+            signature = data[pos : pos + 4]
+            (size,) = struct.unpack_from(">I", data, pos + 4)
+            if signature == b"link":
+                raise ValueError("split git index is not supported")
+            pos += 8 + size
+
+        return entries
+
+
+class DaemonDigests:
+    """
+    Digests of files in source directories served by a packaging daemon
+    started with the serve command.
+
+    A served digest is used only if the stat data of a file still matches
+    the one the daemon has seen, otherwise the fallback digest cache or the
+    file content is used.
+    """
+
+    timeout = 30
+
+    def __init__(self, digests, fallback=None, log=None):
+        self._digests = digests
+        self._fallback = fallback
+        self._log = log or logging.getLogger("hash")
+
+    @classmethod
+    def connect(cls, socket_path, source_dirs, fallback=None, log=None):
+        """
+        Requests digests of files in the source directories from a daemon
+        listening on the socket. Returns None if there is no daemon.
+        """
+        log = log or logging.getLogger("hash")
+        if not (source_dirs and socket_path and hasattr(socket, "AF_UNIX")):
+            return None
+        try:
+            st = os.stat(socket_path)
+        except OSError:
+            return None
+        if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+            log.warning("ignoring packaging daemon socket: %s", socket_path)
+            return None
+
+        request = {"op": "digests", "roots": source_dirs}
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(cls.timeout)
+                sock.connect(socket_path)
+                sock.sendall(json.dumps(request).encode() + b"\n")
+                sock.shutdown(socket.SHUT_WR)
+                chunks = []
+                while True:
+                    chunk = sock.recv(1024 * 64)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            digests = json.loads(b"".join(chunks))["digests"]
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("packaging daemon is not available: %s", e)
+            return None
+
+        log.debug("received %d digests from packaging daemon", len(digests))
+        return cls(digests, fallback=fallback, log=log)
+
+    def get(self, path, st):
+        entry = self._digests.get(os.path.abspath(path))
+        if entry is not None and entry[:-1] == FileDigestCache.stat_key(st):
+            digest = bytes.fromhex(entry[-1])
+            if self._fallback is not None:
+                # Keep the file in a digest cache or a tree saved by the run
+                self._fallback.put(path, st, digest)
+            return digest
+        if self._fallback is not None:
+            return self._fallback.get(path, st)
+        return None
+
+    def put(self, path, st, digest):
+        if self._fallback is not None:
+            self._fallback.put(path, st, digest)
+
+    def new_hash(self, path, st):
+        return hashlib.sha256()
+
+
+class ZipMemberCache:
+    """
+    Content-addressed cache of compressed zip members shared by builds.
+
+    Each entry holds a raw compressed stream with CRC32 and size of a file
+    content, keyed by a digest of the content, the compression method and
+    level (and the zlib version, so reused streams are the same as fresh
+    ones). Least recently used entries are evicted above a size budget.
+    """
+
+    magic = b"TFLZ"
+    header = struct.Struct("<4sIQ")
+    cache_dir = "zip"
+
+    # Smaller files are compressed faster than a cache entry is looked up
+    min_file_size = 8 * 1024
+
+    def __init__(self, directory, max_bytes, log=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._log = log or logging.getLogger("zip")
+
+    @classmethod
+    def for_artifacts_dir(cls, artifacts_dir, max_bytes, log=None):
+        return cls(os.path.join(artifacts_dir, "cache", cls.cache_dir), max_bytes, log)
+
+    @staticmethod
+    def key(digest, compress_type, compresslevel=None):
+        key = hashlib.sha256(digest)
+        key.update(
+            "{}:{}:{}".format(
+                compress_type, compresslevel, zlib.ZLIB_RUNTIME_VERSION
+            ).encode()
+        )
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Returns (payload, crc, file_size) or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            data = None
+        if data is not None:
+            size = self.header.size
+            if len(data) >= size:
+                magic, crc, file_size = self.header.unpack_from(data)
+                if magic == self.magic:
+                    with self._lock:
+                        self.hits += 1
+                    return data[size:], crc, file_size
+            self._log.warning("ignoring broken zip cache entry: %s", path)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, payload, crc, file_size):
+        path = self._path(key)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Unique across threads and builds sharing the cache
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), prefix=key + ".", suffix=".tmp"
+            )
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.header.pack(self.magic, crc, file_size))
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self._log.warning("can't store zip cache entry %s: %s", path, e)
+            if tmp_path:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+    def evict(self):
+        """Removes least recently used entries above the size budget."""
+        entries = []
+        total = 0
+        try:
+            subdirs = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for subdir in subdirs:
+            if not subdir.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(subdir.path):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                total += st.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._log.debug("evicted %d zip cache entries", removed)
+
+
+class ZipLineage:
+    """
+    Tracks the last archive built from the same build plan along with
+    digests of its members, so the next build can reuse its compressed
+    members.
+
+    The archive is used as a base only if it was compressed with the same
+    settings and zlib version, so reused members are the same as freshly
+    compressed ones.
+    """
+
+    version = 1
+    cache_dir = "lineage"
+
+    def __init__(self, filename, log=None):
+        self.filename = filename
+        self._log = log or logging.getLogger("zip")
+
+    @classmethod
+    def for_build_plan(cls, artifacts_dir, runtime, build_plan, log=None):
+        key = hashlib.sha256(json.dumps([runtime, build_plan], sort_keys=True).encode())
+        filename = os.path.join(
+            artifacts_dir, "cache", cls.cache_dir, "{}.json".format(key.hexdigest())
+        )
+        return cls(filename, log=log)
+
+    def settings(self, compress_type, compresslevel):
+        return {
+            "version": self.version,
+            "zlib": zlib.ZLIB_RUNTIME_VERSION,
+            "compress_type": compress_type,
+            "compresslevel": compresslevel,
+        }
+
+    def load(self, compress_type, compresslevel):
+        """Returns a filename of the base archive and digests of its members."""
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None, {}
+        except (OSError, ValueError) as e:
+            self._log.warning("ignoring zip lineage %s: %s", self.filename, e)
+            return None, {}
+        if not isinstance(data, dict) or data.get("settings") != self.settings(
+            compress_type, compresslevel
+        ):
+            return None, {}
+        base_filename = data.get("filename")
+        if not base_filename or not os.path.isfile(base_filename):
+            return None, {}
+        return base_filename, data.get("digests") or {}
+
+    def save(self, zip_filename, digests, compress_type, compresslevel):
+        data = {
+            "settings": self.settings(compress_type, compresslevel),
+            "filename": os.path.abspath(zip_filename),
+            "digests": digests,
+        }
+        tmp_filename = "{}.tmp".format(self.filename)
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(tmp_filename, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_filename, self.filename)
+        except OSError as e:
+            self._log.warning("can't save zip lineage %s: %s", self.filename, e)
+
+
+class ZipWriter:
+    """
+    Append-only writer of zip archives.
+
+    Writes the same archives as zipfile.ZipFile in "w" mode does, without
+    relying on its internals. Central directory records are packed as soon
+    as members are written, so no ZipInfo objects are kept. A member can be
+    written from already compressed data, or streamed, in which case its
+    local header is updated afterwards, or followed by a data descriptor
+    when the output isn't seekable.
+
+    If a hash object is given, it's updated with the archive bytes in the
+    order they end up in the file, as they are written. Data of a streamed
+    member follows a local header which is known only at the end of the
+    member, unless its CRC and compressed size are given in advance, so
+    such data is spooled (in memory up to spool_size bytes) and written
+    after the header.
+    """
+
+    zip64_limit = (1 << 31) - 1
+    filecount_limit = (1 << 16) - 1
+
+    local_header = struct.Struct("<4s2B4HL2L2H")
+    central_header = struct.Struct("<4s4B4HL2L5H2L")
+    end_record = struct.Struct("<4s4H2LH")
+    end_record64 = struct.Struct("<4sQ2H2L4Q")
+    end_locator64 = struct.Struct("<4sLQL")
+
+    spool_size = 8 * 1024 * 1024
+
+    def __init__(self, fp, allow_zip64=True, hash_obj=None):
+        self.fp = fp
+        self.allow_zip64 = allow_zip64
+        self.hash_obj = hash_obj
+        try:
+            self.seekable = fp.seekable()
+            self._offset = fp.tell() if self.seekable else 0
+        except (AttributeError, OSError):
+            self.seekable = False
+            self._offset = 0
+        self._central_dir = bytearray()
+        self._count = 0
+        self._names = set()
+        self._member = None
+        self._log = logging.getLogger("zip")
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def tell(self):
+        """Returns a current offset in the archive."""
+        return self._offset
+
+    def closed_size(self):
+        """Returns an offset of the end of the archive if it's closed now."""
+        size = self._offset + len(self._central_dir) + self.end_record.size
+        if (
+            self._count > self.filecount_limit
+            or self._offset > self.zip64_limit
+            or len(self._central_dir) > self.zip64_limit
+        ):
+            size += self.end_record64.size + self.end_locator64.size
+        return size
+
+    def _write(self, data):
+        self.fp.write(data)
+        self._offset += len(data)
+        if self.hash_obj is not None:
+            self.hash_obj.update(data)
+
+    def _check(self, zinfo):
+        if self.fp is None:
+            raise ValueError("Attempt to write to ZIP archive that was already closed")
+        if self._member is not None:
+            raise ValueError("Can't write to ZIP archive while a member is written")
+        if zinfo.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise NotImplementedError(
+                "Compression method is not supported: {}".format(zinfo.compress_type)
+            )
+        if not self.allow_zip64:
+            if self._count >= self.filecount_limit:
+                raise zipfile.LargeZipFile("Files count would require ZIP64 extensions")
+            if self._offset > self.zip64_limit:
+                raise zipfile.LargeZipFile(
+                    "Zipfile size would require ZIP64 extensions"
+                )
+        if zinfo.filename in self._names:
+            self._log.warning("duplicate name: %s", zinfo.filename)
+        self._names.add(zinfo.filename)
+
+    def _zip64(self, zinfo):
+        # Compressed size can be larger than uncompressed size
+        zip64 = zinfo.file_size * 1.05 > self.zip64_limit
+        if zip64 and not self.allow_zip64:
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+        return zip64
+
+    @staticmethod
+    def _dos_date_time(date_time):
+        dt = date_time
+        dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+        dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+        return dosdate, dostime
+
+    @staticmethod
+    def _encode_filename(zinfo):
+        try:
+            return zinfo.filename.encode("ascii"), zinfo.flag_bits
+        except UnicodeEncodeError:
+            return zinfo.filename.encode("utf-8"), zinfo.flag_bits | 0x800
+
+    def _file_header(self, zinfo, zip64):
+        dosdate, dostime = self._dos_date_time(zinfo.date_time)
+        if zinfo.flag_bits & 0x08:
+            # Written in a data descriptor after the file data
+            crc = compress_size = file_size = 0
+        else:
+            crc = zinfo.CRC
+            compress_size = zinfo.compress_size
+            file_size = zinfo.file_size
+
+        extra = zinfo.extra
+        if zip64:
+            extra = extra + struct.pack("<HHQQ", 1, 16, file_size, compress_size)
+            file_size = compress_size = 0xFFFFFFFF
+            zinfo.extract_version = max(45, zinfo.extract_version)
+            zinfo.create_version = max(45, zinfo.create_version)
+
+        filename, flag_bits = self._encode_filename(zinfo)
+        header = self.local_header.pack(
+            b"PK\x03\x04",
+            zinfo.extract_version,
+            zinfo.reserved,
+            flag_bits,
+            zinfo.compress_type,
+            dostime,
+            dosdate,
+            crc,
+            compress_size,
+            file_size,
+            len(filename),
+            len(extra),
+        )
+        return header + filename + extra
+
+    def _add_central_record(self, zinfo):
+        dosdate, dostime = self._dos_date_time(zinfo.date_time)
+        extra = []
+        file_size = zinfo.file_size
+        compress_size = zinfo.compress_size
+        if file_size > self.zip64_limit or compress_size > self.zip64_limit:
+            extra.extend((file_size, compress_size))
+            file_size = compress_size = 0xFFFFFFFF
+        header_offset = zinfo.header_offset
+        if header_offset > self.zip64_limit:
+            extra.append(header_offset)
+            header_offset = 0xFFFFFFFF
+
+        extra_data = zinfo.extra
+        min_version = 0
+        if extra:
+            extra_data = (
+                struct.pack("<HH" + "Q" * len(extra), 1, 8 * len(extra), *extra)
+                + extra_data
+            )
+            min_version = 45
+
+        filename, flag_bits = self._encode_filename(zinfo)
+        self._central_dir += self.central_header.pack(
+            b"PK\x01\x02",
+            max(min_version, zinfo.create_version),
+            zinfo.create_system,
+            max(min_version, zinfo.extract_version),
+            zinfo.reserved,
+            flag_bits,
+            zinfo.compress_type,
+            dostime,
+            dosdate,
+            zinfo.CRC,
+            compress_size,
+            file_size,
+            len(filename),
+            len(extra_data),
+            len(zinfo.comment),
+            0,
+            zinfo.internal_attr,
+            zinfo.external_attr,
+            header_offset,
+        )
+        self._central_dir += filename
+        self._central_dir += extra_data
+        self._central_dir += zinfo.comment
+        self._count += 1
+
+    def write_dir(self, zinfo):
+        """Writes a directory member."""
+        self._check(zinfo)
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        zinfo.header_offset = self._offset
+        self._write(self._file_header(zinfo, False))
+        self._add_central_record(zinfo)
+
+    def write_member(self, zinfo, payload, crc, file_size):
+        """Writes a member with already compressed data."""
+        self._check(zinfo)
+        zip64 = self._zip64(zinfo)
+        zinfo.flag_bits = 0x00
+        if not zinfo.external_attr:
+            zinfo.external_attr = 0o600 << 16  # permissions: ?rw-------
+        zinfo.CRC = crc
+        zinfo.compress_size = len(payload)
+        zinfo.file_size = file_size
+        if not zip64 and max(file_size, len(payload)) > self.zip64_limit:
+            raise RuntimeError("File size too large, try using force_zip64")
+        zinfo.header_offset = self._offset
+        self._write(self._file_header(zinfo, zip64))
+        self._write(payload)
+        self._add_central_record(zinfo)
+
+    def start_member(self, zinfo, crc=None, compress_size=None):
+        """
+        Starts a member which data is written with write() and copy_file().
+        If CRC and compressed size of the data are given, its local header
+        is written as is and end_member() checks them.
+        """
+        self._check(zinfo)
+        zip64 = self._zip64(zinfo)
+        zinfo.flag_bits = 0x00 if self.seekable else 0x08
+        if not zinfo.external_attr:
+            zinfo.external_attr = 0o600 << 16  # permissions: ?rw-------
+        zinfo.CRC = crc or 0
+        zinfo.compress_size = compress_size or 0
+        zinfo.header_offset = self._offset
+        known = crc is not None and compress_size is not None
+        spool = None
+        if self.seekable and not known and self.hash_obj is not None:
+            # Hashed in the order of the archive after the header is known
+            spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        else:
+            self._write(self._file_header(zinfo, zip64))
+        self._member = (zinfo, zip64, self._offset, known, spool)
+
+    def write(self, data):
+        """Writes compressed data of the current member."""
+        spool = self._member[4]
+        if spool is not None:
+            spool.write(data)
+        else:
+            self._write(data)
+
+    def copy_file(self, src, count):
+        """
+        Copies up to count bytes from the current position of a source file
+        as compressed data of the current member, letting the kernel copy them
+        when possible (the bytes aren't hashed then, so only without a hash
+        object). Returns a number of copied bytes.
+        """
+        copied = 0
+        offset = src.tell()
+        kernel_copy = hasattr(os, "copy_file_range") or (
+            hasattr(os, "sendfile") and not WINDOWS
+        )
+        if self.seekable and kernel_copy and self.hash_obj is None:
+            self.fp.flush()
+            src_fd, dest_fd = src.fileno(), self.fp.fileno()
+            os.lseek(dest_fd, self._offset, os.SEEK_SET)
+            try:
+                while copied < count:
+                    n = count - copied
+                    if hasattr(os, "copy_file_range"):
+                        n = os.copy_file_range(src_fd, dest_fd, n, offset + copied)
+                    else:
+                        n = os.sendfile(dest_fd, src_fd, offset + copied, n)
+                    if not n:
+                        break
+                    copied += n
+            except OSError as e:
+                self._log.debug("kernel copy is not available: %s", e)
+            # Synchronize positions of buffered files
+            self.fp.seek(self._offset + copied)
+            self._offset += copied
+            src.seek(offset + copied)
+
+        while copied < count:
+            data = src.read(min(count - copied, 1024 * 1024))
+            if not data:
+                break
+            self.write(data)
+            copied += len(data)
+        return copied
+
+    def end_member(self, crc, file_size):
+        """Completes the current member."""
+        zinfo, zip64, data_offset, known, spool = self._member
+        self._member = None
+        if spool is not None:
+            with spool:
+                compress_size = spool.tell()
+                spool.seek(0)
+                zinfo.CRC = crc
+                zinfo.compress_size = compress_size
+                zinfo.file_size = file_size
+                self._write(self._file_header(zinfo, zip64))
+                data_offset = self._offset
+                while True:
+                    data = spool.read(1024 * 1024)
+                    if not data:
+                        break
+                    self._write(data)
+        compress_size = self._offset - data_offset
+        if known and (zinfo.CRC, zinfo.compress_size, zinfo.file_size) != (
+            crc,
+            compress_size,
+            file_size,
+        ):
+            raise RuntimeError(
+                "Member data doesn't match its header: {}".format(zinfo.filename)
+            )
+        zinfo.CRC = crc
+        zinfo.compress_size = compress_size
+        zinfo.file_size = file_size
+        if not zip64 and max(file_size, zinfo.compress_size) > self.zip64_limit:
+            raise RuntimeError("File size too large, try using force_zip64")
+
+        if zinfo.flag_bits & 0x08:
+            fmt = "<LLQQ" if zip64 else "<LLLL"
+            self._write(
+                struct.pack(fmt, 0x08074B50, crc, zinfo.compress_size, file_size)
+            )
+        elif not (known or spool is not None):
+            # Update the header with sizes and CRC, it keeps the same length
+            self.fp.seek(zinfo.header_offset)
+            self.fp.write(self._file_header(zinfo, zip64))
+            self.fp.seek(self._offset)
+        self._add_central_record(zinfo)
+
+    def close(self):
+        """Writes the central directory and the end of the archive."""
+        if self.fp is None:
+            return
+        if self._member is not None:
+            raise ValueError("Can't close ZIP archive while a member is written")
+
+        central_dir_offset = self._offset
+        self._write(self._central_dir)
+        central_dir_size = len(self._central_dir)
+        count = self._count
+        self._central_dir = bytearray()
+
+        requires_zip64 = None
+        if count > self.filecount_limit:
+            requires_zip64 = "Files count"
+        elif central_dir_offset > self.zip64_limit:
+            requires_zip64 = "Central directory offset"
+        elif central_dir_size > self.zip64_limit:
+            requires_zip64 = "Central directory size"
+        if requires_zip64:
+            if not self.allow_zip64:
+                raise zipfile.LargeZipFile(
+                    requires_zip64 + " would require ZIP64 extensions"
+                )
+            end_record_offset = self._offset
+            self._write(
+                self.end_record64.pack(
+                    b"PK\x06\x06",
+                    44,
+                    45,
+                    45,
+                    0,
+                    0,
+                    count,
+                    count,
+                    central_dir_size,
+                    central_dir_offset,
+                )
+            )
+            self._write(self.end_locator64.pack(b"PK\x06\x07", 0, end_record_offset, 1))
+            count = min(count, 0xFFFF)
+            central_dir_size = min(central_dir_size, 0xFFFFFFFF)
+            central_dir_offset = min(central_dir_offset, 0xFFFFFFFF)
+
+        self._write(
+            self.end_record.pack(
+                b"PK\x05\x06",
+                0,
+                0,
+                count,
+                count,
+                central_dir_size,
+                central_dir_offset,
+                0,
+            )
+        )
+        self.fp.flush()
+        self.fp = None
+
 
 class ZipWriteStream:
     """"""
 
+    # A default limit of file bytes being compressed at once by workers
+    max_inflight_bytes = 256 * 1024 * 1024
+
+    # Files of this size and larger are read in large slices and stored ones
+    # are copied after their CRC is computed
+    large_file_size = 16 * 1024 * 1024
+    large_chunk_size = 8 * 1024 * 1024
+
+    # Contents of files of this size and smaller are kept in memory while
+    # they are looked up in the member cache, larger ones are read again
+    max_buffered_size = 1024 * 1024
+
     def __init__(
         self,
         zip_filename,
@@ -313,6 +1803,11 @@ class ZipWriteStream:
         compresslevel=None,
         timestamp=None,
         quiet=False,
+        workers=None,
+        max_inflight_bytes=None,
+        member_cache=None,
+        lineage=None,
+        size_profiler=None,
     ):
         self.timestamp = timestamp
         self.filename = zip_filename
@@ -326,6 +1821,33 @@ class ZipWriteStream:
         self._compresslevel = compresslevel
         self._zip = None
 
+        # Members compressed by workers, written in the order of submission
+        self._workers = workers if workers and workers > 1 else None
+        if max_inflight_bytes:
+            self.max_inflight_bytes = max_inflight_bytes
+        self._executor = None
+        self._pending = deque()
+        self._inflight_bytes = 0
+        self._member_cache = member_cache
+
+        # Members of the previous archive of the same lineage
+        self._lineage = lineage
+        self._digests = {}
+        self._base_digests = {}
+        self._base_members = {}
+        self._base_fp = None
+        self._base_lock = threading.Lock()
+        self.reused = 0
+
+        self._compression_policy = None
+        self._compression_policies = []
+
+        self._size_profiler = size_profiler
+
+        # A digest of the archive, computed while it's written
+        self._hash_obj = None
+        self.base64sha256 = None
+
         self._log = logging.getLogger("zip")
 
     def open(self):
@@ -335,18 +1857,89 @@ class ZipWriteStream:
         self._tmp_filename = "{}.tmp".format(self.filename)
         if not self.quiet:
             self._log.info("creating '%s' archive", self.filename)
-        self._zip = zipfile.ZipFile(self._tmp_filename, "w", self._compress_type)
+        self._hash_obj = hashlib.sha256()
+        # Readable, so members with updated headers can be hashed
+        self._zip = ZipWriter(open(self._tmp_filename, "w+b"), hash_obj=self._hash_obj)
+        if self._workers:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        if self._lineage:
+            self._open_base()
         return self
 
+    def _open_base(self):
+        base_filename, digests = self._lineage.load(
+            self._compress_type, self._compresslevel
+        )
+        if not base_filename:
+            return
+        try:
+            with zipfile.ZipFile(base_filename) as zf:
+                members = {zinfo.filename: zinfo for zinfo in zf.infolist()}
+            self._base_fp = open(base_filename, "rb")
+        except (OSError, zipfile.BadZipFile) as e:
+            self._log.warning("ignoring base archive %s: %s", base_filename, e)
+            return
+        if not self.quiet:
+            self._log.info("using base archive '%s'", base_filename)
+        self._base_members = members
+        self._base_digests = digests
+
     def close(self, failed=False):
-        self._zip.close()
-        self._zip = None
+        if not failed:
+            try:
+                self._write_pending()
+                if self._size_profiler:
+                    self._size_profiler.set_archive_size(self._zip.closed_size())
+            except BaseException:
+                self.close(failed=True)
+                raise
+        if self._executor:
+            for _, future, *_ in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._executor.shutdown()
+            self._executor = None
+        zip, self._zip = self._zip, None
+        fp = zip.fp
+        try:
+            if not failed:
+                zip.close()
+        finally:
+            if fp:
+                fp.close()
+        if self._base_fp:
+            self._base_fp.close()
+            self._base_fp = None
+        if not failed and not self.quiet:
+            CompressionPolicy.report(self._compression_policies, self._log)
+        profiler = self._size_profiler
+        if profiler and (not failed or profiler.exceeded):
+            profiler.write_report(self.filename)
+        cache = self._member_cache
+        if cache and not failed:
+            self._log.debug("zip cache: %d hits, %d misses", cache.hits, cache.misses)
+            cache.evict()
         if not os.path.exists(self._tmp_filename):
             return
         if failed:
             os.unlink(self._tmp_filename)
         else:
+            # Don't leave a sidecar of a replaced archive if writing fails
+            try:
+                os.unlink("{}.sha256".format(self.filename))
+            except FileNotFoundError:
+                pass
             os.replace(self._tmp_filename, self.filename)
+            sidecar = write_sha256_sidecar(self.filename, self._hash_obj)
+            self.base64sha256 = sidecar["base64sha256"]
+            if self._lineage:
+                self._log.debug("reused %d members of base archive", self.reused)
+                self._lineage.save(
+                    self.filename,
+                    self._digests,
+                    self._compress_type,
+                    self._compresslevel,
+                )
 
     def __enter__(self):
         return self.open()
@@ -377,7 +1970,11 @@ class ZipWriteStream:
                 self._log.exception("Error during zip archive creation")
             self.close(failed=True)
             raise SystemExit(1)
-        self.close()
+        try:
+            self.close()
+        except Exception:
+            self._log.exception("Error during zip archive creation")
+            raise SystemExit(1)
 
     def _ensure_open(self):
         if self._zip is not None:
@@ -393,7 +1990,21 @@ class ZipWriteStream:
             self._log.info("creating %s", archive_dir)
             os.makedirs(archive_dir, exist_ok=True)
 
-    def write_dirs(self, *base_dirs, prefix=None, timestamp=None):
+    def set_compression_policy(self, policy):
+        """
+        Sets a policy choosing compression of the next members,
+        None resets it to the compression of the stream.
+        """
+        self._compression_policy = policy
+        if policy and policy not in self._compression_policies:
+            self._compression_policies.append(policy)
+
+    def set_size_claim(self, claim):
+        """Sets a name of a claim to account sizes of the next members in."""
+        if self._size_profiler:
+            self._size_profiler.claim = claim
+
+    def write_dirs(self, *base_dirs, prefix=None, timestamp=None, follow_symlinks=True):
         """
         Writes a directory content to a prefix inside of a zip archive
         """
@@ -401,9 +2012,9 @@ class ZipWriteStream:
         for base_dir in base_dirs:
             if not self.quiet:
                 self._log.info("adding content of directory: %s", base_dir)
-            for path in emit_dir_content(base_dir):
+            for path, st in emit_dir_entries(base_dir, follow_symlinks):
                 arcname = os.path.relpath(path, base_dir)
-                self._write_file(path, prefix, arcname, timestamp)
+                self._write_file(path, prefix, arcname, timestamp, st=st)
 
     def write_files(self, files_stream, prefix=None, timestamp=None):
         """
@@ -413,19 +2024,32 @@ class ZipWriteStream:
         for file_path, arcname in files_stream:
             self._write_file(file_path, prefix, arcname, timestamp)
 
-    def write_file(self, file_path, prefix=None, name=None, timestamp=None):
+    def write_file(self, file_path, prefix=None, name=None, timestamp=None, st=None):
         """
         Reads a file and writes it to a prefix
         or a full qualified name in a zip archive
         """
         self._ensure_open()
-        self._write_file(file_path, prefix, name, timestamp)
+        self._write_file(file_path, prefix, name, timestamp, st=st)
+
+    def write_manifest(self, base_path, stats, prefix=None, timestamp=None):
+        """
+        Writes files listed in a manifest made by the prepare command
+        without walking a directory again. Stats are (path, arcname,
+        stat result) of files checked by BuildPlanManager before the
+        build starts.
+        """
+        self._ensure_open()
+        if not self.quiet:
+            self._log.info("adding content of manifest: %s", base_path)
+        for path, arcname, st in stats:
+            self._write_file(path, prefix, arcname, timestamp, st=st)
 
-    def _write_file(self, file_path, prefix=None, name=None, timestamp=None):
+    def _write_file(self, file_path, prefix=None, name=None, timestamp=None, st=None):
         arcname = name if name else os.path.basename(file_path)
         if prefix:
             arcname = os.path.join(prefix, arcname)
-        zinfo = self._make_zinfo_from_file(file_path, arcname)
+        zinfo = self._make_zinfo_from_file(file_path, arcname, st)
         if not self.quiet:
             if zinfo.is_dir():
                 self._log.info("adding: %s/", arcname)
@@ -436,7 +2060,7 @@ class ZipWriteStream:
         date_time = self._timestamp_to_date_time(timestamp)
         if date_time:
             self._update_zinfo(zinfo, date_time=date_time)
-        self._write_zinfo(zinfo, file_path)
+        self._write_zinfo(zinfo, file_path, prefix=prefix)
 
     def write_file_obj(self, file_path, data, prefix=None, timestamp=None):
         """
@@ -445,57 +2069,313 @@ class ZipWriteStream:
         self._ensure_open()
         raise NotImplementedError
 
-    def _write_zinfo(self, zinfo, filename, compress_type=None, compresslevel=None):
+    def _write_zinfo(
+        self, zinfo, filename, compress_type=None, compresslevel=None, prefix=None
+    ):
         self._ensure_open()
 
         zip = self._zip
 
-        if not zip.fp:
-            raise ValueError("Attempt to write to ZIP archive that was already closed")
-        if zip._writing:
-            raise ValueError(
-                "Can't write to ZIP archive while an open writing handle exists"
-            )
+        totals = None
+        if self._size_profiler:
+            totals = self._size_profiler.add(zinfo, prefix)
+
+        if stat.S_ISLNK(zinfo.external_attr >> 16):
+            # Keep members in order of writing
+            self._write_pending()
+            target = symlink_target(filename)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            zip.write_member(zinfo, target, zlib.crc32(target), len(target))
+            self._account_written(zinfo, totals)
+            return
 
-        if zinfo.is_dir():
-            zinfo.compress_size = 0
-            zinfo.CRC = 0
-        else:
+        if not zinfo.is_dir():
             if compress_type is not None:
                 zinfo.compress_type = compress_type
+            elif self._compression_policy:
+                zinfo.compress_type, compresslevel = self._compression_policy.choose(
+                    filename, zinfo.file_size
+                )
             else:
                 zinfo.compress_type = self._compress_type
 
-            if PY37:
-                if compresslevel is not None:
-                    zinfo._compresslevel = compresslevel
-                else:
-                    zinfo._compresslevel = self._compresslevel
+        compress = None
+        if (
+            not zinfo.is_dir()
+            and zinfo.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+            and zip.seekable
+            and zinfo.file_size <= self.max_inflight_bytes
+        ):
+            cache = self._member_cache
+            if self._lineage:
+                compress = functools.partial(
+                    self._compress_incremental,
+                    zinfo.filename,
+                    self._base_member(zinfo),
+                )
+            elif cache and zinfo.file_size >= cache.min_file_size:
+                compress = self._compress_cached
+            elif self._executor or zinfo.file_size < self.large_file_size:
+                # Small files are written without updating a local header
+                compress = self._compress_file
+        if compresslevel is None:
+            compresslevel = self._compresslevel
+
+        if compress and not self._executor:
+            zip.write_member(
+                zinfo, *compress(filename, zinfo.compress_type, compresslevel)
+            )
+            self._account_written(zinfo, totals)
+            return
+        if compress:
+            future = self._executor.submit(
+                compress, filename, zinfo.compress_type, compresslevel
+            )
+            self._pending.append((zinfo, future, zinfo.file_size, totals))
+            self._inflight_bytes += zinfo.file_size
+            while self._inflight_bytes > self.max_inflight_bytes:
+                self._write_pending(1)
+            return
+
+        # Keep members in order of writing
+        self._write_pending()
 
         if zinfo.is_dir():
-            with zip._lock:
-                if zip._seekable:
-                    zip.fp.seek(zip.start_dir)
-                zinfo.header_offset = zip.fp.tell()  # Start of header bytes
-                if zinfo.compress_type == zipfile.ZIP_LZMA:
-                    # Compressed data includes an end-of-stream (EOS) marker
-                    zinfo.flag_bits |= 0x02
-
-                zip._writecheck(zinfo)
-                zip._didModify = True
-
-                zip.filelist.append(zinfo)
-                zip.NameToInfo[zinfo.filename] = zinfo
-                zip.fp.write(zinfo.FileHeader(False))
-                zip.start_dir = zip.fp.tell()
+            zip.write_dir(zinfo)
         else:
-            with open(filename, "rb") as src, zip.open(zinfo, "w") as dest:
-                shutil.copyfileobj(src, dest, 1024 * 8)
+            self._write_stream(zinfo, filename, compresslevel)
+        self._account_written(zinfo, totals)
+
+    def _account_written(self, zinfo, totals):
+        if totals is not None:
+            self._size_profiler.add_compressed(zinfo, totals, self._zip.tell())
+
+    def _write_pending(self, count=None):
+        """Writes members compressed by workers in the order of submission."""
+        while self._pending and (count is None or count > 0):
+            zinfo, future, size, totals = self._pending[0]
+            payload, crc, file_size = future.result()
+            self._pending.popleft()
+            self._inflight_bytes -= size
+            self._zip.write_member(zinfo, payload, crc, file_size)
+            self._account_written(zinfo, totals)
+            if count is not None:
+                count -= 1
+
+    def _write_stream(self, zinfo, filename, compresslevel=None):
+        """
+        Writes a file to the zip archive reading it in slices. Data of large
+        stored files is copied after their CRC is computed, so it's hashed as
+        it's written, other data is spooled by ZipWriter until its header is
+        known.
+        """
+        zip = self._zip
+        chunk_size = min(self.large_chunk_size, zinfo.file_size + 1)
+
+        with open(filename, "rb") as src:
+            st = os.fstat(src.fileno())
+            crc = 0
+            file_size = 0
+            if (
+                zinfo.compress_type == zipfile.ZIP_STORED
+                and zinfo.file_size >= self.large_file_size
+            ):
+                for data in self._read_chunks(src, chunk_size):
+                    file_size += len(data)
+                    crc = zlib.crc32(data, crc)
+                src.seek(0)
+                # The local header is known, so data is hashed as it's copied
+                zinfo.file_size = file_size
+                zip.start_member(zinfo, crc, file_size)
+                if zip.copy_file(src, file_size) != file_size:
+                    raise RuntimeError("Unexpected end of file: {}".format(filename))
+            else:
+                zip.start_member(zinfo)
+                compressor = self._compressor(zinfo.compress_type, compresslevel)
+                for data in self._read_chunks(src, chunk_size):
+                    file_size += len(data)
+                    crc = zlib.crc32(data, crc)
+                    zip.write(compressor.compress(data) if compressor else data)
+                if compressor:
+                    zip.write(compressor.flush())
+            if (st.st_size, st.st_mtime_ns) != (
+                file_size,
+                os.fstat(src.fileno()).st_mtime_ns,
+            ):
+                raise RuntimeError(
+                    "File has been changed while it was written: {}".format(filename)
+                )
+            zip.end_member(crc, file_size)
+
+    @staticmethod
+    def _read_chunks(src, chunk_size):
+        """Yields slices of a file read into a reused buffer."""
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            n = src.readinto(buffer)
+            if not n:
+                break
+            yield view[:n]
+
+    def _compress_cached(self, filename, compress_type, compresslevel=None):
+        """
+        Same as _compress_file, but reuses a compressed stream of the same
+        file content from the member cache.
+        """
+        digest, crc, file_size, data = self._digest_file(filename)
+        return self._compress_content(
+            filename,
+            digest.digest(),
+            crc,
+            file_size,
+            data,
+            compress_type,
+            compresslevel,
+        )
+
+    def _digest_file(self, filename):
+        """
+        Returns a sha256 object, CRC32 and size of a file content, reading
+        it in chunks, and the content itself if it's small enough to keep.
+        """
+        digest = hashlib.sha256()
+        chunks = []
+        crc = 0
+        file_size = 0
+        with open(filename, "rb") as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                digest.update(data)
+                crc = zlib.crc32(data, crc)
+                file_size += len(data)
+                if file_size <= self.max_buffered_size:
+                    chunks.append(data)
+        data = b"".join(chunks) if file_size <= self.max_buffered_size else None
+        return digest, crc, file_size, data
+
+    def _compress_content(
+        self, filename, digest, crc, file_size, data, compress_type, compresslevel=None
+    ):
+        cache = self._member_cache
+        key = None
+        if cache and file_size >= cache.min_file_size:
+            key = cache.key(digest, compress_type, compresslevel)
+            member = cache.get(key)
+            if member is not None and member[1:] == (crc, file_size):
+                return member
+        if data is not None:
+            member = self._compress_data(data, compress_type, compresslevel)
+        else:
+            member = self._compress_file(filename, compress_type, compresslevel)
+            if member[1:] != (crc, file_size):
+                raise RuntimeError(
+                    "File has been changed while it was written: {}".format(filename)
+                )
+        if key is not None:
+            cache.put(key, *member)
+        return member
+
+    def _base_member(self, zinfo):
+        """Returns a member of the base archive which may have the same data."""
+        base = self._base_members.get(zinfo.filename)
+        if (
+            base is not None
+            and base.file_size == zinfo.file_size
+            and base.external_attr == zinfo.external_attr
+            and base.compress_type == zinfo.compress_type
+            # Neither encrypted nor followed by a data descriptor
+            and not base.flag_bits & 0x09
+        ):
+            return base
+        return None
+
+    def _compress_incremental(
+        self, arcname, base, filename, compress_type, compresslevel=None
+    ):
+        """
+        Same as _compress_cached, but copies compressed data of a member
+        of the base archive, if it has the same content.
+        """
+        digest, crc, file_size, data = self._digest_file(filename)
+        self._digests[arcname] = digest.hexdigest()
+        if base is not None and self._base_digests.get(arcname) == digest.hexdigest():
+            if base.CRC == crc and base.file_size == file_size:
+                payload = self._read_base_payload(base)
+                if payload is not None:
+                    self.reused += 1
+                    return payload, crc, file_size
+        return self._compress_content(
+            filename,
+            digest.digest(),
+            crc,
+            file_size,
+            data,
+            compress_type,
+            compresslevel,
+        )
+
+    def _read_base_payload(self, base):
+        """Reads raw compressed data of a member of the base archive."""
+        with self._base_lock:
+            f = self._base_fp
+            f.seek(base.header_offset)
+            header = f.read(30)
+            if len(header) != 30 or header[:4] != b"PK\x03\x04":
+                return None
+            name_length, extra_length = struct.unpack("<HH", header[26:])
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+            payload = f.read(base.compress_size)
+        if len(payload) != base.compress_size:
+            return None
+        return payload
+
+    @staticmethod
+    def _compressor(compress_type, compresslevel=None):
+        if compress_type == zipfile.ZIP_DEFLATED:
+            if compresslevel is None:
+                compresslevel = zlib.Z_DEFAULT_COMPRESSION
+            return zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        return None
+
+    @classmethod
+    def _compress_data(cls, data, compress_type, compresslevel=None):
+        """Returns a raw compressed stream, CRC32 and size of data."""
+        compressor = cls._compressor(compress_type, compresslevel)
+        payload = compressor.compress(data) + compressor.flush() if compressor else data
+        return payload, zlib.crc32(data), len(data)
+
+    @classmethod
+    def _compress_file(cls, filename, compress_type, compresslevel=None):
+        """
+        Returns a raw compressed stream, CRC32 and size of a file content.
+        Zlib releases the GIL, so it's called in worker threads.
+        """
+        compressor = cls._compressor(compress_type, compresslevel)
+        chunks = []
+        crc = 0
+        file_size = 0
+        with open(filename, "rb") as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                file_size += len(data)
+                crc = zlib.crc32(data, crc)
+                chunks.append(compressor.compress(data) if compressor else data)
+        if compressor:
+            chunks.append(compressor.flush())
+        return b"".join(chunks), crc, file_size
+
+    def _make_zinfo_from_file(self, filename, arcname=None, st=None):
+        if st is not None:
+            return self._zinfo_from_stat(st, arcname or filename)
 
-    def _make_zinfo_from_file(self, filename, arcname=None):
         if PY38:
             zinfo_func = zipfile.ZipInfo.from_file
-            strict_timestamps = self._zip._strict_timestamps
+            strict_timestamps = True
         else:
             zinfo_func = self._zinfo_from_file
             strict_timestamps = True
@@ -521,6 +2401,15 @@ class ZipWriteStream:
         if isinstance(filename, os.PathLike):
             filename = os.fspath(filename)
         st = os.stat(filename)
+        if arcname is None:
+            arcname = filename
+        return ZipWriteStream._zinfo_from_stat(
+            st, arcname, strict_timestamps=strict_timestamps
+        )
+
+    @staticmethod
+    def _zinfo_from_stat(st, arcname, *, strict_timestamps=True):
+        """Construct an appropriate ZipInfo from a stat result of a file."""
         isdir = stat.S_ISDIR(st.st_mode)
         mtime = time.localtime(st.st_mtime)
         date_time = mtime[0:6]
@@ -529,8 +2418,6 @@ class ZipWriteStream:
         elif strict_timestamps and date_time[0] > 2107:
             date_time = (2107, 12, 31, 23, 59, 59)
         # Create ZipInfo instance to store file information
-        if arcname is None:
-            arcname = filename
         arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
         while arcname[0] in (os.sep, os.altsep):
             arcname = arcname[1:]
@@ -621,6 +2508,14 @@ class ZipContentFilter:
         self._rules = None
 
     def filter(self, path, prefix=None):
+        for op, _ in self.filter_entries(path, prefix):
+            yield op
+
+    def filter_entries(self, path, prefix=None, follow_symlinks=True):
+        """
+        Same as filter, but yields paths with their stat results
+        (None for broken symlinks).
+        """
         path = os.path.normpath(path)
         if prefix:
             prefix = os.path.normpath(prefix)
@@ -649,37 +2544,308 @@ class ZipContentFilter:
             if d:
                 return path
 
-        def emit_dir(dpath, opath):
-            if apply(dpath):
-                yield opath
-            else:
-                self._log.debug("skip:   %s", dpath)
-
-        def emit_file(fpath, opath):
-            if apply(fpath):
-                yield opath
+        def emit_entry(rpath, opath, entry):
+            if apply(rpath):
+                yield opath, entry_stat(entry)
             else:
-                self._log.debug("skip:   %s", fpath)
+                self._log.debug("skip:   %s", rpath)
 
-        if os.path.isfile(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is not None and stat.S_ISREG(st.st_mode):
             name = os.path.basename(path)
             if prefix:
                 name = os.path.join(prefix, name)
             if apply(name):
-                yield path
+                yield path, st
         else:
-            for root, dirs, files in os.walk(path, followlinks=True):
-                # Sort directories and files to ensure they are always processed in the same order
-                dirs.sort()
-                files.sort()
-                o, d = norm_path(path, root)
-                # log.info('od: %s %s', o, d)
+            dir_entries = {}
+            for root, dirs, files in scan_dir(path, follow_symlinks):
                 if root != path:
-                    yield from emit_dir(d, o)
-                for name in files:
-                    o, f = norm_path(path, root, name)
-                    # log.info('of: %s %s', o, f)
-                    yield from emit_file(f, o)
+                    o, d = norm_path(path, root)
+                    yield from emit_entry(d, o, dir_entries.pop(root))
+                for entry in dirs:
+                    dir_entries[entry.path] = entry
+                for entry in files:
+                    o, f = norm_path(path, root, entry.name)
+                    yield from emit_entry(f, o, entry)
+
+
+class CompressionPolicy:
+    """
+    Chooses a compression method and level per zip member.
+
+    Files with extensions of already compressed formats are stored as is,
+    the others are stored when a sample from the beginning of a file looks
+    like random data, and deflated otherwise.
+    """
+
+    stored_extensions = (
+        ".zip",
+        ".whl",
+        ".egg",
+        ".jar",
+        ".war",
+        ".gz",
+        ".tgz",
+        ".bz2",
+        ".xz",
+        ".zst",
+        ".7z",
+        ".png",
+        ".jpg",
+        ".jpeg",
+        ".gif",
+        ".webp",
+        ".mp3",
+        ".mp4",
+        ".woff",
+        ".woff2",
+        ".onnx",
+        ".pt",
+        ".pth",
+        ".h5",
+        ".safetensors",
+        ".tflite",
+    )
+    # Shannon entropy (bits per byte) of a sample above which a file is stored
+    entropy_threshold = 7.5
+    sample_size = 4096
+
+    def __init__(self, level=None, stored_extensions=None, entropy_threshold=None):
+        if level is not None and not (isinstance(level, int) and 0 <= level <= 9):
+            raise ValueError("Compression level must be from 0 to 9: {}".format(level))
+        self.level = level
+        if stored_extensions is not None:
+            self.stored_extensions = tuple(e.lower() for e in stored_extensions)
+        if entropy_threshold is not None:
+            self.entropy_threshold = float(entropy_threshold)
+        self.stats = {
+            "stored_files": 0,
+            "stored_bytes": 0,
+            "bytes_added": 0,
+            "seconds_saved": 0.0,
+        }
+        self._log = logging.getLogger("zip")
+
+    @classmethod
+    def from_config(cls, config):
+        """Makes a policy from a `compression` value of a source_path item."""
+        if config is True:
+            config = {}
+        if not isinstance(config, dict):
+            raise ValueError("Unsupported compression value: {}".format(config))
+        unknown = set(config) - {"level", "stored_extensions", "entropy_threshold"}
+        if unknown:
+            raise ValueError(
+                "Unsupported compression options: {}".format(", ".join(sorted(unknown)))
+            )
+        return cls(**config)
+
+    @staticmethod
+    def entropy(data):
+        if not data:
+            return 0.0
+        n = len(data)
+        return -sum(c / n * math.log2(c / n) for c in Counter(data).values())
+
+    def choose(self, filename, file_size):
+        """Returns a compression method and level for a file."""
+        if file_size and filename.lower().endswith(self.stored_extensions):
+            sample = None
+        elif file_size >= self.sample_size:
+            with open(filename, "rb") as f:
+                sample = f.read(self.sample_size)
+            if self.entropy(sample) < self.entropy_threshold:
+                return zipfile.ZIP_DEFLATED, self.level
+        else:
+            return zipfile.ZIP_DEFLATED, self.level
+        self._account_stored(filename, file_size, sample)
+        return zipfile.ZIP_STORED, None
+
+    def _account_stored(self, filename, file_size, sample):
+        """
+        Estimates bytes added and compression time saved by storing a file,
+        extrapolating them from deflating a sample of it.
+        """
+        if sample is None:
+            with open(filename, "rb") as f:
+                sample = f.read(self.sample_size)
+        level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+        started = time.perf_counter()
+        compressed = zlib.compress(sample, level)
+        elapsed = time.perf_counter() - started
+        ratio = file_size / len(sample) if sample else 0
+        stats = self.stats
+        stats["stored_files"] += 1
+        stats["stored_bytes"] += file_size
+        stats["bytes_added"] += max(0, int((len(sample) - len(compressed)) * ratio))
+        stats["seconds_saved"] += elapsed * ratio
+        self._log.debug("storing uncompressed: %s", filename)
+
+    @staticmethod
+    def report(policies, log):
+        total = {}
+        for policy in policies:
+            for k, v in policy.stats.items():
+                total[k] = total.get(k, 0) + v
+        if not total.get("stored_files"):
+            return
+        log.info(
+            "compression policy: stored %d files (%d bytes) uncompressed, "
+            "about %d bytes added and %.2fs of compression saved",
+            total["stored_files"],
+            total["stored_bytes"],
+            total["bytes_added"],
+            total["seconds_saved"],
+        )
+
+
+class ZipSizeProfiler:
+    """
+    Keeps running totals of uncompressed and compressed sizes of zip members
+    per source_path claim, prefix and top-level package, and fails a build
+    as soon as a size budget is exceeded.
+    """
+
+    # A number of the largest entries of each breakdown in the summary
+    summary_size = 10
+
+    def __init__(self, max_unzipped_size=None, max_zipped_size=None):
+        self.max_unzipped_size = max_unzipped_size
+        self.max_zipped_size = max_zipped_size
+        self.claim = None
+        self.archive_size = 0
+        self.exceeded = None
+        # [unzipped, zipped, files]
+        self.total = [0, 0, 0]
+        self.claims = {}
+        self.prefixes = {}
+        self.packages = {}
+        self._log = logging.getLogger("zip")
+
+    def add(self, zinfo, prefix=None):
+        """
+        Accounts an uncompressed size of a member before it's written and
+        returns totals to account its compressed size in.
+        """
+        prefix = prefix.strip("/") if prefix else ""
+        name = zinfo.filename
+        if prefix and name.startswith(prefix + "/"):
+            name = name[len(prefix) + 1 :]
+        package = name.split("/", 1)[0]
+        if prefix:
+            package = "{}/{}".format(prefix, package)
+        totals = (
+            self.total,
+            self.claims.setdefault(self.claim or "", [0, 0, 0]),
+            self.prefixes.setdefault(prefix, [0, 0, 0]),
+            self.packages.setdefault(package, [0, 0, 0]),
+        )
+        for t in totals:
+            t[0] += zinfo.file_size
+            t[2] += 1
+        self._check("unzipped", self.total[0], self.max_unzipped_size, zinfo.filename)
+        return totals
+
+    def add_compressed(self, zinfo, totals, archive_size):
+        """Accounts a compressed size of a written member."""
+        for t in totals:
+            t[1] += zinfo.compress_size
+        self.archive_size = archive_size
+        self._check("zipped", archive_size, self.max_zipped_size, zinfo.filename)
+
+    def set_archive_size(self, archive_size):
+        """Checks a final size of the archive with its central directory."""
+        self.archive_size = archive_size
+        self._check("zipped", archive_size, self.max_zipped_size, "central directory")
+
+    def _check(self, kind, size, budget, filename):
+        if budget is None or size <= budget:
+            return
+        self.exceeded = "{} size budget of {} is exceeded by {}".format(
+            kind, self.format_size(budget), filename
+        )
+        raise RuntimeError(
+            "Package {}, the largest contributors:\n{}".format(
+                self.exceeded, self.summary()
+            )
+        )
+
+    @staticmethod
+    def format_size(size):
+        if size < 1024:
+            return "{} B".format(size)
+        for unit in ("KiB", "MiB", "GiB"):
+            size /= 1024
+            if size < 1024 or unit == "GiB":
+                return "{:.1f} {}".format(size, unit)
+
+    @staticmethod
+    def _sorted(breakdown):
+        return [
+            {"name": name, "unzipped": u, "zipped": z, "files": n}
+            for name, (u, z, n) in sorted(
+                breakdown.items(), key=lambda item: (-item[1][0], item[0])
+            )
+        ]
+
+    def report(self):
+        """Returns a breakdown of sizes, the largest entries first."""
+        u, z, n = self.total
+        return {
+            "total": {"unzipped": u, "zipped": z, "files": n},
+            "archive_size": self.archive_size,
+            "budgets": {
+                "unzipped": self.max_unzipped_size,
+                "zipped": self.max_zipped_size,
+            },
+            "exceeded": self.exceeded,
+            "claims": self._sorted(self.claims),
+            "prefixes": self._sorted(self.prefixes),
+            "packages": self._sorted(self.packages),
+        }
+
+    def summary(self, limit=None):
+        """Returns a human-readable breakdown of sizes."""
+        report = self.report()
+        fmt = "{:>12} {:>12} {:>8}  {}".format
+        total = report["total"]
+        lines = [
+            fmt("unzipped", "zipped", "files", "name"),
+            fmt(
+                self.format_size(total["unzipped"]),
+                self.format_size(total["zipped"]),
+                total["files"],
+                "total, archive {}".format(self.format_size(report["archive_size"])),
+            ),
+        ]
+        for title in ("claims", "prefixes", "packages"):
+            lines.append("{}:".format(title))
+            entries = report[title]
+            for entry in entries[: limit or self.summary_size]:
+                lines.append(
+                    fmt(
+                        self.format_size(entry["unzipped"]),
+                        self.format_size(entry["zipped"]),
+                        entry["files"],
+                        entry["name"] or "-",
+                    )
+                )
+            if len(entries) > (limit or self.summary_size):
+                lines.append("{:>35}  ...".format(""))
+        return "\n".join(lines)
+
+    def write_report(self, zip_filename):
+        """Writes <zip_filename>.size.json and <zip_filename>.size.txt reports."""
+        with open("{}.size.json".format(zip_filename), "w") as f:
+            json.dump(self.report(), f, indent=2)
+            f.write("\n")
+        with open("{}.size.txt".format(zip_filename), "w") as f:
+            f.write(self.summary(limit=sys.maxsize))
+            f.write("\n")
 
 
 def get_build_system_from_pyproject_toml(pyproject_file):
@@ -705,9 +2871,13 @@ class BuildPlanManager:
     def __init__(self, args, log=None):
         self._args = args
         self._source_paths = None
+        self._digests = {}
+        # Positions of zip actions mapped to indexes of their source paths
+        self._zip_sources = {}
+        self._walked = {}
         self._log = log or logging.root
 
-    def hash(self):
+    def hash(self, digest_cache=None, workers=None):
         if not self._source_paths:
             raise ValueError("BuildPlanManager.plan() should be called first")
 
@@ -715,9 +2885,78 @@ class BuildPlanManager:
         # runtime value, build command, and content of the build paths
         # because they can have an effect on the resulting archive.
         self._log.debug("Computing content hash on files...")
-        content_hash = generate_content_hash(self._source_paths, log=self._log)
+        content_hash = generate_content_hash(
+            self._source_paths,
+            log=self._log,
+            digest_cache=digest_cache,
+            workers=workers,
+            digests=self._digests,
+            walked=self._walked if self._args.manifest else None,
+        )
         return content_hash
 
+    def source_dirs(self):
+        """Returns absolute paths of directories listed as sources."""
+        dirs = []
+        for p, *_ in self._source_paths or []:
+            p = os.path.abspath(p)
+            if os.path.isdir(p) and p not in dirs:
+                dirs.append(p)
+        return dirs
+
+    def manifest(self):
+        """
+        Lists files to be zipped by the zip actions of a build plan
+        which sources exist before the build, so the build command can
+        write them without walking the source paths again. Files are
+        listed as they were walked by hash().
+
+        Returns a manifest, a mapping of "<step>.<action>" positions to
+        mappings of "files", a list of [arcname, size, mode, digest]
+        entries, and "dirs", relative paths of the source directory and
+        its directories with listed files, which mtimes change when files
+        are added to them. The manifest is a part of the build plan, so
+        mtimes of files and directories are returned separately as
+        a mapping of positions to mappings of relative paths to mtimes.
+        """
+        manifest = {}
+        mtimes = {}
+        for position, index in self._zip_sources.items():
+            source_path = self._source_paths[index][0]
+            isdir = os.path.isdir(source_path)
+            entries = []
+            source_mtimes = {}
+            for path, st in self._walked.get(index, ()):
+                if isdir:
+                    arcname = os.path.relpath(path, source_path)
+                else:
+                    arcname = os.path.basename(path)
+                if st is None:
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        # Let the build walk it and fail on broken symlinks
+                        entries = None
+                        break
+                digest = self._digests.get(os.path.normpath(path))
+                # Sizes of directories depend on filesystems
+                size = 0 if stat.S_ISDIR(st.st_mode) else st.st_size
+                entries.append(
+                    [arcname, size, st.st_mode, digest.hex() if digest else None]
+                )
+                source_mtimes[arcname] = st.st_mtime_ns
+            if entries is None:
+                continue
+            dirs = manifest_dirs(entries) if isdir else []
+            for path in dirs:
+                if path not in source_mtimes:
+                    source_mtimes[path] = os.stat(
+                        os.path.join(source_path, path)
+                    ).st_mtime_ns
+            manifest[position] = {"files": entries, "dirs": dirs}
+            mtimes[position] = source_mtimes
+        return manifest, mtimes
+
     def plan(self, source_path, query, log=None):
         claims = source_path
         if not isinstance(source_path, list):
@@ -734,7 +2973,16 @@ class BuildPlanManager:
             build_step.append(x)
 
         def hash(path, patterns=None, prefix=None):
-            source_paths.append((path, patterns, prefix))
+            if follow_symlinks:
+                source_paths.append((path, patterns, prefix))
+            else:
+                source_paths.append((path, patterns, prefix, False))
+
+        def zip_step(path, patterns=None, prefix=None):
+            position = "{}.{}".format(len(build_plan), len(build_step))
+            self._zip_sources[position] = len(source_paths)
+            step("zip", path, prefix)
+            hash(path, patterns, prefix)
 
         def pip_requirements_step(path, prefix=None, required=False, tmp_dir=None):
             command = runtime
@@ -878,6 +3126,7 @@ class BuildPlanManager:
                 batch.clear()
 
         for claim in claims:
+            follow_symlinks = True
             if isinstance(claim, str):
                 path = os.path.normpath(claim)
                 if not os.path.exists(path):
@@ -900,8 +3149,7 @@ class BuildPlanManager:
                         poetry_install_step(path)
                 elif runtime.startswith("nodejs"):
                     npm_requirements_step(os.path.join(path, "package.json"))
-                step("zip", path, None)
-                hash(path)
+                zip_step(path)
 
             elif isinstance(claim, dict):
                 path = claim.get("path")
@@ -909,6 +3157,27 @@ class BuildPlanManager:
                     path = os.path.normpath(path)
                 patterns = claim.get("patterns")
                 commands = claim.get("commands")
+                if claim.get("symlinks"):
+                    follow_symlinks = False
+                    step("set:symlinks", True)
+                compression = claim.get("compression")
+                if compression:
+                    # Fail early on invalid options
+                    CompressionPolicy.from_config(compression)
+                    step("set:compression", compression)
+                prune = claim.get("prune")
+                if prune:
+                    DependencyPruner.from_config(prune)
+                    step("set:prune", prune)
+                bytecode = claim.get("bytecode")
+                if bytecode:
+                    bytecode_optimization_levels(bytecode)
+                    step("set:bytecode", bytecode)
+                installer = claim.get("installer")
+                if installer:
+                    if installer not in INSTALLER_BACKENDS:
+                        raise ValueError("Unsupported installer: {}".format(installer))
+                    step("set:installer", installer)
                 if patterns:
                     step("set:filter", patterns_list(self._args, patterns))
                 if commands:
@@ -977,8 +3246,7 @@ class BuildPlanManager:
                                 tmp_dir=claim.get("npm_tmp_dir"),
                             )
                     if path:
-                        step("zip", path, prefix)
-                        hash(path, patterns, prefix)
+                        zip_step(path, patterns, prefix)
             else:
                 raise ValueError("Unsupported source_path item: {}".format(claim))
 
@@ -989,18 +3257,41 @@ class BuildPlanManager:
         if log.isEnabledFor(DEBUG3):
             log.debug("source_paths: %s", json.dumps(source_paths, indent=2))
 
-        for p, patterns, prefix in source_paths:
+        for p, patterns, prefix, *follow in source_paths:
             if self._source_paths is None:
                 self._source_paths = []
             pf = None
             if patterns is not None:
                 pf = ZipContentFilter(args=self._args)
                 pf.compile(patterns)
-            self._source_paths.append((p, pf, prefix))
+            self._source_paths.append((p, pf, prefix, *follow))
 
         return build_plan
 
-    def execute(self, build_plan, zip_stream, query):
+    def execute(
+        self,
+        build_plan,
+        zip_stream,
+        query,
+        install_workers=None,
+        dep_cache=None,
+        manifest_mtimes=None,
+    ):
+        backends = self._installer_backends(
+            build_plan, query.installer if query else None
+        )
+        installs = InstallPipeline(
+            lambda i, action: self._install(
+                query, action, dep_cache=dep_cache, backend=backends[i]
+            ),
+            workers=install_workers,
+        )
+        try:
+            self._execute(build_plan, zip_stream, query, installs, manifest_mtimes)
+        finally:
+            installs.close()
+
+    def _execute(self, build_plan, zip_stream, query, installs, manifest_mtimes=None):
         sh_log = logging.getLogger("sh")
 
         tf_work_dir = os.getcwd()
@@ -1008,20 +3299,41 @@ class BuildPlanManager:
         zs = zip_stream
         sh_work_dir = None
         pf = None
+        cp = None
+        follow_symlinks = True
+        prune = None
+        bytecode = None
 
-        for step in build_plan:
+        manifest = query.manifest if query else None
+        if manifest:
+            manifest = self._check_manifest(build_plan, manifest, manifest_mtimes)
+
+        for i, step in enumerate(build_plan):
             # init step
             sh_work_dir = tf_work_dir
             if pf:
                 pf.reset()
                 pf = None
+            if cp:
+                zs.set_compression_policy(None)
+                cp = None
+            follow_symlinks = True
+            prune = None
+            bytecode = None
+            if zs:
+                zs.set_size_claim(self._claim_name(i, step))
+            installs.prefetch(build_plan, i)
 
             log.debug("STEPDIR: %s", sh_work_dir)
 
             # execute step actions
-            for action in step:
+            for j, action in enumerate(step):
                 cmd = action[0]
-                if cmd.startswith("zip"):
+                listed = manifest.get("{}.{}".format(i, j)) if manifest else None
+                if listed is not None:
+                    source_path, prefix = action[1:]
+                    zs.write_manifest(source_path, listed, prefix=prefix)
+                elif cmd.startswith("zip"):
                     ts = 0 if cmd == "zip:embedded" else None
 
                     source_path, prefix = None, None
@@ -1041,68 +3353,76 @@ class BuildPlanManager:
                     if os.path.isdir(source_path):
                         if pf:
                             self._zip_write_with_filter(
-                                zs, pf, source_path, prefix, timestamp=ts
+                                zs,
+                                pf,
+                                source_path,
+                                prefix,
+                                timestamp=ts,
+                                follow_symlinks=follow_symlinks,
                             )
                         else:
-                            zs.write_dirs(source_path, prefix=prefix, timestamp=ts)
+                            zs.write_dirs(
+                                source_path,
+                                prefix=prefix,
+                                timestamp=ts,
+                                follow_symlinks=follow_symlinks,
+                            )
                     else:
                         zs.write_file(source_path, prefix=prefix, timestamp=ts)
                 elif cmd == "pip":
                     runtime, pip_requirements, prefix, tmp_dir = action[1:]
-                    with install_pip_requirements(
-                        query, pip_requirements, tmp_dir
-                    ) as rd:
-                        if rd:
-                            if pf:
-                                self._zip_write_with_filter(
-                                    zs, pf, rd, prefix, timestamp=0
-                                )
-                            else:
-                                # XXX: timestamp=0 - what actually do with it?
-                                zs.write_dirs(rd, prefix=prefix, timestamp=0)
+                    self._zip_install(
+                        zs,
+                        installs.install(i, j, action),
+                        query,
+                        runtime,
+                        prefix,
+                        pf,
+                        follow_symlinks,
+                        prune=prune,
+                        bytecode=bytecode,
+                    )
                 elif cmd == "poetry":
                     (runtime, path, poetry_export_extra_args, prefix, tmp_dir) = action[
                         1:
                     ]
                     log.info("poetry_export_extra_args: %s", poetry_export_extra_args)
-                    with install_poetry_dependencies(
-                        query, path, poetry_export_extra_args, tmp_dir
-                    ) as rd:
-                        if rd:
-                            if pf:
-                                self._zip_write_with_filter(
-                                    zs, pf, rd, prefix, timestamp=0
-                                )
-                            else:
-                                # XXX: timestamp=0 - what actually do with it?
-                                zs.write_dirs(rd, prefix=prefix, timestamp=0)
+                    self._zip_install(
+                        zs,
+                        installs.install(i, j, action),
+                        query,
+                        runtime,
+                        prefix,
+                        pf,
+                        follow_symlinks,
+                        prune=prune,
+                        bytecode=bytecode,
+                    )
                 elif cmd == "uv":
                     (runtime, path, uv_export_extra_args, prefix, tmp_dir) = action[1:]
                     log.info("uv_export_extra_args: %s", uv_export_extra_args)
-                    with install_uv_dependencies(
-                        query, path, uv_export_extra_args, tmp_dir
-                    ) as rd:
-                        if rd:
-                            if pf:
-                                self._zip_write_with_filter(
-                                    zs, pf, rd, prefix, timestamp=0
-                                )
-                            else:
-                                zs.write_dirs(rd, prefix=prefix, timestamp=0)
-
+                    self._zip_install(
+                        zs,
+                        installs.install(i, j, action),
+                        query,
+                        runtime,
+                        prefix,
+                        pf,
+                        follow_symlinks,
+                        prune=prune,
+                        bytecode=bytecode,
+                    )
                 elif cmd == "npm":
                     runtime, npm_requirements, prefix, tmp_dir = action[1:]
-                    with install_npm_requirements(
-                        query, npm_requirements, tmp_dir
-                    ) as rd:
-                        if rd:
-                            if pf:
-                                self._zip_write_with_filter(
-                                    zs, pf, rd, prefix, timestamp=0
-                                )
-                            else:
-                                # XXX: timestamp=0 - what actually do with it?
-                                zs.write_dirs(rd, prefix=prefix, timestamp=0)
+                    self._zip_install(
+                        zs,
+                        installs.install(i, j, action),
+                        query,
+                        runtime,
+                        prefix,
+                        pf,
+                        follow_symlinks,
+                    )
                 elif cmd == "sh":
                     with tempfile.NamedTemporaryFile(
                         mode="w+t", delete=True
@@ -1160,23 +3480,679 @@ class BuildPlanManager:
                     pf = ZipContentFilter(args=self._args)
                     pf.compile(patterns)
 
+                elif cmd == "set:symlinks":
+                    follow_symlinks = not action[1]
+
+                elif cmd == "set:compression":
+                    cp = CompressionPolicy.from_config(action[1])
+                    zs.set_compression_policy(cp)
+
+                elif cmd == "set:prune":
+                    prune = action[1]
+
+                elif cmd == "set:bytecode":
+                    bytecode = action[1]
+
+                elif cmd == "set:installer":
+                    # Applied to installs of the step, which can start ahead
+                    pass
+
+    def _zip_install(
+        self,
+        zs,
+        install,
+        query,
+        runtime,
+        prefix,
+        pf,
+        follow_symlinks,
+        prune=None,
+        bytecode=None,
+    ):
+        """
+        Zips a directory made by an install context manager, pruned and
+        compiled to bytecode first if the step sets it up.
+        """
+        with install as rd:
+            if not rd:
+                return
+            if prune:
+                DependencyPruner.from_config(prune).prune(query, rd, runtime)
+            if bytecode:
+                compile_bytecode(query, rd, runtime, bytecode, prefix)
+            if pf:
+                self._zip_write_with_filter(
+                    zs,
+                    pf,
+                    rd,
+                    prefix,
+                    timestamp=0,
+                    follow_symlinks=follow_symlinks,
+                )
+            else:
+                # XXX: timestamp=0 - what actually do with it?
+                zs.write_dirs(
+                    rd,
+                    prefix=prefix,
+                    timestamp=0,
+                    follow_symlinks=follow_symlinks,
+                )
+
+    def _check_manifest(self, build_plan, manifest, mtimes=None):
+        """
+        Checks all files and directories of a manifest before anything is
+        built, so a build fails early if sources have been changed or new
+        files have been added since the build plan was prepared.
+
+        Known mtimes let unchanged files and directories be checked by
+        their stat results only. Otherwise contents of files are compared
+        with their digests, and a source is walked again with its filter
+        to find new files. Returns checked (path, arcname, stat result)
+        of files by positions of their zip actions.
+        """
+        mtimes = mtimes or {}
+        checked = {}
+        for i, step in enumerate(build_plan):
+            pf = None
+            follow_symlinks = True
+            for j, action in enumerate(step):
+                cmd = action[0]
+                position = "{}.{}".format(i, j)
+                if cmd == "set:filter":
+                    pf = ZipContentFilter(args=self._args)
+                    pf.compile(action[1])
+                elif cmd == "set:symlinks":
+                    follow_symlinks = not action[1]
+                elif position in manifest:
+                    source_path, prefix = action[1:]
+                    listed = manifest[position]
+                    known = mtimes.get(position) or {}
+                    walked = None
+                    for path in listed["dirs"]:
+                        try:
+                            mtime_ns = os.stat(
+                                os.path.join(source_path, path)
+                            ).st_mtime_ns
+                        except FileNotFoundError:
+                            mtime_ns = None
+                        if mtime_ns is None or mtime_ns != known.get(path):
+                            walked = self._walk_manifest_source(
+                                source_path, listed, pf, prefix, follow_symlinks
+                            )
+                            break
+                    checked[position] = manifest_stats(
+                        source_path, listed["files"], known, walked
+                    )
+        return checked
+
+    @staticmethod
+    def _walk_manifest_source(source_path, listed, pf, prefix, follow_symlinks):
+        """
+        Walks a source directory of a manifest the same way as its zip
+        action does and fails on files which aren't listed. Files skipped
+        by the filter of the source, like __pycache__, are ignored.
+        Returns a mapping of arcnames to (path, stat result).
+        """
+        if pf:
+            paths = pf.filter_entries(source_path, prefix, follow_symlinks)
+        else:
+            paths = emit_dir_entries(source_path, follow_symlinks)
+        arcnames = {entry[0] for entry in listed["files"]}
+        walked = {}
+        for path, st in paths:
+            arcname = os.path.relpath(path, source_path)
+            if arcname not in arcnames:
+                raise RuntimeError(
+                    "File has been added since the build plan was prepared: {}".format(
+                        path
+                    )
+                )
+            walked[arcname] = (path, st)
+        return walked
+
+    @staticmethod
+    def _installer_backends(build_plan, default=None):
+        """Returns installer backends of pip and poetry installs of each step."""
+        backends = []
+        for step in build_plan:
+            backend = default or "pip"
+            for action in step:
+                if action[0] == "set:installer":
+                    backend = action[1]
+            backends.append(backend)
+        return backends
+
+    @staticmethod
+    def _install(query, action, dep_cache=None, backend="pip"):
+        """Returns a context manager installing dependencies of an action."""
+        installer = functools.partial(
+            BuildPlanManager._installer, query, action, backend
+        )
+        key = dep_cache.key(query, action, backend) if dep_cache else None
+        if key:
+            return dep_cache.install(key, installer, action[-1])
+        return installer()
+
+    @staticmethod
+    def _installer(query, action, backend="pip"):
+        cmd = action[0]
+        if cmd == "pip":
+            runtime, pip_requirements, prefix, tmp_dir = action[1:]
+            return install_pip_requirements(
+                query, pip_requirements, tmp_dir, installer=backend
+            )
+        if cmd == "poetry":
+            runtime, path, poetry_export_extra_args, prefix, tmp_dir = action[1:]
+            return install_poetry_dependencies(
+                query, path, poetry_export_extra_args, tmp_dir, installer=backend
+            )
+        if cmd == "uv":
+            runtime, path, uv_export_extra_args, prefix, tmp_dir = action[1:]
+            return install_uv_dependencies(query, path, uv_export_extra_args, tmp_dir)
+        if cmd == "npm":
+            runtime, npm_requirements, prefix, tmp_dir = action[1:]
+            return install_npm_requirements(query, npm_requirements, tmp_dir)
+        raise ValueError("Unsupported install action: {}".format(cmd))
+
+    @staticmethod
+    def _claim_name(index, step):
+        """Names a build plan step by its first packaging action."""
+        for action in step:
+            cmd = action[0]
+            if cmd.startswith("zip"):
+                return "{}: {} {}".format(
+                    index, cmd, action[1] if len(action) > 1 else "."
+                )
+            if cmd in ("pip", "poetry", "uv", "npm"):
+                return "{}: {} {}".format(index, cmd, action[2])
+        return str(index)
+
     @staticmethod
     def _zip_write_with_filter(
-        zip_stream, path_filter, source_path, prefix, timestamp=None
+        zip_stream,
+        path_filter,
+        source_path,
+        prefix,
+        timestamp=None,
+        follow_symlinks=True,
     ):
-        for path in path_filter.filter(source_path, prefix):
-            if os.path.isdir(source_path):
+        isdir = os.path.isdir(source_path)
+        for path, st in path_filter.filter_entries(
+            source_path, prefix, follow_symlinks
+        ):
+            if isdir:
                 arcname = os.path.relpath(path, source_path)
             else:
                 arcname = os.path.basename(path)
-            zip_stream.write_file(path, prefix, arcname, timestamp=timestamp)
+            zip_stream.write_file(path, prefix, arcname, timestamp=timestamp, st=st)
 
 
-@contextmanager
-def install_pip_requirements(query, requirements_file, tmp_dir):
-    # TODO:
-    #  1. Emit files instead of temp_dir
+class DependencyCache:
+    """
+    Cache of installed dependency trees shared by builds.
+
+    Entries are keyed by contents of requirements and lock files, the
+    installer with its extra arguments, the runtime, the architecture and
+    the docker image. On a hit, the installer isn't run and a tree is made
+    of hardlinks (or reflinks, or copies) to the cached files. Least
+    recently used entries are evicted above a size budget.
+    """
+
+    cache_dir = "deps"
+    # Changes when installs of the same inputs produce different trees
+    version = 2
+
+    def __init__(self, directory, max_bytes, log=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._log = log or logging.getLogger("deps")
+
+    @classmethod
+    def for_artifacts_dir(cls, artifacts_dir, max_bytes, log=None):
+        return cls(os.path.join(artifacts_dir, "cache", cls.cache_dir), max_bytes, log)
+
+    @staticmethod
+    def _input_files(action):
+        """
+        Returns files an install depends on, or None if it depends on
+        something else too, like local packages or other requirement files.
+        """
+        cmd = action[0]
+        if cmd in ("pip", "npm"):
+            requirements = action[2]
+            files = [requirements]
+            if cmd == "npm":
+                files.append(
+                    os.path.join(os.path.dirname(requirements), "package-lock.json")
+                )
+            else:
+                with open(requirements) as f:
+                    for line in f:
+                        line = line.strip()
+                        if line.startswith(("-", ".", "/", "file:")) or (
+                            "file:" in line
+                        ):
+                            return None
+            return files
+        path = action[2]
+        project_dir = path if os.path.isdir(path) else os.path.dirname(path)
+        if cmd == "poetry":
+            names = ("pyproject.toml", "poetry.lock", "poetry.toml")
+            lock_file, local_sources = (
+                "poetry.lock",
+                ('type = "directory"', 'type = "file"'),
+            )
+        else:
+            names = ("pyproject.toml", "uv.lock")
+            lock_file, local_sources = "uv.lock", ("{ path =", "{ directory =")
+        lock_path = os.path.join(project_dir, lock_file)
+        if not os.path.isfile(lock_path):
+            # Dependencies would be resolved on every install
+            return None
+        with open(lock_path) as f:
+            lock = f.read()
+        if any(source in lock for source in local_sources) or (
+            cmd == "uv" and '{ editable = "' in lock.replace('{ editable = "." }', "")
+        ):
+            return None
+        return [os.path.join(project_dir, name) for name in names]
+
+    @staticmethod
+    def _docker_image(query, runtime):
+        docker = query.docker
+        if not docker:
+            return None
+        image = docker.docker_image or "public.ecr.aws/sam/build-{}".format(runtime)
+        try:
+            image_id = check_output(docker_image_id_command(image)).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            image_id = None
+        return [image, image_id, docker.docker_additional_options]
+
+    def key(self, query, action, backend="pip"):
+        """Returns a key of an install action, or None if it can't be cached."""
+        try:
+            files = self._input_files(action)
+            if files is None:
+                return None
+            digests = []
+            for path in files:
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        digests.append(file_source_code_hash(f))
+                else:
+                    digests.append(None)
+        except OSError:
+            return None
+        cmd, runtime = action[:2]
+        extra_args = action[3] if cmd in ("poetry", "uv") else None
+        data = [
+            self.version,
+            cmd,
+            backend if cmd in ("pip", "poetry") else None,
+            extra_args,
+            runtime,
+            # Lambda functions without architectures run on x86_64
+            query.architecture or "x86_64",
+            platform.system(),
+            platform.machine(),
+            self._docker_image(query, runtime),
+            digests,
+        ]
+        return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    @contextmanager
+    def install(self, key, installer, tmp_dir=None):
+        """Yields an installed tree, from the cache or made by an installer."""
+        path = self._path(key)
+        if os.path.isdir(path):
+            with tempdir(tmp_dir) as temp_dir:
+                try:
+                    link_tree(path, temp_dir)
+                    os.utime(path + ".json")  # Mark as recently used
+                except OSError as e:
+                    self._log.warning(
+                        "ignoring broken dependency cache %s: %s", path, e
+                    )
+                else:
+                    with self._lock:
+                        self.hits += 1
+                    self._log.info("Reused installed dependencies: %s", path)
+                    yield temp_dir
+                    return
+        with self._lock:
+            self.misses += 1
+        with installer() as rd:
+            if rd:
+                self.put(key, rd)
+            yield rd
+
+    def put(self, key, source_dir):
+        path = self._path(key)
+        tmp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Unique across threads and builds sharing the cache
+            tmp_path = tempfile.mkdtemp(
+                dir=self.directory, prefix=key + ".", suffix=".tmp"
+            )
+            size = link_tree(source_dir, tmp_path)
+            with open(tmp_path + ".json", "w") as f:
+                json.dump({"size": size}, f)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Stored by a concurrent build
+                shutil.rmtree(tmp_path)
+                os.unlink(tmp_path + ".json")
+            else:
+                os.replace(tmp_path + ".json", path + ".json")
+        except OSError as e:
+            self._log.warning("can't store dependency cache %s: %s", path, e)
+            if tmp_path:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                try:
+                    os.unlink(tmp_path + ".json")
+                except OSError:
+                    pass
+
+    def evict(self):
+        """Removes least recently used entries above the size budget."""
+        entries = []
+        total = 0
+        try:
+            metas = [e for e in os.scandir(self.directory) if e.name.endswith(".json")]
+        except FileNotFoundError:
+            return
+        for meta in metas:
+            try:
+                with open(meta.path) as f:
+                    size = json.load(f)["size"]
+                mtime_ns = meta.stat().st_mtime_ns
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((mtime_ns, size, meta.path[: -len(".json")]))
+            total += size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.unlink(path + ".json")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        self._log.debug("dependency cache: evicted %d entries", removed)
+
+
+def link_tree(source_dir, target_dir):
+    """
+    Makes a copy of a directory tree of hardlinks, or reflinks or copies
+    of files when they can't be linked. Returns a size of the files.
+    """
+    size = 0
+    os.makedirs(target_dir, exist_ok=True)
+    for root, dirs, files in os.walk(source_dir):
+        target_root = os.path.join(target_dir, os.path.relpath(root, source_dir))
+        for name in dirs:
+            src = os.path.join(root, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), os.path.join(target_root, name))
+            else:
+                os.mkdir(os.path.join(target_root, name))
+                shutil.copymode(src, os.path.join(target_root, name))
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(target_root, name)
+            st = os.lstat(src)
+            if stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(src), dst)
+                continue
+            size += st.st_size
+            try:
+                os.link(src, dst)
+            except OSError:
+                copy_file(src, dst)
+    return size
+
+
+def copy_file(src, dst):
+    """Copies a file with a reflink if a filesystem supports it."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            import fcntl
+
+            fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())  # FICLONE
+        except (ImportError, OSError):
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
+class InstallPipeline:
+    """
+    Runs dependency installs of a build plan ahead in a bounded pool of
+    workers, so they overlap with zipping of earlier steps. Installed
+    directories are still zipped one by one in the order of the build plan,
+    so the archive is the same as a sequentially built one.
+    """
 
+    actions = ("pip", "poetry", "uv", "npm")
+
+    def __init__(self, installer, workers=None):
+        self._installer = installer
+        self._executor = None
+        if workers and workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = {}
+
+    def prefetch(self, build_plan, start):
+        """
+        Submits installs of the steps from the start one up to the first
+        shell command, which can prepare files used by later installs.
+        """
+        if not self._executor:
+            return
+        for i in range(start, len(build_plan)):
+            for j, action in enumerate(build_plan[i]):
+                if action[0] == "sh":
+                    return
+                if action[0] in self.actions and (i, j) not in self._futures:
+                    self._futures[(i, j)] = self._executor.submit(
+                        self._enter, i, action
+                    )
+
+    def _enter(self, i, action):
+        cm = self._installer(i, action)
+        return cm, cm.__enter__()
+
+    @contextmanager
+    def install(self, i, j, action):
+        """Returns a directory installed by an action of a build plan."""
+        future = self._futures.get((i, j))
+        if future is None:
+            with self._installer(i, action) as rd:
+                yield rd
+            return
+        # Keep the future, so it's cleaned up on close if this one fails
+        cm, rd = future.result()
+        del self._futures[(i, j)]
+        with ExitStack() as stack:
+            stack.push(cm)
+            yield rd
+
+    def close(self):
+        """Waits for the installs in progress and removes unused directories."""
+        if not self._executor:
+            return
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown()
+        self._executor = None
+        for future in self._futures.values():
+            if not future.cancelled() and future.exception() is None:
+                cm, _ = future.result()
+                cm.__exit__(None, None, None)
+        self._futures.clear()
+
+
+INSTALLER_BACKENDS = ("pip", "uv")
+
+
+def installer_backend(backend, docker=None):
+    """Returns an installer backend available in a build environment."""
+    if backend == "uv" and not docker:
+        if not shutil.which("uv"):
+            log.warning("uv is not available in PATH, installing with pip")
+            return "pip"
+    return backend or "pip"
+
+
+def uv_python_platform(runtime, architecture=None):
+    """
+    Returns a uv target platform of a Lambda python runtime. Runtimes from
+    python3.12 run on Amazon Linux 2023 with glibc 2.34, and older ones on
+    Amazon Linux 2 with glibc 2.26, so manylinux2014 wheels are used there.
+    """
+    machine = (architecture or platform.machine()).lower()
+    machine = {"arm64": "aarch64", "amd64": "x86_64"}.get(machine, machine)
+    version = tuple(int(v) for v in runtime[len("python") :].split("."))
+    glibc = "2_34" if version >= (3, 12) else "2_17"
+    return "{}-manylinux_{}".format(machine, glibc)
+
+
+def pip_install_command(
+    backend,
+    runtime,
+    requirements_filename,
+    python_exec=None,
+    architecture=None,
+    no_deps=False,
+):
+    """
+    Returns a command installing requirements into the current directory
+    with pip or with uv, which picks wheels of the Lambda runtime platform.
+    """
+    options = ["--no-compile"]
+    if no_deps:
+        options.append("--no-deps")
+    if backend == "uv":
+        return (
+            ["uv", "pip", "install"]
+            + options
+            + [
+                "--python={}".format(python_exec or runtime),
+                "--python-version={}".format(runtime[len("python") :]),
+                "--python-platform={}".format(
+                    uv_python_platform(runtime, architecture)
+                ),
+                "--target=.",
+                "--requirement={}".format(requirements_filename),
+            ]
+        )
+    return (
+        [python_exec or runtime, "-m", "pip", "install"]
+        + options
+        + [
+            "--prefix=",
+            "--target=.",
+            "--requirement={}".format(requirements_filename),
+        ]
+    )
+
+
+def pip_install_shell(backend, runtime, requirements_filename, **kwargs):
+    """
+    Returns a shell command of pip_install_command for docker images,
+    which falls back to pip when uv isn't installed in an image.
+    """
+    pip_command = shlex_join(
+        pip_install_command("pip", runtime, requirements_filename, **kwargs)
+    )
+    if backend != "uv":
+        return pip_command
+    uv_command = shlex_join(
+        pip_install_command("uv", runtime, requirements_filename, **kwargs)
+    )
+    return "if command -v uv >/dev/null 2>&1; then {}; else {}; fi".format(
+        uv_command, pip_command
+    )
+
+
+def uv_cache_dir():
+    """Returns a directory of the uv cache of host builds."""
+    if os.environ.get("UV_CACHE_DIR"):
+        return os.environ["UV_CACHE_DIR"]
+    if WINDOWS:
+        return os.path.join(os.environ.get("LOCALAPPDATA", ""), "uv", "cache")
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "uv")
+
+
+def uv_link_mode(cache_dir, target_dir):
+    """
+    Returns a uv link mode of files from a cache into a target directory:
+    hardlinks (clones on macOS) within one filesystem and copies across
+    filesystems, where uv would try and fail to link every file first.
+    """
+    try:
+        same_fs = os.stat(cache_dir).st_dev == os.stat(target_dir).st_dev
+    except OSError:
+        return None
+    if not same_fs:
+        return "copy"
+    return "clone" if OSX else "hardlink"
+
+
+def uv_env(target_dir, env=None):
+    """Returns an environment of host uv commands installing into a directory."""
+    if os.environ.get("UV_LINK_MODE"):
+        return env
+    link_mode = uv_link_mode(uv_cache_dir(), target_dir)
+    if not link_mode:
+        return env
+    env = dict(env or os.environ)
+    env["UV_LINK_MODE"] = link_mode
+    return env
+
+
+def docker_uv_cache_dir(docker, artifacts_dir):
+    """Returns a host directory of the uv cache mounted into docker builds."""
+    uv_cache = docker.docker_uv_cache
+    if not uv_cache:
+        return None
+    if isinstance(uv_cache, str):
+        return os.path.abspath(uv_cache)
+    return os.path.abspath(os.path.join(artifacts_dir, "cache/uv"))
+
+
+DEFAULT_ARTIFACTS_DIR = "builds"
+
+
+def wheelhouse_dir(wheelhouse, artifacts_dir=DEFAULT_ARTIFACTS_DIR):
+    """
+    Returns a wheelhouse directory of a TF_LAMBDA_PACKAGE_WHEELHOUSE value,
+    which is either a boolean or a path. Both the prepare and the wheelhouse
+    commands resolve it, so wheels are built where builds look for them.
+    """
+    if not wheelhouse:
+        return None
+    if wheelhouse.lower() in ("false", "no", "n", "0"):
+        return None
+    if wheelhouse.lower() in ("true", "yes", "y", "1"):
+        wheelhouse = os.path.join(artifacts_dir, "wheelhouse")
+    return os.path.abspath(wheelhouse)
+
+
+@contextmanager
+def install_pip_requirements(query, requirements_file, tmp_dir, installer="pip"):
     if not os.path.exists(requirements_file):
         yield
         return
@@ -1185,8 +4161,20 @@ def install_pip_requirements(query, requirements_file, tmp_dir):
     artifacts_dir = query.artifacts_dir
     docker = query.docker
     temp_dir = query.temp_dir
+    wheelhouse = query.wheelhouse
+    backend = installer_backend(installer, docker)
     docker_image_tag_id = None
 
+    if wheelhouse and docker:
+        log.warning("Wheelhouse is only used by builds outside of docker")
+        wheelhouse = None
+    if wheelhouse and not os.path.isdir(wheelhouse):
+        raise RuntimeError(
+            "Wheelhouse {} doesn't exist, build it with the wheelhouse command".format(
+                wheelhouse
+            )
+        )
+
     if docker:
         docker_file = docker.docker_file
         docker_image = docker.docker_image
@@ -1218,7 +4206,7 @@ def install_pip_requirements(query, requirements_file, tmp_dir):
 
     working_dir = os.getcwd()
 
-    log.info("Installing python requirements: %s", requirements_file)
+    log.info("Installing python requirements with %s: %s", backend, requirements_file)
     with tempdir(tmp_dir) as temp_dir:
         requirements_filename = os.path.basename(requirements_file)
         target_file = os.path.join(temp_dir, requirements_filename)
@@ -1240,112 +4228,130 @@ def install_pip_requirements(query, requirements_file, tmp_dir):
                 subproc_env["PATH"] = os_path
 
         # Install dependencies into the temporary directory.
-        with cd(temp_dir):
-            pip_command = [
-                python_exec,
-                "-m",
-                "pip",
-                "install",
-                "--no-compile",
-                "--prefix=",
-                "--target=.",
-                "--requirement={}".format(requirements_filename),
-            ]
-            if docker:
-                with_ssh_agent = docker.with_ssh_agent
-                pip_cache_dir = docker.docker_pip_cache
-                if pip_cache_dir:
-                    if isinstance(pip_cache_dir, str):
-                        pip_cache_dir = os.path.abspath(
-                            os.path.join(working_dir, pip_cache_dir)
-                        )
-                    else:
-                        pip_cache_dir = os.path.abspath(
-                            os.path.join(working_dir, artifacts_dir, "cache/pip")
-                        )
-
-                chown_mask = "{}:{}".format(os.getuid(), os.getgid())
-                shell_command = [
-                    shlex_join(pip_command),
-                    "&&",
-                    shlex_join(["chown", "-R", chown_mask, "."]),
-                ]
-                shell_command = [" ".join(shell_command)]
-                check_call(
-                    docker_run_command(
-                        ".",
-                        shell_command,
-                        runtime,
-                        image=docker_image_tag_id,
-                        shell=True,
-                        ssh_agent=with_ssh_agent,
-                        pip_cache_dir=pip_cache_dir,
-                        docker=docker,
+        pip_command = pip_install_command(
+            backend,
+            runtime,
+            requirements_filename,
+            python_exec=python_exec,
+            architecture=query.architecture,
+        )
+        if wheelhouse:
+            # Offline and only from wheels built by the wheelhouse command
+            pip_command.extend(["--no-index", "--find-links={}".format(wheelhouse)])
+        if backend == "uv" and not docker:
+            subproc_env = uv_env(temp_dir, subproc_env)
+        started = time.monotonic()
+        if docker:
+            with_ssh_agent = docker.with_ssh_agent
+            pip_cache_dir = docker.docker_pip_cache
+            if pip_cache_dir:
+                if isinstance(pip_cache_dir, str):
+                    pip_cache_dir = os.path.abspath(
+                        os.path.join(working_dir, pip_cache_dir)
+                    )
+                else:
+                    pip_cache_dir = os.path.abspath(
+                        os.path.join(working_dir, artifacts_dir, "cache/pip")
                     )
+
+            chown_mask = "{}:{}".format(os.getuid(), os.getgid())
+            shell_command = [
+                pip_install_shell(
+                    backend,
+                    runtime,
+                    requirements_filename,
+                    architecture=query.architecture,
+                ),
+                "&&",
+                shlex_join(["chown", "-R", chown_mask, "."]),
+            ]
+            shell_command = [" ".join(shell_command)]
+            check_call(
+                docker_run_command(
+                    temp_dir,
+                    shell_command,
+                    runtime,
+                    image=docker_image_tag_id,
+                    shell=True,
+                    ssh_agent=with_ssh_agent,
+                    pip_cache_dir=pip_cache_dir,
+                    uv_cache_dir=(
+                        docker_uv_cache_dir(docker, artifacts_dir)
+                        if backend == "uv"
+                        else None
+                    ),
+                    docker=docker,
                 )
-            else:
-                cmd_log.info(shlex_join(pip_command))
-                log_handler and log_handler.flush()
-                try:
-                    if query.quiet:
-                        # quiet: swallow both streams, exit code only.
-                        # On failure, the raised CalledProcessError will
-                        # carry no stderr — the operator wanted quiet.
-                        check_call(
-                            pip_command,
-                            env=subproc_env,
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                        )
-                    else:
-                        # Non-quiet: stream pip output to the console as
-                        # before AND capture stderr separately. Capturing
-                        # via `subprocess.run(..., stderr=PIPE)` would
-                        # mean pip's stderr no longer streams in real
-                        # time, which hurts UX for long-running installs.
-                        # Tee instead: a thread reads pip's stderr line
-                        # by line, writes to sys.stderr (real-time) AND
-                        # accumulates into a buffer for the CalledProcessError.
-                        process = subprocess.Popen(
+            )
+        else:
+            cmd_log.info(shlex_join(pip_command))
+            log_handler and log_handler.flush()
+            try:
+                if query.quiet:
+                    # quiet: swallow both streams, exit code only.
+                    # On failure, the raised CalledProcessError will
+                    # carry no stderr — the operator wanted quiet.
+                    check_call(
+                        pip_command,
+                        env=subproc_env,
+                        cwd=temp_dir,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+                else:
+                    # Non-quiet: stream pip output to the console as
+                    # before AND capture stderr separately. Capturing
+                    # via `subprocess.run(..., stderr=PIPE)` would
+                    # mean pip's stderr no longer streams in real
+                    # time, which hurts UX for long-running installs.
+                    # Tee instead: a thread reads pip's stderr line
+                    # by line, writes to sys.stderr (real-time) AND
+                    # accumulates into a buffer for the CalledProcessError.
+                    process = subprocess.Popen(
+                        pip_command,
+                        env=subproc_env,
+                        cwd=temp_dir,
+                        stderr=subprocess.PIPE,
+                        text=False,
+                    )
+                    stderr_buf = bytearray()
+
+                    def _tee():
+                        for chunk in iter(lambda: process.stderr.read(4096), b""):
+                            sys.stderr.buffer.write(chunk)
+                            sys.stderr.flush()
+                            stderr_buf.extend(chunk)
+
+                    tee_thread = threading.Thread(target=_tee, daemon=True)
+                    tee_thread.start()
+                    rc = process.wait()
+                    tee_thread.join()
+                    if rc != 0:
+                        raise subprocess.CalledProcessError(
+                            rc,
                             pip_command,
-                            env=subproc_env,
-                            stderr=subprocess.PIPE,
-                            text=False,
+                            stderr=bytes(stderr_buf),
                         )
-                        stderr_buf = bytearray()
-
-                        def _tee():
-                            for chunk in iter(lambda: process.stderr.read(4096), b""):
-                                sys.stderr.buffer.write(chunk)
-                                sys.stderr.flush()
-                                stderr_buf.extend(chunk)
-
-                        tee_thread = threading.Thread(target=_tee, daemon=True)
-                        tee_thread.start()
-                        rc = process.wait()
-                        tee_thread.join()
-                        if rc != 0:
-                            raise subprocess.CalledProcessError(
-                                rc,
-                                pip_command,
-                                stderr=bytes(stderr_buf),
-                            )
-                except FileNotFoundError as e:
-                    raise RuntimeError(
-                        "Python interpreter version equal "
-                        "to defined lambda runtime ({}) should be "
-                        "available in system PATH".format(runtime)
-                    ) from e
+            except FileNotFoundError as e:
+                raise RuntimeError(
+                    "Python interpreter version equal "
+                    "to defined lambda runtime ({}) should be "
+                    "available in system PATH".format(runtime)
+                ) from e
 
-            os.remove(target_file)
-            yield temp_dir
+        log.info(
+            "Installed python requirements with %s in %.1fs",
+            backend,
+            time.monotonic() - started,
+        )
+        os.remove(target_file)
+        yield temp_dir
 
 
 @contextmanager
-def install_poetry_dependencies(query, path, poetry_export_extra_args, tmp_dir):
-    # TODO:
-    #  1. Emit files instead of temp_dir
-
+def install_poetry_dependencies(
+    query, path, poetry_export_extra_args, tmp_dir, installer="pip"
+):
     # pyproject.toml is always required by poetry
     pyproject_file = path
     if os.path.isdir(path):
@@ -1412,116 +4418,127 @@ def install_poetry_dependencies(query, path, poetry_export_extra_args, tmp_dir):
         else:
             poetry_lock_target_file = None
 
-        if os.path.isfile(poetry_toml_file):
-            log.info("Using poetry.toml configuration file: %s", poetry_toml_file)
-            poetry_toml_target_file = copy_file_to_target(poetry_toml_file, temp_dir)
-        else:
-            poetry_toml_target_file = None
-
-        poetry_exec = "poetry"
-        python_exec = runtime
-        subproc_env = None
-
-        if not docker:
-            if WINDOWS:
-                poetry_exec = "poetry.bat"
-
-        # Install dependencies into the temporary directory.
-        with cd(temp_dir):
-            # NOTE: poetry must be available in the build environment, which is the case with lambci/lambda:build-python* docker images but not public.ecr.aws/sam/build-python* docker images
-            # FIXME: poetry install does not currently allow to specify the target directory so we export the
-            # requirements then install them with "pip --no-deps" to avoid using pip dependency resolver
-
-            poetry_export = [
-                poetry_exec,
-                "export",
-                "--format",
-                "requirements.txt",
-                "--output",
-                "requirements.txt",
-                "--with-credentials",
-            ] + poetry_export_extra_args
-
-            poetry_commands = [
-                [
-                    poetry_exec,
-                    "config",
-                    "--no-interaction",
-                    "virtualenvs.create",
-                    "true",
-                ],
-                [
-                    poetry_exec,
-                    "config",
-                    "--no-interaction",
-                    "virtualenvs.in-project",
-                    "true",
-                ],
-                poetry_export,
-                [
-                    python_exec,
-                    "-m",
-                    "pip",
-                    "install",
-                    "--no-compile",
-                    "--no-deps",
-                    "--prefix=",
-                    "--target=.",
-                    "--requirement=requirements.txt",
-                ],
-            ]
-            if docker:
-                with_ssh_agent = docker.with_ssh_agent
-                poetry_cache_dir = docker.docker_poetry_cache
-                if poetry_cache_dir:
-                    if isinstance(poetry_cache_dir, str):
-                        poetry_cache_dir = os.path.abspath(
-                            os.path.join(working_dir, poetry_cache_dir)
-                        )
-                    else:
-                        poetry_cache_dir = os.path.abspath(
-                            os.path.join(working_dir, artifacts_dir, "cache/poetry")
-                        )
+        if os.path.isfile(poetry_toml_file):
+            log.info("Using poetry.toml configuration file: %s", poetry_toml_file)
+            poetry_toml_target_file = copy_file_to_target(poetry_toml_file, temp_dir)
+        else:
+            poetry_toml_target_file = None
 
-                chown_mask = "{}:{}".format(os.getuid(), os.getgid())
-                poetry_commands += [["chown", "-R", chown_mask, "."]]
-                shell_commands = [
-                    shlex_join(poetry_command) for poetry_command in poetry_commands
-                ]
-                shell_command = [" && ".join(shell_commands)]
-                check_call(
-                    docker_run_command(
-                        ".",
-                        shell_command,
-                        runtime,
-                        image=docker_image_tag_id,
-                        shell=True,
-                        ssh_agent=with_ssh_agent,
-                        poetry_cache_dir=poetry_cache_dir,
-                        docker=docker,
+        poetry_exec = "poetry"
+        python_exec = runtime
+        subproc_env = None
+
+        if not docker:
+            if WINDOWS:
+                poetry_exec = "poetry.bat"
+
+        # Install dependencies into the temporary directory.
+        # NOTE: poetry must be available in the build environment, which is the case with lambci/lambda:build-python* docker images but not public.ecr.aws/sam/build-python* docker images
+        # FIXME: poetry install does not currently allow to specify the target directory so we export the
+        # requirements then install them with "pip --no-deps" to avoid using pip dependency resolver
+
+        poetry_export = [
+            poetry_exec,
+            "export",
+            "--format",
+            "requirements.txt",
+            "--output",
+            "requirements.txt",
+            "--with-credentials",
+        ] + poetry_export_extra_args
+
+        poetry_commands = [
+            [
+                poetry_exec,
+                "config",
+                "--no-interaction",
+                "virtualenvs.create",
+                "true",
+            ],
+            [
+                poetry_exec,
+                "config",
+                "--no-interaction",
+                "virtualenvs.in-project",
+                "true",
+            ],
+            poetry_export,
+        ]
+        pip_install_options = dict(
+            python_exec=python_exec, architecture=query.architecture, no_deps=True
+        )
+        if docker:
+            with_ssh_agent = docker.with_ssh_agent
+            poetry_cache_dir = docker.docker_poetry_cache
+            if poetry_cache_dir:
+                if isinstance(poetry_cache_dir, str):
+                    poetry_cache_dir = os.path.abspath(
+                        os.path.join(working_dir, poetry_cache_dir)
                     )
+                else:
+                    poetry_cache_dir = os.path.abspath(
+                        os.path.join(working_dir, artifacts_dir, "cache/poetry")
+                    )
+
+            chown_mask = "{}:{}".format(os.getuid(), os.getgid())
+            poetry_commands += [["chown", "-R", chown_mask, "."]]
+            shell_commands = [
+                shlex_join(poetry_command) for poetry_command in poetry_commands
+            ]
+            shell_commands.insert(
+                -1,
+                pip_install_shell(
+                    installer, runtime, "requirements.txt", **pip_install_options
+                ),
+            )
+            shell_command = [" && ".join(shell_commands)]
+            check_call(
+                docker_run_command(
+                    temp_dir,
+                    shell_command,
+                    runtime,
+                    image=docker_image_tag_id,
+                    shell=True,
+                    ssh_agent=with_ssh_agent,
+                    poetry_cache_dir=poetry_cache_dir,
+                    uv_cache_dir=(
+                        docker_uv_cache_dir(docker, artifacts_dir)
+                        if installer == "uv"
+                        else None
+                    ),
+                    docker=docker,
                 )
-            else:
-                cmd_log.info(poetry_commands)
-                log_handler and log_handler.flush()
-                for poetry_command in poetry_commands:
-                    if query.quiet:
-                        check_call(
-                            poetry_command,
-                            env=subproc_env,
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                        )
-                    else:
-                        check_call(poetry_command, env=subproc_env)
+            )
+        else:
+            backend = installer_backend(installer)
+            if backend == "uv":
+                subproc_env = uv_env(temp_dir, subproc_env)
+            poetry_commands.append(
+                pip_install_command(
+                    backend, runtime, "requirements.txt", **pip_install_options
+                )
+            )
+            cmd_log.info(poetry_commands)
+            log_handler and log_handler.flush()
+            for poetry_command in poetry_commands:
+                if query.quiet:
+                    check_call(
+                        poetry_command,
+                        env=subproc_env,
+                        cwd=temp_dir,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+                else:
+                    check_call(poetry_command, env=subproc_env, cwd=temp_dir)
 
-            os.remove(pyproject_target_file)
-            if poetry_lock_target_file:
-                os.remove(poetry_lock_target_file)
-            if poetry_toml_target_file:
-                os.remove(poetry_toml_target_file)
+        os.remove(pyproject_target_file)
+        if poetry_lock_target_file:
+            os.remove(poetry_lock_target_file)
+        if poetry_toml_target_file:
+            os.remove(poetry_toml_target_file)
 
-            yield temp_dir
+        yield temp_dir
 
 
 @contextmanager
@@ -1628,75 +4645,87 @@ def install_uv_dependencies(query, path, uv_export_extra_args, tmp_dir):
                 "uv build requires either uv.lock or pyproject.toml to be present"
             )
 
-        with cd(temp_dir):
-            uv_export = [
-                uv_exec,
-                "export",
-                "--python",
-                runtime,
-                "--no-dev",
-                "-o",
-                "requirements.txt",
-            ]
+        uv_export = [
+            uv_exec,
+            "export",
+            "--python",
+            runtime,
+            "--no-dev",
+            "-o",
+            "requirements.txt",
+        ]
 
-            user_lock_exists = os.path.exists(uv_lock_file)
-            if user_lock_exists:
-                uv_export.append("--frozen")
-
-            uv_export += uv_export_extra_args
-
-            if docker:
-                shell_command = [
-                    " && ".join(
-                        [
-                            shlex_join(uv_export),
-                            "sed -i.bak '/^-e \\.\\$/d' requirements.txt",
-                            shlex_join(
-                                [
-                                    uv_exec,
-                                    "pip",
-                                    "install",
-                                    "--python",
-                                    runtime,
-                                    "--system",
-                                    "--no-compile",
-                                    "--target=.",
-                                    "--requirement=requirements.txt",
-                                ]
-                            ),
-                            f"chown -R {os.getuid()}:{os.getgid()} .",
-                        ]
-                    )
-                ]
+        user_lock_exists = os.path.exists(uv_lock_file)
+        if user_lock_exists:
+            uv_export.append("--frozen")
 
-                check_call(
-                    docker_run_command(
-                        ".",
-                        shell_command,
-                        runtime,
-                        image=docker_image_tag_id,
-                        shell=True,
-                        ssh_agent=docker.with_ssh_agent,
-                        docker=docker,
-                    )
-                )
-            else:
-                check_call(uv_export, env=subproc_env)
-                strip_editable_self_dependency("requirements.txt", query)
-                check_call(
+        uv_export += uv_export_extra_args
+
+        started = time.monotonic()
+        if docker:
+            cache_dir = docker_uv_cache_dir(docker, query.artifacts_dir)
+            shell_command = [
+                " && ".join(
                     [
-                        uv_exec,
-                        "pip",
-                        "install",
-                        "--python",
-                        runtime,
-                        "--system",
-                        "--no-compile",
-                        "--target=.",
-                        "--requirement=requirements.txt",
-                    ],
-                    env=subproc_env,
+                        shlex_join(uv_export),
+                        "sed -i.bak '/^-e \\.\\$/d' requirements.txt",
+                        shlex_join(
+                            [
+                                uv_exec,
+                                "pip",
+                                "install",
+                                "--python",
+                                runtime,
+                                "--system",
+                                "--no-compile",
+                                "--target=.",
+                                "--requirement=requirements.txt",
+                            ]
+                        ),
+                        f"chown -R {os.getuid()}:{os.getgid()} .",
+                    ]
+                )
+            ]
+
+            check_call(
+                docker_run_command(
+                    temp_dir,
+                    shell_command,
+                    runtime,
+                    image=docker_image_tag_id,
+                    shell=True,
+                    ssh_agent=docker.with_ssh_agent,
+                    uv_cache_dir=cache_dir,
+                    docker=docker,
                 )
+            )
+        else:
+            cache_dir = uv_cache_dir()
+            subproc_env = uv_env(temp_dir, subproc_env)
+            check_call(uv_export, env=subproc_env, cwd=temp_dir)
+            strip_editable_self_dependency(
+                os.path.join(temp_dir, "requirements.txt"), query
+            )
+            check_call(
+                [
+                    uv_exec,
+                    "pip",
+                    "install",
+                    "--python",
+                    runtime,
+                    "--system",
+                    "--no-compile",
+                    "--target=.",
+                    "--requirement=requirements.txt",
+                ],
+                env=subproc_env,
+                cwd=temp_dir,
+            )
+        log.info(
+            "Installed python dependencies with uv in %.1fs (uv cache: %s)",
+            time.monotonic() - started,
+            cache_dir or "none",
+        )
 
         if generated_uv_lock and os.path.isdir(path):
             source_uv_lock = os.path.join(path, "uv.lock")
@@ -1729,9 +4758,6 @@ def install_uv_dependencies(query, path, uv_export_extra_args, tmp_dir):
 
 @contextmanager
 def install_npm_requirements(query, requirements_file, tmp_dir):
-    # TODO:
-    #  1. Emit files instead of temp_dir
-
     if not os.path.exists(requirements_file):
         yield
         return
@@ -1787,50 +4813,524 @@ def install_npm_requirements(query, requirements_file, tmp_dir):
                 subproc_env = os.environ.copy()
 
         # Install dependencies into the temporary directory.
-        with cd(temp_dir):
-            npm_command = [npm_exec, "install"]
-            if docker:
-                with_ssh_agent = docker.with_ssh_agent
-                chown_mask = "{}:{}".format(os.getuid(), os.getgid())
-                shell_command = [
-                    shlex_join(npm_command),
-                    "&&",
-                    shlex_join(["chown", "-R", chown_mask, "."]),
-                ]
-                shell_command = [" ".join(shell_command)]
-                check_call(
-                    docker_run_command(
-                        ".",
-                        shell_command,
-                        runtime,
-                        image=docker_image_tag_id,
-                        shell=True,
-                        ssh_agent=with_ssh_agent,
-                        docker=docker,
+        npm_command = [npm_exec, "install"]
+        if docker:
+            with_ssh_agent = docker.with_ssh_agent
+            chown_mask = "{}:{}".format(os.getuid(), os.getgid())
+            shell_command = [
+                shlex_join(npm_command),
+                "&&",
+                shlex_join(["chown", "-R", chown_mask, "."]),
+            ]
+            shell_command = [" ".join(shell_command)]
+            check_call(
+                docker_run_command(
+                    temp_dir,
+                    shell_command,
+                    runtime,
+                    image=docker_image_tag_id,
+                    shell=True,
+                    ssh_agent=with_ssh_agent,
+                    docker=docker,
+                )
+            )
+        else:
+            cmd_log.info(shlex_join(npm_command))
+            log_handler and log_handler.flush()
+            try:
+                if query.quiet:
+                    check_call(
+                        npm_command,
+                        env=subproc_env,
+                        cwd=temp_dir,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
                     )
+                else:
+                    check_call(npm_command, env=subproc_env, cwd=temp_dir)
+            except FileNotFoundError as e:
+                raise RuntimeError(
+                    "Nodejs interpreter version equal "
+                    "to defined lambda runtime ({}) should be "
+                    "available in system PATH".format(runtime)
+                ) from e
+
+        temp_copy.remove_from_target_dir()
+        yield temp_dir
+
+
+def bytecode_optimization_levels(config):
+    """Returns optimization levels from a `bytecode` value of a source_path item."""
+    if config is True:
+        return [0]
+    if isinstance(config, dict):
+        unknown = set(config) - {"optimize"}
+        if unknown:
+            raise ValueError(
+                "Unsupported bytecode options: {}".format(", ".join(sorted(unknown)))
+            )
+        levels = config.get("optimize", 0)
+        if not isinstance(levels, list):
+            levels = [levels]
+        if levels and all(level in (0, 1, 2) for level in levels):
+            return sorted(set(levels))
+    raise ValueError("Unsupported bytecode value: {}".format(config))
+
+
+def compile_bytecode(query, path, runtime, config, prefix=None):
+    """
+    Compiles .py files of installed dependencies into __pycache__ with an
+    interpreter of the target runtime, as /var/task is read-only and the
+    Python runtime would compile them on every cold start otherwise.
+
+    Bytecode is checked against sources by neither mtime nor hash, so it's
+    reproducible and zip member timestamps don't matter. Source paths in
+    the bytecode point to where the files end up in /var/task, under the
+    prefix in the zip if any.
+    """
+    docker = query.docker
+
+    dest_dir = "/var/task"
+    prefix = prefix and os.path.normpath(prefix).replace(os.sep, "/").strip("/")
+    if prefix and prefix != ".":
+        dest_dir = "/".join((dest_dir, prefix))
+
+    log.info("Compiling python bytecode: %s", path)
+    python_exec = runtime
+    if not docker and WINDOWS:
+        python_exec = "python.exe"
+    compile_command = [
+        python_exec,
+        "-m",
+        "compileall",
+        "-q",
+        "-j",
+        "0",
+        "--invalidation-mode",
+        "unchecked-hash",
+        # Keep the bytecode independent of a temporary directory path
+        "-d",
+        dest_dir,
+    ]
+    for level in bytecode_optimization_levels(config):
+        compile_command.extend(["-o", str(level)])
+    compile_command.append(".")
+
+    if docker:
+        chown_mask = "{}:{}".format(os.getuid(), os.getgid())
+        shell_command = [
+            shlex_join(compile_command),
+            "&&",
+            shlex_join(["chown", "-R", chown_mask, "."]),
+        ]
+        shell_command = [" ".join(shell_command)]
+        check_call(
+            docker_run_command(
+                path,
+                shell_command,
+                runtime,
+                image=docker.docker_image,
+                shell=True,
+                docker=docker,
+            )
+        )
+    else:
+        cmd_log.info(shlex_join(compile_command))
+        log_handler and log_handler.flush()
+        try:
+            check_call(
+                compile_command,
+                cwd=path,
+                stdout=subprocess.DEVNULL if query.quiet else None,
+            )
+        except FileNotFoundError as e:
+            raise RuntimeError(
+                "Python interpreter version equal "
+                "to defined lambda runtime ({}) should be "
+                "available in system PATH".format(runtime)
+            ) from e
+
+
+class DependencyPruner:
+    """
+    Removes files which aren't needed at runtime from installed dependencies
+    before they're zipped, and strips debug symbols of ELF shared objects.
+
+    Patterns ending with "/" match directories, patterns with "/" match
+    paths relative to the installation directory, the others match names.
+    """
+
+    rule_sets = {
+        "tests": ("*/tests/", "*/test/"),
+        "pycache": ("__pycache__/", "*.pyc"),
+        "typing": ("*.pyi", "py.typed"),
+        "docs": ("*/docs/", "*/doc/", "*/examples/"),
+        "metadata": (
+            "*.dist-info/RECORD",
+            "*.dist-info/INSTALLER",
+            "*.dist-info/REQUESTED",
+            "*.dist-info/direct_url.json",
+        ),
+        "sources": ("*.c", "*.cc", "*.cpp", "*.h", "*.hpp", "*.pyx", "*.pxd", "*.pxi"),
+    }
+    default_rules = ("tests", "pycache", "typing", "metadata", "sources")
+
+    def __init__(
+        self, rules=None, patterns=None, keep=None, strip=False, dry_run=False
+    ):
+        if rules is None:
+            rules = self.default_rules
+        unknown = set(rules) - set(self.rule_sets)
+        if unknown:
+            raise ValueError(
+                "Unsupported prune rules: {}".format(", ".join(sorted(unknown)))
+            )
+        self.rules = [(rule, self.rule_sets[rule]) for rule in rules]
+        if patterns:
+            self.rules.append(("patterns", tuple(patterns)))
+        self.keep = tuple(keep or ())
+        self.strip = strip
+        self.dry_run = dry_run
+        # {rule: [files, bytes]}
+        self.stats = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Makes a pruner from a `prune` value of a source_path item."""
+        if config is True:
+            config = {}
+        if not isinstance(config, dict):
+            raise ValueError("Unsupported prune value: {}".format(config))
+        unknown = set(config) - {"rules", "patterns", "keep", "strip", "dry_run"}
+        if unknown:
+            raise ValueError(
+                "Unsupported prune options: {}".format(", ".join(sorted(unknown)))
+            )
+        return cls(**config)
+
+    @staticmethod
+    def _match(relpath, patterns):
+        name = relpath.rstrip("/").rsplit("/", 1)[-1]
+        for pattern in patterns:
+            if pattern.endswith("/") != relpath.endswith("/"):
+                continue
+            if "/" in pattern.rstrip("/"):
+                if fnmatch.fnmatchcase(relpath, pattern):
+                    return True
+            elif fnmatch.fnmatchcase(name, pattern.rstrip("/")):
+                return True
+        return False
+
+    def _rule_for(self, relpath):
+        if self._match(relpath, self.keep):
+            return None
+        for rule, patterns in self.rules:
+            if self._match(relpath, patterns):
+                return rule
+        return None
+
+    def _account(self, rule, files, size):
+        stats = self.stats.setdefault(rule, [0, 0])
+        stats[0] += files
+        stats[1] += size
+
+    @staticmethod
+    def _tree_size(path):
+        files = size = 0
+        for _, st in list_file_entries(path, follow_symlinks=False):
+            # Skip broken symlinks
+            if st is not None and not stat.S_ISDIR(st.st_mode):
+                files += 1
+                size += st.st_size
+        return files, size
+
+    def prune(self, query, path, runtime):
+        """Prunes an installation directory."""
+        shared_objects = []
+        for root, dirs, files in os.walk(path):
+            relroot = os.path.relpath(root, path).replace(os.sep, "/")
+            relroot = "" if relroot == "." else relroot + "/"
+            for name in sorted(dirs):
+                dir_path = os.path.join(root, name)
+                rule = self._rule_for(relroot + name + "/")
+                if rule and not os.path.islink(dir_path):
+                    dirs.remove(name)
+                    self._account(rule, *self._tree_size(dir_path))
+                    if not self.dry_run:
+                        shutil.rmtree(dir_path)
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                st = os.lstat(file_path)
+                rule = self._rule_for(relroot + name)
+                if rule:
+                    self._account(rule, 1, st.st_size)
+                    if not self.dry_run:
+                        os.unlink(file_path)
+                elif self.strip and stat.S_ISREG(st.st_mode) and ".so" in name:
+                    debug_size = elf_debug_size(file_path)
+                    if debug_size:
+                        shared_objects.append((file_path, st.st_size, debug_size))
+
+        if shared_objects:
+            if self.dry_run:
+                for _, _, debug_size in shared_objects:
+                    self._account("strip", 1, debug_size)
+            else:
+                self._strip(query, path, runtime, [p for p, *_ in shared_objects])
+                for file_path, size, _ in shared_objects:
+                    self._account("strip", 1, size - os.path.getsize(file_path))
+        self.report(path)
+
+    @staticmethod
+    def _strip(query, path, runtime, files):
+        docker = query.docker
+        strip_command = ["strip", "--strip-debug"]
+        for f in files:
+            if os.stat(f).st_nlink > 1:
+                # Don't modify a file of a dependency cache in place
+                tmp_file = f + ".strip"
+                copy_file(f, tmp_file)
+                os.replace(tmp_file, f)
+        files = [os.path.relpath(f, path) for f in files]
+        if docker:
+            chown_mask = "{}:{}".format(os.getuid(), os.getgid())
+            shell_command = [
+                shlex_join(strip_command + files),
+                "&&",
+                shlex_join(["chown", "-R", chown_mask, "."]),
+            ]
+            shell_command = [" ".join(shell_command)]
+            check_call(
+                docker_run_command(
+                    path,
+                    shell_command,
+                    runtime,
+                    image=docker.docker_image,
+                    shell=True,
+                    docker=docker,
+                )
+            )
+        elif not shutil.which(strip_command[0]):
+            log.warning("strip is not available, shared objects aren't stripped")
+        else:
+            cmd_log.info(shlex_join(strip_command + ["..."]))
+            check_call(strip_command + files, cwd=path)
+
+    def report(self, path):
+        files = sum(f for f, _ in self.stats.values())
+        size = sum(b for _, b in self.stats.values())
+        log.info(
+            "%s %d bytes in %d files of %s",
+            "Would reclaim" if self.dry_run else "Reclaimed",
+            size,
+            files,
+            path,
+        )
+        for rule, (files, size) in sorted(
+            self.stats.items(), key=lambda item: -item[1][1]
+        ):
+            log.info("  %s: %d bytes in %d files", rule, size, files)
+
+
+def elf_debug_size(file_path):
+    """
+    Returns a total size of debug sections of an ELF file,
+    or None if it's not an ELF file.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            header = f.read(64)
+            if len(header) < 52 or header[:4] != b"\x7fELF":
+                return None
+            endian = "<" if header[5] == 1 else ">"
+            if header[4] == 2:
+                shoff, shentsize, shnum, shstrndx = struct.unpack_from(
+                    endian + "Q10xHHH", header, 0x28
                 )
+                section = struct.Struct(endian + "II16xQQ")
             else:
-                cmd_log.info(shlex_join(npm_command))
-                log_handler and log_handler.flush()
-                try:
-                    if query.quiet:
-                        check_call(
-                            npm_command,
-                            env=subproc_env,
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                        )
-                    else:
-                        check_call(npm_command, env=subproc_env)
-                except FileNotFoundError as e:
-                    raise RuntimeError(
-                        "Nodejs interpreter version equal "
-                        "to defined lambda runtime ({}) should be "
-                        "available in system PATH".format(runtime)
-                    ) from e
+                shoff, shentsize, shnum, shstrndx = struct.unpack_from(
+                    endian + "I10xHHH", header, 0x20
+                )
+                section = struct.Struct(endian + "II8xII")
+            if not shoff or shstrndx >= shnum:
+                return 0
+            f.seek(shoff)
+            table = f.read(shentsize * shnum)
+            sections = [section.unpack_from(table, i * shentsize) for i in range(shnum)]
+            _, _, names_offset, names_size = sections[shstrndx]
+            f.seek(names_offset)
+            names = f.read(names_size)
+    except (OSError, struct.error):
+        return None
+
+    size = 0
+    for name, sh_type, _, sh_size in sections:
+        name = names[name : names.find(b"\0", name)]
+        # SHT_NOBITS sections take no space in the file
+        if sh_type != 8 and name.startswith((b".debug", b".zdebug")):
+            size += sh_size
+    return size
+
+
+class ImportTimeProfiler:
+    """
+    Imports a handler module from an extracted zip archive with the
+    interpreter of the target runtime under `-X importtime` and ranks
+    modules by their cumulative import time.
+    """
+
+    # A number of runs, the fastest one is reported
+    runs = 3
+    # A number of modules in the report
+    report_size = 25
+
+    def __init__(self, query, zip_filename, handler, budget_ms=None):
+        self.query = query
+        self.zip_filename = zip_filename
+        self.module = handler.rsplit(".", 1)[0]
+        self.budget_ms = budget_ms
+        self.total_us = None
+        # [(module, self_us, cumulative_us, depth)]
+        self.imports = []
+
+    @staticmethod
+    def parse(output, module):
+        """
+        Returns imports of a module, in the order they were finished,
+        from the `-X importtime` output.
+        """
+        entries = []
+        for line in output.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            fields = line[len("import time:") :].split("|")
+            if len(fields) != 3 or not fields[0].strip().isdigit():
+                continue
+            name = fields[2][1:]
+            depth = (len(name) - len(name.lstrip(" "))) // 2
+            entries.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+        # Nested imports are listed before the module importing them
+        for i in range(len(entries) - 1, -1, -1):
+            name, _, _, depth = entries[i]
+            if name == module and depth == 0:
+                start = i
+                while start > 0 and entries[start - 1][3] > 0:
+                    start -= 1
+                return entries[start : i + 1]
+        return []
+
+    def _command(self, runtime):
+        python_exec = runtime
+        if not self.query.docker and WINDOWS:
+            python_exec = "python.exe"
+        return [
+            python_exec,
+            "-s",
+            "-X",
+            "importtime",
+            "-c",
+            "import {}".format(self.module),
+        ]
+
+    def _run(self, path, runtime):
+        docker = self.query.docker
+        command = self._command(runtime)
+        # Lambda can't write bytecode of modules to /var/task either
+        env = {"PYTHONDONTWRITEBYTECODE": "1", "PYTHONPATH": "."}
+        if docker:
+            command = docker_run_command(
+                path,
+                ["env"] + ["{}={}".format(k, v) for k, v in env.items()] + command,
+                runtime,
+                image=docker.docker_image,
+                docker=docker,
+            )
+            env = None
+        else:
+            cmd_log.info(shlex_join(command))
+            env = dict(os.environ, **env)
+        return subprocess.run(
+            command,
+            cwd=path,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+
+    def profile(self, runtime):
+        """
+        Returns False if the module can't be imported, logs the report as
+        an error and raises an error if the import time is over the budget.
+        """
+        log.info("Profiling import time of %s", self.module)
+        with tempdir(self.query.temp_dir) as path:
+            with zipfile.ZipFile(self.zip_filename) as zf:
+                zf.extractall(path)
+            for _ in range(self.runs):
+                result = self._run(path, runtime)
+                imports = self.parse(result.stderr, self.module)
+                if result.returncode or not imports:
+                    errors = [
+                        line
+                        for line in result.stderr.splitlines()
+                        if not line.startswith("import time:")
+                    ]
+                    log.warning(
+                        "Can't import %s to profile it:\n%s",
+                        self.module,
+                        "\n".join(errors),
+                    )
+                    return False
+                if self.total_us is None or imports[-1][2] < self.total_us:
+                    self.total_us = imports[-1][2]
+                    self.imports = imports
+
+        self.write_report("{}.importtime.txt".format(self.zip_filename))
+        over_budget = (
+            self.budget_ms is not None and self.total_us > self.budget_ms * 1000
+        )
+        (log.error if over_budget else log.info)(
+            "Import time:\n%s", self.summary(self.report_size)
+        )
+        if over_budget:
+            raise RuntimeError(
+                "Import time of {} is {:.1f} ms, over the budget of {} ms".format(
+                    self.module, self.total_us / 1000, self.budget_ms
+                )
+            )
+        return True
+
+    def packages(self):
+        """Returns top-level packages with their total self import time."""
+        packages = {}
+        for name, self_us, _, _ in self.imports:
+            package = name.split(".", 1)[0]
+            packages[package] = packages.get(package, 0) + self_us
+        return sorted(packages.items(), key=lambda item: (-item[1], item[0]))
+
+    def summary(self, limit=None):
+        fmt = "{:>10} {:>10}  {}".format
+        lines = [fmt("cumul, ms", "self, ms", "module")]
+        ranked = sorted(self.imports, key=lambda entry: (-entry[2], entry[0]))
+        for name, self_us, cumulative_us, _ in ranked[:limit]:
+            lines.append(
+                fmt(
+                    "{:.1f}".format(cumulative_us / 1000),
+                    "{:.1f}".format(self_us / 1000),
+                    name,
+                )
+            )
+        lines.append("packages:")
+        for package, self_us in self.packages()[:limit]:
+            lines.append(fmt("", "{:.1f}".format(self_us / 1000), package))
+        return "\n".join(lines)
 
-            temp_copy.remove_from_target_dir()
-            yield temp_dir
+    def write_report(self, filename):
+        with open(filename, "w") as f:
+            f.write(self.summary())
+            f.write("\n")
 
 
 class TemporaryCopy:
@@ -1926,6 +5426,7 @@ def docker_run_command(
     interactive=False,
     pip_cache_dir=None,
     poetry_cache_dir=None,
+    uv_cache_dir=None,
     docker=None,
 ):
     """"""
@@ -1995,6 +5496,21 @@ def docker_run_command(
                     "{}:/root/.cache/pypoetry:z".format(poetry_cache_dir),
                 ]
             )
+        if uv_cache_dir:
+            uv_cache_dir = os.path.abspath(uv_cache_dir)
+            os.makedirs(uv_cache_dir, exist_ok=True)
+            docker_cmd.extend(
+                [
+                    "-v",
+                    "{}:/root/.cache/uv:z".format(uv_cache_dir),
+                    "-e",
+                    "UV_CACHE_DIR=/root/.cache/uv",
+                    # Files can't be linked across bind mounts of the cache
+                    # and of the build root
+                    "-e",
+                    "UV_LINK_MODE=copy",
+                ]
+            )
 
     if not image:
         image = "public.ecr.aws/sam/build-{}".format(runtime)
@@ -2018,10 +5534,285 @@ def docker_run_command(
     return docker_cmd
 
 
+################################################################################
+# Packaging daemon
+
+
+class Inotify:
+    """A minimal binding of the Linux inotify API."""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = (
+        IN_MODIFY
+        | IN_ATTRIB
+        | IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+        | IN_ONLYDIR
+    )
+
+    def __init__(self):
+        if platform.system() != "Linux":
+            raise RuntimeError("inotify is available only on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read_events(self):
+        """Returns a list of (wd, mask, name) of pending events."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 1024 * 64)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = struct.unpack_from("iIII", data, pos)
+                pos += 16
+                name = data[pos : pos + length].rstrip(b"\0")
+                pos += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DigestDaemon:
+    """
+    Keeps digests of files in source directories current by watching them
+    with inotify, and serves them over a Unix socket to prepare commands.
+
+    Source directories are watched from the first request on and files are
+    hashed again as soon as they are changed. Files are hashed between
+    requests in slices of time, so a request for a large tree which hasn't
+    been watched yet is replied with digests hashed in reply_time seconds,
+    and the rest of the tree is hashed in the background.
+    """
+
+    reply_time = 1.0
+    slice_time = 0.1
+
+    def __init__(self, socket_path, log=None):
+        self.socket_path = socket_path
+        self._log = log or logging.getLogger("serve")
+        self._inotify = Inotify()
+        self._cache = FileDigestCache(None, log=self._log)
+        self._dirs = {}
+        self._watched = {}
+        self._dirty = set()
+        self._running = False
+
+    @staticmethod
+    def default_socket_path():
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+        if runtime_dir:
+            return os.path.join(runtime_dir, "terraform-aws-lambda.sock")
+        return os.path.join(
+            tempfile.gettempdir(), "terraform-aws-lambda-{}.sock".format(os.getuid())
+        )
+
+    def watch(self, top):
+        """Watches a directory tree and schedules its files for hashing."""
+        for root, dirs, files in scan_dir(top):
+            if root in self._watched and root != top:
+                dirs[:] = []
+                continue
+            try:
+                wd = self._inotify.add_watch(root)
+            except OSError as e:
+                self._log.warning("can't watch %s: %s", root, e)
+                dirs[:] = []
+                continue
+            self._dirs[wd] = root
+            self._watched[root] = wd
+            for entry in files:
+                self._dirty.add(entry.path)
+
+    def _forget(self, top):
+        self._dirty = {p for p in self._dirty if not is_subpath(p, top)}
+        for path, _ in self._cache.entries(top):
+            self._cache.discard(path)
+        for path in [d for d in self._watched if is_subpath(d, top)]:
+            wd = self._watched.pop(path)
+            if self._dirs.get(wd) == path:
+                del self._dirs[wd]
+
+    def process_events(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self._log.warning("inotify queue overflow, rehashing everything")
+                for top in list(self._watched):
+                    self.watch(top)
+                continue
+            root = self._dirs.get(wd)
+            if root is None:
+                continue
+            if mask & Inotify.IN_IGNORED:
+                self._forget(root)
+                continue
+            if not name:
+                continue
+            path = os.path.join(root, name)
+            if mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    self.watch(path)
+                elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    self._forget(path)
+            else:
+                self._cache.discard(path)
+                self._dirty.add(path)
+
+    def _rehash(self, deadline=None):
+        """
+        Hashes changed files until the deadline, if it's given. Returns True
+        if there are files left to hash, files in the racy window are
+        hashed again later.
+        """
+        pending = set()
+        while self._dirty:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            path = self._dirty.pop()
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._cache.discard(path)
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if self._cache.is_racy(st):
+                # Retry later when its stat data can be trusted
+                pending.add(path)
+                continue
+            _file_content_digest(path, st, self._cache)
+        left = bool(self._dirty)
+        self._dirty |= pending
+        return left
+
+    def digests(self, roots):
+        self.process_events()
+        digests = {}
+        for top in roots:
+            if top not in self._watched:
+                self._log.info("watching %s", top)
+                self.watch(top)
+        if self._rehash(deadline=time.monotonic() + self.reply_time):
+            self._log.info("replying while %d files are hashed", len(self._dirty))
+        for top in roots:
+            digests.update(self._cache.entries(top))
+        return digests
+
+    def _handle(self, conn):
+        with conn:
+            conn.settimeout(DaemonDigests.timeout)
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = conn.recv(1024 * 64)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                request = json.loads(data)
+                if request.get("op") != "digests":
+                    raise ValueError("unsupported request: {}".format(request))
+                roots = [os.path.abspath(p) for p in request["roots"]]
+                response = {"digests": self.digests(roots)}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"error": str(e)}
+            conn.sendall(json.dumps(response).encode())
+
+    def stop(self):
+        self._running = False
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.socket_path)
+                raise RuntimeError(
+                    "Packaging daemon is already running: {}".format(self.socket_path)
+                )
+            except ConnectionRefusedError:
+                os.unlink(self.socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        server.listen()
+        self._log.info("listening on %s", self.socket_path)
+
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        selector.register(self._inotify.fd, selectors.EVENT_READ)
+        self._running = True
+        busy = False
+        try:
+            while self._running:
+                # Don't wait for events while there are files left to hash
+                for key, _ in selector.select(timeout=0 if busy else 1):
+                    if key.fileobj is server:
+                        self._handle(server.accept()[0])
+                self.process_events()
+                busy = self._rehash(deadline=time.monotonic() + self.slice_time)
+        finally:
+            selector.close()
+            server.close()
+            self._inotify.close()
+            os.unlink(self.socket_path)
+
+
 ################################################################################
 # Commands
 
 
+def manifest_mtimes_filename(zip_filename):
+    return "{}.mtimes.json".format(os.path.splitext(zip_filename)[0])
+
+
+def load_manifest_mtimes(zip_filename):
+    """
+    Returns mtimes of manifest files saved by the prepare command or None
+    when the build plan has been prepared elsewhere, e.g. in a saved plan.
+    """
+    try:
+        with open(manifest_mtimes_filename(zip_filename)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
 def prepare_command(args):
     """
     Generates a content hash of the source_path, which is used to determine if
@@ -2066,7 +5857,35 @@ def prepare_command(args):
     if log.isEnabledFor(DEBUG2):
         log.debug("BUILD_PLAN: %s", json.dumps(build_plan, indent=2))
 
-    content_hash = bpm.hash()
+    digest_cache = None
+    if args.hash_git_index:
+        digest_cache = GitIndexDigests(log=log)
+    elif args.hash_tree:
+        digest_cache = MerkleDigestTree.for_source_path(
+            artifacts_dir, source_path, log=log
+        ).load()
+    elif args.hash_cache:
+        digest_cache = FileDigestCache.for_source_path(
+            artifacts_dir, source_path, log=log
+        ).load()
+
+    hash_workers = (
+        args.hash_workers if args.hash_workers is not None else query.hash_workers
+    )
+    hash_workers = int(hash_workers) if hash_workers else None
+
+    daemon_digests = None
+    if not args.hash_git_index:
+        daemon_digests = DaemonDigests.connect(
+            args.daemon_socket, bpm.source_dirs(), fallback=digest_cache, log=log
+        )
+
+    content_hash = bpm.hash(daemon_digests or digest_cache, workers=hash_workers)
+    if isinstance(digest_cache, FileDigestCache):
+        if isinstance(digest_cache, MerkleDigestTree):
+            for subtree in digest_cache.changed_subtrees():
+                log.info("changed: %s", os.path.relpath(subtree))
+        digest_cache.save()
     content_hash.update(json.dumps(build_plan, sort_keys=True).encode())
     content_hash.update(runtime.encode())
     for c in hash_internal:
@@ -2095,9 +5914,21 @@ def prepare_command(args):
         "artifacts_dir": artifacts_dir,
         "build_plan": build_plan,
         "quiet": query.quiet,
+        "handler": query.handler,
+        "architecture": query.architecture,
     }
     if docker:
         build_data["docker"] = docker
+    manifest_mtimes = None
+    if args.manifest:
+        build_data["manifest"], manifest_mtimes = bpm.manifest()
+    if args.installer:
+        if args.installer not in INSTALLER_BACKENDS:
+            raise ValueError("Unsupported installer: {}".format(args.installer))
+        build_data["installer"] = args.installer
+    wheelhouse = wheelhouse_dir(args.wheelhouse, artifacts_dir)
+    if wheelhouse:
+        build_data["wheelhouse"] = wheelhouse
 
     build_plan = json.dumps(build_data)
     build_plan_filename = os.path.join(
@@ -2107,6 +5938,11 @@ def prepare_command(args):
         os.makedirs(artifacts_dir, exist_ok=True)
     with open(build_plan_filename, "w") as f:
         f.write(build_plan)
+    if manifest_mtimes is not None:
+        # Kept out of the build plan, which changes in Terraform state
+        # shouldn't depend on file modification times
+        with open(manifest_mtimes_filename(zip_filename), "w") as f:
+            json.dump(manifest_mtimes, f)
 
     # Output the result to Terraform.
     json.dump(
@@ -2153,16 +5989,136 @@ def build_command(args):
 
     # Zip up the build plan and write it to the target filename.
     # This will be used by the Lambda function as the source code package.
-    with ZipWriteStream(filename, quiet=getattr(query, "quiet", False)) as zs:
+    zip_workers = int(args.zip_workers) if args.zip_workers else None
+    lineage = None
+    if args.zip_incremental:
+        lineage = ZipLineage.for_build_plan(query.artifacts_dir, runtime, build_plan)
+    size_profiler = None
+    if args.size_report or args.max_unzipped_size or args.max_zipped_size:
+        size_profiler = ZipSizeProfiler(
+            max_unzipped_size=(
+                int(args.max_unzipped_size) * 1024 * 1024
+                if args.max_unzipped_size
+                else None
+            ),
+            max_zipped_size=(
+                int(args.max_zipped_size) * 1024 * 1024
+                if args.max_zipped_size
+                else None
+            ),
+        )
+    member_cache = None
+    if args.zip_cache:
+        member_cache = ZipMemberCache.for_artifacts_dir(
+            query.artifacts_dir, int(args.zip_cache_size) * 1024 * 1024
+        )
+    dep_cache = None
+    if args.dep_cache:
+        dep_cache = DependencyCache.for_artifacts_dir(
+            query.artifacts_dir, int(args.dep_cache_size) * 1024 * 1024
+        )
+    with ZipWriteStream(
+        filename,
+        quiet=getattr(query, "quiet", False),
+        workers=zip_workers,
+        member_cache=member_cache,
+        lineage=lineage,
+        size_profiler=size_profiler,
+    ) as zs:
         bpm = BuildPlanManager(args, log=log)
-        bpm.execute(build_plan, zs, query)
+        bpm.execute(
+            build_plan,
+            zs,
+            query,
+            install_workers=(
+                int(args.install_workers) if args.install_workers else None
+            ),
+            dep_cache=dep_cache,
+            manifest_mtimes=load_manifest_mtimes(filename) if query.manifest else None,
+        )
+    if dep_cache:
+        dep_cache.evict()
 
     os.utime(filename, ns=(timestamp, timestamp))
     if not getattr(query, "quiet", False):
         log.info("Created: %s", shlex.quote(filename))
+        if size_profiler:
+            log.info("Package size:\n%s", size_profiler.summary())
     if log.isEnabledFor(logging.DEBUG):
-        with open(filename, "rb") as f:
-            log.info("Base64sha256: %s", source_code_hash(f.read()))
+        log.info("Base64sha256: %s", zs.base64sha256)
+
+    if args.import_profile and runtime.startswith("python"):
+        if not query.handler:
+            log.warning("Handler is not set, import time isn't profiled")
+            return
+        profiler = ImportTimeProfiler(
+            query,
+            filename,
+            query.handler,
+            budget_ms=int(args.import_budget) if args.import_budget else None,
+        )
+        try:
+            profiler.profile(runtime)
+        except RuntimeError as e:
+            # Build the package again when the budget is fixed
+            for path in (filename, "{}.sha256".format(filename)):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            log.error("%s, removed: %s", e, shlex.quote(filename))
+            raise SystemExit(1)
+
+
+def wheelhouse_command(args):
+    """
+    Builds wheels of python requirements into a wheelhouse used by
+    offline installs of builds.
+    """
+
+    wheel_dir = os.path.abspath(args.wheel_dir) if args.wheel_dir else None
+    wheel_dir = (
+        wheel_dir
+        or wheelhouse_dir(args.wheelhouse, args.artifacts_dir)
+        or wheelhouse_dir("true", args.artifacts_dir)
+    )
+    os.makedirs(wheel_dir, exist_ok=True)
+
+    python_exec = "python.exe" if WINDOWS else args.runtime
+    for requirements_file in args.requirements:
+        requirements_file = os.path.abspath(requirements_file)
+        log.info("Building wheels of python requirements: %s", requirements_file)
+        # Wheels already in the wheelhouse aren't rebuilt
+        pip_command = [
+            python_exec,
+            "-m",
+            "pip",
+            "wheel",
+            "--wheel-dir={}".format(wheel_dir),
+            "--find-links={}".format(wheel_dir),
+            "--requirement={}".format(requirements_file),
+        ]
+        cmd_log.info(shlex_join(pip_command))
+        log_handler and log_handler.flush()
+        check_call(pip_command, cwd=os.path.dirname(requirements_file))
+    log.info("Wheelhouse: %s", wheel_dir)
+
+
+def serve_command(args):
+    """
+    Runs a packaging daemon which keeps content hashes of source files
+    warm for prepare commands until it's interrupted.
+    """
+
+    log = logging.getLogger("serve")
+
+    socket_path = args.socket or args.daemon_socket
+    daemon = DigestDaemon(socket_path, log=log)
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
 
 def add_hidden_commands(sub_parsers):
@@ -2213,10 +6169,7 @@ def add_hidden_commands(sub_parsers):
                 log.debug("-" * 80)
                 subprocess.call([zipinfo, args.zipfile])
             log.debug("-" * 80)
-            log.debug(
-                "Source code hash: %s",
-                source_code_hash(open(args.zipfile, "rb").read()),
-            )
+            log.debug("Source code hash: %s", zs.base64sha256)
 
     p = hidden_parser("zip", help="Zip folder with provided files timestamp")
     p.set_defaults(command=zip_cmd)
@@ -2233,7 +6186,7 @@ def add_hidden_commands(sub_parsers):
     p.add_argument("-v", "--verbose", action="store_true")
 
     p = hidden_parser("hash", help="Generate content hash for a file")
-    p.set_defaults(command=lambda args: print(source_code_hash(args.file.read())))
+    p.set_defaults(command=lambda args: print(file_source_code_hash(args.file)))
     p.add_argument("file", help="Path to a file", type=argparse.FileType("rb"))
 
 
@@ -2252,6 +6205,13 @@ def args_parser():
         action="store_true",
         help="Force rebuilding even if a zip artifact exists",
     )
+    p.add_argument(
+        "--no-dep-cache",
+        dest="dep_cache",
+        action="store_false",
+        help="Install dependencies without the installed dependency cache "
+        "enabled by TF_LAMBDA_PACKAGE_DEP_CACHE",
+    )
     p.add_argument(
         "-t",
         "--timestamp",
@@ -2264,6 +6224,43 @@ def args_parser():
         metavar="PLAN_FILE",
         help="A build plan file provided by the prepare command",
     )
+
+    p = sp.add_parser(
+        "wheelhouse", help="build wheels of python requirements for offline installs"
+    )
+    p.set_defaults(command=wheelhouse_command)
+    p.add_argument(
+        "-r", "--runtime", help="A python runtime of wheels", default="python3.12"
+    )
+    p.add_argument(
+        "-a",
+        "--artifacts-dir",
+        default=DEFAULT_ARTIFACTS_DIR,
+        help="An artifacts directory of builds, as the artifacts_dir variable "
+        "(builds by default)",
+    )
+    p.add_argument(
+        "-d",
+        "--wheel-dir",
+        help="A wheelhouse directory (<artifacts dir>/wheelhouse by default, "
+        "or TF_LAMBDA_PACKAGE_WHEELHOUSE if it's a path)",
+    )
+    p.add_argument(
+        "requirements",
+        metavar="REQUIREMENTS_FILE",
+        nargs=argparse.ONE_OR_MORE,
+        help="A pip requirements file",
+    )
+
+    p = sp.add_parser(
+        "serve", help="run a daemon keeping content hashes of sources warm"
+    )
+    p.set_defaults(command=serve_command)
+    p.add_argument(
+        "-s",
+        "--socket",
+        help="A Unix socket path to listen on",
+    )
     add_hidden_commands(sp)
     return ap
 
@@ -2277,6 +6274,33 @@ def main():
             "TF_RECREATE_MISSING_LAMBDA_PACKAGE", None
         ),
         log_level=os.environ.get("TF_LAMBDA_PACKAGE_LOG_LEVEL", "INFO"),
+        hash_cache=yesno_bool(os.environ.get("TF_LAMBDA_PACKAGE_HASH_CACHE", False)),
+        hash_workers=os.environ.get("TF_LAMBDA_PACKAGE_HASH_WORKERS", None),
+        hash_tree=yesno_bool(os.environ.get("TF_LAMBDA_PACKAGE_HASH_TREE", False)),
+        hash_git_index=yesno_bool(
+            os.environ.get("TF_LAMBDA_PACKAGE_HASH_GIT_INDEX", False)
+        ),
+        manifest=yesno_bool(os.environ.get("TF_LAMBDA_PACKAGE_MANIFEST", False)),
+        zip_workers=os.environ.get("TF_LAMBDA_PACKAGE_ZIP_WORKERS"),
+        zip_cache=yesno_bool(os.environ.get("TF_LAMBDA_PACKAGE_ZIP_CACHE", False)),
+        zip_cache_size=os.environ.get("TF_LAMBDA_PACKAGE_ZIP_CACHE_SIZE", 1024),
+        zip_incremental=yesno_bool(
+            os.environ.get("TF_LAMBDA_PACKAGE_ZIP_INCREMENTAL", False)
+        ),
+        size_report=yesno_bool(os.environ.get("TF_LAMBDA_PACKAGE_SIZE_REPORT", False)),
+        max_unzipped_size=os.environ.get("TF_LAMBDA_PACKAGE_MAX_UNZIPPED_SIZE"),
+        max_zipped_size=os.environ.get("TF_LAMBDA_PACKAGE_MAX_ZIPPED_SIZE"),
+        import_profile=yesno_bool(
+            os.environ.get("TF_LAMBDA_PACKAGE_IMPORT_PROFILE", False)
+        ),
+        import_budget=os.environ.get("TF_LAMBDA_PACKAGE_IMPORT_BUDGET"),
+        install_workers=os.environ.get("TF_LAMBDA_PACKAGE_INSTALL_WORKERS"),
+        dep_cache=yesno_bool(os.environ.get("TF_LAMBDA_PACKAGE_DEP_CACHE", False)),
+        dep_cache_size=os.environ.get("TF_LAMBDA_PACKAGE_DEP_CACHE_SIZE", 4096),
+        wheelhouse=os.environ.get("TF_LAMBDA_PACKAGE_WHEELHOUSE"),
+        installer=os.environ.get("TF_LAMBDA_PACKAGE_INSTALLER"),
+        daemon_socket=os.environ.get("TF_LAMBDA_PACKAGE_DAEMON_SOCKET")
+        or (None if WINDOWS else DigestDaemon.default_socket_path()),
     )
 
     p = args_parser()
@@ -18,6 +18,7 @@ data "external" "archive_prepare" {
 
     docker = var.build_in_docker ? jsonencode({
       docker_pip_cache          = var.docker_pip_cache
+      docker_uv_cache           = var.docker_uv_cache
       docker_build_root         = var.docker_build_root
       docker_file               = var.docker_file
       docker_image              = var.docker_image
@@ -28,8 +29,11 @@ data "external" "archive_prepare" {
 
     artifacts_dir = var.artifacts_dir
     runtime       = var.runtime
+    handler       = var.handler
+    architecture  = try(var.architectures[0], null)
     source_path   = try(tostring(var.source_path), jsonencode(var.source_path))
     hash_extra    = var.hash_extra
+    hash_workers  = var.hash_workers
     # Include into the hash the module sources that affect the packaging.
     hash_internal = jsonencode([filesha256("${path.module}/package.py")])
 
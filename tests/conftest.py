@@ -0,0 +1,43 @@
+import os
+from unittest.mock import Mock
+
+import pytest
+
+
+@pytest.fixture
+def make_query(tmp_path):
+    """
+    Returns a factory of query mocks of a local build, with attributes
+    overridden by keyword arguments.
+    """
+
+    def make_query(**attrs):
+        defaults = {
+            "docker": None,
+            "quiet": True,
+            "manifest": None,
+            "installer": None,
+            "architecture": None,
+            "temp_dir": str(tmp_path),
+        }
+        defaults.update(attrs)
+        return Mock(**defaults)
+
+    return make_query
+
+
+@pytest.fixture
+def make_tree():
+    """
+    Returns a function writing files of a {relative path: content} dict
+    under a root directory.
+    """
+
+    def make_tree(root, files):
+        for name, content in files.items():
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+
+    return make_tree
@@ -0,0 +1,113 @@
+import importlib.util
+import marshal
+import os
+import sys
+from contextlib import contextmanager
+from unittest.mock import Mock
+
+import pytest
+
+import package
+from package import BuildPlanManager, bytecode_optimization_levels, compile_bytecode
+
+
+def make_site_packages(path):
+    (path / "pkg").mkdir(parents=True)
+    (path / "pkg" / "__init__.py").write_text("VALUE = 1\n")
+    (path / "pkg" / "mod.py").write_text("def f():\n    assert True\n")
+    return path
+
+
+def read_pycs(path):
+    pycs = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(".pyc"):
+                full = os.path.join(root, name)
+                with open(full, "rb") as f:
+                    pycs[os.path.relpath(full, path)] = f.read()
+    return pycs
+
+
+def test_compile_bytecode_is_reproducible(tmp_path, make_query):
+    a = make_site_packages(tmp_path / "a")
+    b = make_site_packages(tmp_path / "b")
+    compile_bytecode(make_query(), str(a), sys.executable, True)
+    compile_bytecode(make_query(), str(b), sys.executable, True)
+
+    pycs = read_pycs(a)
+    tag = sys.implementation.cache_tag
+    assert sorted(pycs) == [
+        os.path.join("pkg", "__pycache__", "__init__.{}.pyc".format(tag)),
+        os.path.join("pkg", "__pycache__", "mod.{}.pyc".format(tag)),
+    ]
+    assert pycs == read_pycs(b)
+    for data in pycs.values():
+        assert data[:4] == importlib.util.MAGIC_NUMBER
+        # Hash-based and not checked against sources
+        assert int.from_bytes(data[4:8], "little") == 0b01
+
+
+def test_compile_bytecode_optimization_levels(tmp_path, make_query):
+    path = make_site_packages(tmp_path / "site")
+    compile_bytecode(make_query(), str(path), sys.executable, {"optimize": [1, 2]})
+
+    names = sorted(os.path.basename(p) for p in read_pycs(path))
+    tag = sys.implementation.cache_tag
+    assert names == [
+        "__init__.{}.opt-1.pyc".format(tag),
+        "__init__.{}.opt-2.pyc".format(tag),
+        "mod.{}.opt-1.pyc".format(tag),
+        "mod.{}.opt-2.pyc".format(tag),
+    ]
+
+
+@pytest.mark.parametrize(
+    "prefix, dest_dir",
+    [
+        (None, "/var/task"),
+        ("python", "/var/task/python"),
+        ("./vendor/", "/var/task/vendor"),
+    ],
+)
+def test_compile_bytecode_source_paths(tmp_path, prefix, dest_dir, make_query):
+    path = make_site_packages(tmp_path / "site")
+    compile_bytecode(make_query(), str(path), sys.executable, True, prefix)
+
+    tag = sys.implementation.cache_tag
+    pyc = os.path.join("pkg", "__pycache__", "mod.{}.pyc".format(tag))
+    code = marshal.loads(read_pycs(path)[pyc][16:])
+    assert code.co_filename == dest_dir + "/pkg/mod.py"
+
+
+@pytest.mark.parametrize(
+    "config", [False, "yes", {"optimize": 3}, {"optimize": []}, {"level": 1}]
+)
+def test_bytecode_invalid_config(config):
+    with pytest.raises(ValueError):
+        bytecode_optimization_levels(config)
+
+
+def test_execute_compiles_installed_requirements(tmp_path, monkeypatch, make_query):
+    site = make_site_packages(tmp_path / "site")
+
+    @contextmanager
+    def install_pip_requirements(query, requirements_file, tmp_dir, installer=None):
+        yield str(site)
+
+    monkeypatch.setattr(package, "install_pip_requirements", install_pip_requirements)
+    zs = Mock()
+    bpm = BuildPlanManager(args=Mock())
+    bpm.execute(
+        build_plan=[
+            [
+                ["set:bytecode", True],
+                ["pip", sys.executable, "requirements.txt", None, None],
+            ]
+        ],
+        zip_stream=zs,
+        query=make_query(),
+    )
+
+    assert len(read_pycs(site)) == 2
+    zs.write_dirs.assert_called_once()
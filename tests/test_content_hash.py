@@ -0,0 +1,186 @@
+import logging
+import os
+import shutil
+import subprocess
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from package import (
+    FileDigestCache,
+    GitIndexDigests,
+    MerkleDigestTree,
+    generate_content_hash,
+)
+
+
+log = logging.getLogger("test")
+
+
+def later():
+    # Move the clock forward so fresh files are out of the racy window
+    return patch("package.time.time", return_value=time.time() + 60)
+
+
+def content_hash(source_path, digest_cache=None):
+    return generate_content_hash(
+        [(source_path, None, None)], log=log, digest_cache=digest_cache
+    ).hexdigest()
+
+
+def test_digest_cache_keeps_hash(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"a.py": "a", "lib/b.py": "b"})
+    cache_file = str(tmp_path / "cache.json")
+
+    expected = content_hash(src)
+
+    cache = FileDigestCache(cache_file, log=log).load()
+    with later():
+        assert content_hash(src, cache) == expected
+    cache.save()
+
+    cache = FileDigestCache(cache_file, log=log).load()
+    with patch("package.open", side_effect=AssertionError, create=True):
+        assert content_hash(src, cache) == expected
+
+
+def test_digest_cache_invalidated_on_stat_mismatch(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"a.py": "a"})
+    cache_file = str(tmp_path / "cache.json")
+
+    cache = FileDigestCache(cache_file, log=log).load()
+    with later():
+        content_hash(src, cache)
+    cache.save()
+
+    make_tree(src, {"a.py": "changed"})
+    expected = content_hash(src)
+
+    cache = FileDigestCache(cache_file, log=log).load()
+    assert content_hash(src, cache) == expected
+
+
+def test_digest_cache_skips_racy_files(tmp_path):
+    cache = FileDigestCache(str(tmp_path / "cache.json"), log=log)
+    st = Mock(st_size=1, st_mtime_ns=10**30, st_ino=1, st_ctime_ns=10**30)
+    cache.put("a.py", st, b"digest")
+    assert cache.get("a.py", st) is None
+
+
+def test_threaded_hash_matches_serial(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"{}/{}.py".format(i % 3, i): str(i) for i in range(20)})
+
+    expected = content_hash(src)
+    threaded = generate_content_hash(
+        [(src, None, None)], log=log, workers=4
+    ).hexdigest()
+    assert threaded == expected
+
+
+def test_merkle_tree_reports_changed_subtrees(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"a.py": "a", "lib/b.py": "b", "lib/sub/c.py": "c"})
+    cache_file = str(tmp_path / "tree.json")
+
+    tree = MerkleDigestTree(cache_file, log=log).load()
+    expected = content_hash(src, tree)
+    assert tree.changed_subtrees() == []
+    assert set(tree.subtree_digests()) == {
+        src,
+        os.path.join(src, "lib"),
+        os.path.join(src, "lib", "sub"),
+    }
+    tree.save()
+
+    tree = MerkleDigestTree(cache_file, log=log).load()
+    assert content_hash(src, tree) == expected
+    assert tree.changed_subtrees() == []
+
+    make_tree(src, {"lib/sub/c.py": "changed"})
+    tree = MerkleDigestTree(cache_file, log=log).load()
+    content_hash(src, tree)
+    assert tree.changed_subtrees() == [os.path.join(src, "lib", "sub")]
+
+
+def git(cwd, *args):
+    return subprocess.check_output(["git", *args], cwd=cwd).decode().strip()
+
+
+@pytest.mark.skipif(not shutil.which("git"), reason="git is not installed")
+@pytest.mark.parametrize("index_version", ["2", "3", "4"])
+def test_git_index_digests(tmp_path, index_version, make_tree):
+    src = str(tmp_path / "repo" / "src")
+    make_tree(src, {"a.py": "a", "lib/b.py": "b", "lib/c.py": "c"})
+    for name in ("a.py", "lib/b.py", "lib/c.py"):
+        os.utime(os.path.join(src, name), (1, 1))
+    repo = str(tmp_path / "repo")
+    git(repo, "init", "-q")
+    git(repo, "add", ".")
+    git(repo, "update-index", "--index-version", index_version)
+    make_tree(src, {"lib/c.py": "modified", "untracked.py": "u"})
+
+    expected = content_hash(src)
+
+    digests = GitIndexDigests(log=log)
+    assert digests.get(os.path.join(src, "a.py"), os.stat(os.path.join(src, "a.py")))
+    assert not digests.get(
+        os.path.join(src, "lib/c.py"), os.stat(os.path.join(src, "lib/c.py"))
+    )
+
+    hashed = []
+    real_open = open
+
+    def tracking_open(file, *args, **kwargs):
+        hashed.append(os.path.relpath(file, src))
+        return real_open(file, *args, **kwargs)
+
+    with patch("package.open", side_effect=tracking_open, create=True):
+        assert content_hash(src, digests) != expected
+    assert sorted(hashed) == ["lib/c.py", "untracked.py"]
+
+    # Same content gives the same hash whether it's taken from the index or not
+    os.remove(os.path.join(repo, ".git", "index"))
+    assert content_hash(src, GitIndexDigests(log=log)) == content_hash(src, digests)
+
+
+def test_overlapping_source_paths_read_once(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"a.py": "a", "lib/b.py": "b"})
+    source_paths = [
+        (src, None, None),
+        (os.path.join(src, "lib"), None, None),
+        (os.path.join(src, "lib", "b.py"), None, None),
+    ]
+
+    opened = []
+    real_open = open
+
+    def tracking_open(file, *args, **kwargs):
+        opened.append(file)
+        return real_open(file, *args, **kwargs)
+
+    with patch("package.open", side_effect=tracking_open, create=True):
+        generate_content_hash(source_paths, log=log, workers=4)
+    assert len(opened) == 2
+
+
+def test_digest_cache_keeps_hardlinked_files(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"a.py": "a"})
+    os.link(os.path.join(src, "a.py"), os.path.join(src, "b.py"))
+    cache_file = str(tmp_path / "cache.json")
+
+    cache = FileDigestCache(cache_file, log=log).load()
+    with later():
+        content_hash(src, cache)
+    cache.save()
+
+    cache = FileDigestCache(cache_file, log=log).load()
+    assert sorted(os.path.basename(p) for p, _ in cache.entries(src)) == [
+        "a.py",
+        "b.py",
+    ]
@@ -0,0 +1,144 @@
+import logging
+import os
+import platform
+import socket
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from package import (
+    DaemonDigests,
+    DigestDaemon,
+    FileDigestCache,
+    generate_content_hash,
+)
+
+
+pytestmark = pytest.mark.skipif(
+    platform.system() != "Linux", reason="inotify is available only on Linux"
+)
+
+log = logging.getLogger("test")
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    daemon = DigestDaemon(str(tmp_path / "daemon.sock"), log=log)
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    for _ in range(500):
+        if os.path.exists(daemon.socket_path):
+            break
+        time.sleep(0.01)
+    yield daemon
+    daemon.stop()
+    thread.join()
+
+
+def test_daemon_serves_current_digests(tmp_path, daemon):
+    src = str(tmp_path / "src")
+    write(os.path.join(src, "a.py"), "a")
+    write(os.path.join(src, "lib", "b.py"), "b")
+    source_paths = [(src, None, None)]
+
+    # Move the clock forward so fresh files are out of the racy window
+    with patch("package.time.time", return_value=time.time() + 60):
+        served = DaemonDigests.connect(daemon.socket_path, [src], log=log)
+        assert sorted(os.path.relpath(p, src) for p in served._digests) == [
+            "a.py",
+            os.path.join("lib", "b.py"),
+        ]
+        expected = generate_content_hash(source_paths, log=log).hexdigest()
+        with patch("package.open", side_effect=AssertionError, create=True):
+            hashed = generate_content_hash(source_paths, log=log, digest_cache=served)
+        assert hashed.hexdigest() == expected
+
+        write(os.path.join(src, "lib", "c.py"), "c")
+        write(os.path.join(src, "a.py"), "changed")
+        time.sleep(0.2)
+        served = DaemonDigests.connect(daemon.socket_path, [src], log=log)
+        assert len(served._digests) == 3
+        expected = generate_content_hash(source_paths, log=log).hexdigest()
+        with patch("package.open", side_effect=AssertionError, create=True):
+            hashed = generate_content_hash(source_paths, log=log, digest_cache=served)
+        assert hashed.hexdigest() == expected
+
+
+def test_daemon_digests_are_kept_in_fallback_cache(tmp_path, daemon):
+    src = str(tmp_path / "src")
+    write(os.path.join(src, "a.py"), "a")
+    write(os.path.join(src, "lib", "b.py"), "b")
+    cache_file = str(tmp_path / "cache.json")
+
+    with patch("package.time.time", return_value=time.time() + 60):
+        fallback = FileDigestCache(cache_file, log=log)
+        served = DaemonDigests.connect(
+            daemon.socket_path, [src], fallback=fallback, log=log
+        )
+        generate_content_hash([(src, None, None)], log=log, digest_cache=served)
+        fallback.save()
+
+    saved = FileDigestCache(cache_file, log=log).load()
+    assert sorted(os.path.relpath(p, src) for p, _ in saved.entries(src)) == [
+        "a.py",
+        os.path.join("lib", "b.py"),
+    ]
+
+
+def test_daemon_replies_before_tree_is_hashed(tmp_path, daemon):
+    src = str(tmp_path / "src")
+    write(os.path.join(src, "a.py"), "a")
+    write(os.path.join(src, "lib", "b.py"), "b")
+    source_paths = [(src, None, None)]
+    daemon.reply_time = 0
+
+    with patch("package.time.time", return_value=time.time() + 60):
+        served = DaemonDigests.connect(daemon.socket_path, [src], log=log)
+        assert served._digests == {}
+        expected = generate_content_hash(source_paths, log=log).hexdigest()
+        hashed = generate_content_hash(source_paths, log=log, digest_cache=served)
+        assert hashed.hexdigest() == expected
+
+        # The tree is hashed in the background
+        for _ in range(500):
+            served = DaemonDigests.connect(daemon.socket_path, [src], log=log)
+            if len(served._digests) == 2:
+                break
+            time.sleep(0.01)
+        assert len(served._digests) == 2
+
+
+def test_daemon_timeout_falls_back(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / "daemon.sock")
+    monkeypatch.setattr(DaemonDigests, "timeout", 0.1)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        server.listen()
+        # A daemon which is too busy to reply
+        assert DaemonDigests.connect(socket_path, [str(tmp_path)], log=log) is None
+
+
+def test_daemon_watch_skips_symlink_loops(tmp_path):
+    src = tmp_path / "src"
+    write(str(src / "a" / "a.py"), "a")
+    os.symlink("..", src / "a" / "loop")
+
+    daemon = DigestDaemon(str(tmp_path / "daemon.sock"), log=log)
+    try:
+        daemon.watch(str(src))
+        assert sorted(daemon._watched) == [str(src), str(src / "a")]
+        assert daemon._dirty == {str(src / "a" / "a.py")}
+    finally:
+        daemon._inotify.close()
+
+
+def test_no_daemon_falls_back(tmp_path):
+    assert DaemonDigests.connect(str(tmp_path / "none.sock"), [str(tmp_path)]) is None
@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+import sys
+from contextlib import contextmanager
+from unittest.mock import Mock
+
+import pytest
+
+import package
+from package import BuildPlanManager, DependencyCache, link_tree
+
+
+def fake_installer(monkeypatch, tmp_path, calls):
+    @contextmanager
+    def install_pip_requirements(query, requirements_file, tmp_dir, installer=None):
+        calls.append(requirements_file)
+        site = tmp_path / "installed-{}".format(len(calls))
+        (site / "pkg").mkdir(parents=True)
+        (site / "pkg" / "__init__.py").write_text("VALUE = 1\n")
+        (site / "pkg" / "data.bin").write_bytes(b"x" * 100)
+        yield str(site)
+
+    monkeypatch.setattr(package, "install_pip_requirements", install_pip_requirements)
+
+
+def run_plan(query, dep_cache, requirements, tmp_path):
+    zs = Mock()
+    trees = []
+    zs.write_dirs.side_effect = lambda *paths, **kwargs: trees.append(
+        sorted(
+            os.path.relpath(os.path.join(root, name), paths[0])
+            for root, _, files in os.walk(paths[0])
+            for name in files
+        )
+    )
+    BuildPlanManager(args=Mock()).execute(
+        build_plan=[
+            [["pip", sys.executable, str(requirements), None, str(tmp_path)]],
+        ],
+        zip_stream=zs,
+        query=query,
+        dep_cache=dep_cache,
+    )
+    return trees
+
+
+def test_dep_cache_hit(tmp_path, monkeypatch, make_query):
+    calls = []
+    fake_installer(monkeypatch, tmp_path, calls)
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("requests==2.32.3\n")
+    cache = DependencyCache(str(tmp_path / "cache"), 1024 * 1024)
+
+    first = run_plan(make_query(), cache, requirements, tmp_path)
+    second = run_plan(make_query(), cache, requirements, tmp_path)
+
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert first == second == [["pkg/__init__.py", "pkg/data.bin"]]
+
+    requirements.write_text("requests==2.32.4\n")
+    run_plan(make_query(), cache, requirements, tmp_path)
+    assert len(calls) == 2
+
+
+def test_dep_cache_disabled_for_local_requirements(tmp_path, monkeypatch, make_query):
+    calls = []
+    fake_installer(monkeypatch, tmp_path, calls)
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("-e ./lib\n")
+    cache = DependencyCache(str(tmp_path / "cache"), 1024 * 1024)
+
+    run_plan(make_query(), cache, requirements, tmp_path)
+    run_plan(make_query(), cache, requirements, tmp_path)
+
+    assert len(calls) == 2
+    assert not os.path.exists(cache.directory)
+
+
+def test_dep_cache_key(tmp_path, make_query):
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / "pyproject.toml").write_text("[project]\nname = 'app'\n")
+    cache = DependencyCache(str(tmp_path / "cache"), 0)
+    query = make_query()
+
+    # Without a lock file dependencies are resolved on every install
+    assert (
+        cache.key(query, ["uv", "python3.12", str(project), None, None, None]) is None
+    )
+
+    (project / "uv.lock").write_text('[[package]]\nname = "app"\n')
+    key = cache.key(query, ["uv", "python3.12", str(project), None, None, None])
+    assert key
+    assert key != cache.key(query, ["uv", "python3.13", str(project), None, None, None])
+    assert key != cache.key(
+        query, ["uv", "python3.12", str(project), ["--extra", "s3"], None, None]
+    )
+
+    arm64_query = make_query(architecture="arm64")
+    action = ["uv", "python3.12", str(project), None, None, None]
+    assert cache.key(query, action, "uv") != cache.key(arm64_query, action, "uv")
+
+    (project / "uv.lock").write_text('source = { directory = "../lib" }\n')
+    assert (
+        cache.key(query, ["uv", "python3.12", str(project), None, None, None]) is None
+    )
+
+
+def test_dep_cache_evict(tmp_path):
+    cache = DependencyCache(str(tmp_path / "cache"), 250)
+    for i, key in enumerate(["a", "b", "c"]):
+        tree = tmp_path / key
+        tree.mkdir()
+        (tree / "file").write_bytes(b"x" * 100)
+        cache.put(key, str(tree))
+        os.utime(os.path.join(cache.directory, key + ".json"), ns=(i, i))
+
+    cache.evict()
+
+    assert sorted(os.listdir(cache.directory)) == ["b", "b.json", "c", "c.json"]
+
+
+def put_tree(cache, tree):
+    cache._log = Mock()
+    for _ in range(20):
+        cache.put("key", tree)
+    # Fails when another process has renamed the same temporary tree
+    sys.exit(1 if cache._log.warning.called else 0)
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_dep_cache_concurrent_puts(tmp_path):
+    tree = tmp_path / "tree"
+    for i in range(50):
+        (tree / "pkg{}".format(i)).mkdir(parents=True)
+        (tree / "pkg{}".format(i) / "__init__.py").write_text("VALUE = 1\n")
+    cache = DependencyCache(str(tmp_path / "cache"), 1024 * 1024)
+    # Main threads of forked builds have the same thread ids
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=put_tree, args=(cache, str(tree))) for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    assert sorted(os.listdir(cache.directory)) == ["key", "key.json"]
+
+
+def test_link_tree(tmp_path):
+    src = tmp_path / "src"
+    (src / "pkg").mkdir(parents=True)
+    (src / "pkg" / "mod.py").write_text("x = 1\n")
+    os.symlink("mod.py", src / "pkg" / "alias.py")
+
+    assert link_tree(str(src), str(tmp_path / "dst")) == 6
+    assert os.path.samefile(src / "pkg" / "mod.py", tmp_path / "dst" / "pkg" / "mod.py")
+    assert os.readlink(tmp_path / "dst" / "pkg" / "alias.py") == "mod.py"
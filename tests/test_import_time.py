@@ -0,0 +1,73 @@
+import os
+import sys
+import zipfile
+
+import pytest
+
+from package import ImportTimeProfiler
+
+IMPORTTIME = """\
+import time: self [us] | cumulative | imported package
+import time:       100 |        100 |   _io
+import time:       200 |        300 | site
+import time:        50 |         50 |       json.decoder
+import time:        30 |         80 |     json
+import time:        10 |         10 |     util
+import time:         5 |         95 |   app.core
+import time:         1 |         96 | app
+"""
+
+
+def make_zip(tmp_path, files):
+    filename = str(tmp_path / "package.zip")
+    with zipfile.ZipFile(filename, "w") as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    return filename
+
+
+def test_parse():
+    imports = ImportTimeProfiler.parse(IMPORTTIME, "app")
+    assert imports == [
+        ("json.decoder", 50, 50, 3),
+        ("json", 30, 80, 2),
+        ("util", 10, 10, 2),
+        ("app.core", 5, 95, 1),
+        ("app", 1, 96, 0),
+    ]
+    assert ImportTimeProfiler.parse(IMPORTTIME, "missing") == []
+
+
+def test_profile(tmp_path, make_query):
+    filename = make_zip(
+        tmp_path,
+        {
+            "index.py": "import slow\ndef handler(event, context): pass\n",
+            "slow/__init__.py": "import time\ntime.sleep(0.05)\n",
+        },
+    )
+    profiler = ImportTimeProfiler(make_query(), filename, "index.handler")
+    assert profiler.profile(sys.executable)
+
+    assert profiler.imports[-1][0] == "index"
+    assert profiler.total_us >= 50000
+    assert profiler.packages()[0][0] == "slow"
+    with open(filename + ".importtime.txt") as f:
+        assert "slow" in f.read()
+
+
+def test_profile_budget(tmp_path, caplog, make_query):
+    filename = make_zip(tmp_path, {"index.py": "import time\ntime.sleep(0.05)\n"})
+    profiler = ImportTimeProfiler(make_query(), filename, "index.handler", budget_ms=10)
+    with pytest.raises(RuntimeError, match="over the budget"):
+        profiler.profile(sys.executable)
+    assert [r.levelname for r in caplog.records if "Import time" in r.message] == [
+        "ERROR"
+    ]
+
+
+def test_profile_import_error(tmp_path, make_query):
+    filename = make_zip(tmp_path, {"index.py": "import missing_module\n"})
+    profiler = ImportTimeProfiler(make_query(), filename, "index.handler")
+    assert not profiler.profile(sys.executable)
+    assert not os.path.exists(filename + ".importtime.txt")
@@ -0,0 +1,164 @@
+import os
+import shutil
+import sys
+from contextlib import contextmanager
+from unittest.mock import Mock
+
+import pytest
+
+import package
+from package import (
+    BuildPlanManager,
+    docker_run_command,
+    docker_uv_cache_dir,
+    install_pip_requirements,
+    installer_backend,
+    pip_install_command,
+    pip_install_shell,
+    uv_link_mode,
+    uv_python_platform,
+)
+
+
+@pytest.mark.parametrize(
+    "runtime, architecture, expected",
+    [
+        ("python3.9", "x86_64", "x86_64-manylinux_2_17"),
+        ("python3.11", "arm64", "aarch64-manylinux_2_17"),
+        ("python3.12", "x86_64", "x86_64-manylinux_2_34"),
+        ("python3.13", "arm64", "aarch64-manylinux_2_34"),
+    ],
+)
+def test_uv_python_platform(runtime, architecture, expected):
+    assert uv_python_platform(runtime, architecture) == expected
+
+
+def test_pip_install_command():
+    assert pip_install_command("pip", "python3.12", "requirements.txt") == [
+        "python3.12",
+        "-m",
+        "pip",
+        "install",
+        "--no-compile",
+        "--prefix=",
+        "--target=.",
+        "--requirement=requirements.txt",
+    ]
+    assert pip_install_command(
+        "uv", "python3.12", "requirements.txt", architecture="arm64", no_deps=True
+    ) == [
+        "uv",
+        "pip",
+        "install",
+        "--no-compile",
+        "--no-deps",
+        "--python=python3.12",
+        "--python-version=3.12",
+        "--python-platform=aarch64-manylinux_2_34",
+        "--target=.",
+        "--requirement=requirements.txt",
+    ]
+
+
+def test_pip_install_shell_falls_back_to_pip():
+    command = pip_install_shell(
+        "uv", "python3.12", "requirements.txt", architecture="x86_64"
+    )
+    assert command.startswith("if command -v uv >/dev/null 2>&1; then uv pip install")
+    assert "; else python3.12 -m pip install " in command
+    assert pip_install_shell("pip", "python3.12", "requirements.txt").startswith(
+        "python3.12 -m pip install"
+    )
+
+
+def test_installer_backend_falls_back_to_pip(monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda _: None)
+    assert installer_backend("uv") == "pip"
+    assert installer_backend("uv", docker=Mock()) == "uv"
+    assert installer_backend(None) == "pip"
+
+
+def test_execute_installer_backends(monkeypatch):
+    installers = []
+
+    @contextmanager
+    def install_pip_requirements(query, requirements_file, tmp_dir, installer=None):
+        installers.append((requirements_file, installer))
+        yield None
+
+    monkeypatch.setattr(package, "install_pip_requirements", install_pip_requirements)
+    query = Mock()
+    query.manifest = None
+    query.installer = None
+    BuildPlanManager(args=Mock()).execute(
+        build_plan=[
+            [["pip", "python3.12", "a.txt", None, None]],
+            [
+                ["set:installer", "uv"],
+                ["pip", "python3.12", "b.txt", None, None],
+            ],
+        ],
+        zip_stream=None,
+        query=query,
+    )
+
+    assert installers == [("a.txt", "pip"), ("b.txt", "uv")]
+
+
+RUNTIME = "python{}.{}".format(*sys.version_info[:2])
+
+
+@pytest.mark.skipif(
+    not (shutil.which("uv") and shutil.which(RUNTIME)),
+    reason="uv or {} are not installed".format(RUNTIME),
+)
+def test_install_with_uv(tmp_path):
+    from test_wheelhouse import make_wheel
+
+    wheelhouse = tmp_path / "wheelhouse"
+    wheelhouse.mkdir()
+    make_wheel(wheelhouse, "tinypkg", "1.0")
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("tinypkg==1.0\n")
+
+    query = Mock()
+    query.runtime = RUNTIME
+    query.docker = None
+    query.quiet = True
+    query.architecture = "x86_64"
+    query.wheelhouse = str(wheelhouse)
+    with install_pip_requirements(
+        query, str(requirements), str(tmp_path), installer="uv"
+    ) as path:
+        assert os.path.isfile(os.path.join(path, "tinypkg", "__init__.py"))
+
+
+def test_docker_uv_cache_dir(tmp_path):
+    docker = Mock()
+    docker.docker_uv_cache = None
+    assert docker_uv_cache_dir(docker, "builds") is None
+    docker.docker_uv_cache = True
+    assert docker_uv_cache_dir(docker, "builds") == os.path.abspath("builds/cache/uv")
+    docker.docker_uv_cache = str(tmp_path / "uv")
+    assert docker_uv_cache_dir(docker, "builds") == str(tmp_path / "uv")
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="docker builds run on Linux")
+def test_docker_run_command_uv_cache(tmp_path):
+    cache_dir = tmp_path / "uv"
+    docker_cmd = docker_run_command(
+        str(tmp_path), ["true"], "python3.12", uv_cache_dir=str(cache_dir)
+    )
+
+    assert cache_dir.is_dir()
+    assert "{}:/root/.cache/uv:z".format(cache_dir) in docker_cmd
+    assert "UV_CACHE_DIR=/root/.cache/uv" in docker_cmd
+    assert "UV_LINK_MODE=copy" in docker_cmd
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="links files on Linux")
+def test_uv_link_mode(tmp_path):
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "target").mkdir()
+    assert uv_link_mode(str(tmp_path / "cache"), str(tmp_path / "target")) == "hardlink"
+    assert uv_link_mode(str(tmp_path / "missing"), str(tmp_path / "target")) is None
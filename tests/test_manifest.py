@@ -0,0 +1,130 @@
+import hashlib
+import logging
+import os
+import stat
+import zipfile
+from unittest.mock import Mock
+
+from pytest import raises
+
+from package import BuildPlanManager, ZipWriteStream, datatree, file_matches_digest
+
+
+log = logging.getLogger("test")
+
+
+def prepare(source_path):
+    query = Mock(runtime="python3.12", docker=None)
+    bpm = BuildPlanManager(args=Mock(pattern_comments=False), log=log)
+    build_plan = bpm.plan(source_path, query, log)
+    bpm.hash()
+    return bpm, build_plan
+
+
+def build(tmp_path, source_path, name, manifest=None):
+    bpm, build_plan = prepare(source_path)
+    mtimes = None
+    if manifest is None:
+        manifest, mtimes = bpm.manifest()
+
+    filename = str(tmp_path / name)
+    with ZipWriteStream(filename, quiet=True) as zs:
+        bpm.execute(
+            build_plan,
+            zs,
+            datatree("build_query", manifest=manifest),
+            manifest_mtimes=mtimes,
+        )
+    return filename, manifest
+
+
+def test_manifest_build_matches_walk(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"index.py": "a", "lib/b.py": "b", "lib/c/d.txt": "d"})
+    source_path = [src, {"path": src, "prefix_in_zip": "p", "patterns": ["!.*txt"]}]
+
+    filename, manifest = build(tmp_path, source_path, "manifest.zip")
+    assert sorted(manifest) == ["0.0", "1.1"]
+    assert [e[0] for e in manifest["1.1"]["files"]] == [
+        "index.py",
+        "lib",
+        "lib/b.py",
+        "lib/c",
+    ]
+    assert manifest["1.1"]["dirs"] == [".", "lib", "lib/c"]
+    assert all(e[3] for e in manifest["0.0"]["files"] if stat.S_ISREG(e[2]))
+
+    expected, _ = build(tmp_path, source_path, "walk.zip", manifest={})
+    with open(filename, "rb") as f1, open(expected, "rb") as f2:
+        assert f1.read() == f2.read()
+    with zipfile.ZipFile(filename) as zf:
+        assert "p/lib/b.py" in zf.namelist()
+
+
+def test_manifest_build_fails_on_changed_file(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"index.py": "a"})
+    bpm, build_plan = prepare(src)
+    manifest, mtimes = bpm.manifest()
+
+    make_tree(src, {"index.py": "b"})
+    zs = Mock()
+    with raises(RuntimeError, match="has been changed.*index.py"):
+        bpm.execute(
+            build_plan,
+            zs,
+            datatree("build_query", manifest=manifest),
+            manifest_mtimes=mtimes,
+        )
+    zs.write_manifest.assert_not_called()
+
+
+def test_manifest_build_checks_digests_of_touched_files(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"index.py": "a", "lib/b.py": "b"})
+    bpm, build_plan = prepare(src)
+    manifest, _ = bpm.manifest()
+
+    # A saved plan applied in a fresh checkout
+    for path in ("index.py", "lib/b.py", "lib", "."):
+        os.utime(os.path.join(src, path), ns=(10**9, 10**9))
+    filename = str(tmp_path / "out.zip")
+    with ZipWriteStream(filename, quiet=True) as zs:
+        bpm.execute(build_plan, zs, datatree("build_query", manifest=manifest))
+    with zipfile.ZipFile(filename) as zf:
+        assert zf.read("lib/b.py") == b"b"
+
+
+def test_manifest_build_fails_on_new_file_before_writing(tmp_path, make_tree):
+    src = str(tmp_path / "src")
+    make_tree(src, {"index.py": "a", "lib/b.py": "b"})
+    source_path = [{"path": src, "patterns": ["!.*__pycache__.*"]}]
+    bpm, build_plan = prepare(source_path)
+    manifest, mtimes = bpm.manifest()
+
+    lib = os.path.join(src, "lib")
+    mtime_ns = os.stat(lib).st_mtime_ns
+    make_tree(src, {"lib/__pycache__/b.pyc": "pyc"})
+    # Make sure the mtime is changed on filesystems with a coarse resolution
+    os.utime(lib, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    query = datatree("build_query", manifest=manifest)
+    zs = Mock()
+    bpm.execute(build_plan, zs, query, manifest_mtimes=mtimes)
+    zs.write_manifest.assert_called_once()
+
+    make_tree(src, {"lib/new.py": "new"})
+    zs = Mock()
+    with raises(RuntimeError, match="has been added.*new.py"):
+        bpm.execute(build_plan, zs, query, manifest_mtimes=mtimes)
+    zs.write_manifest.assert_not_called()
+
+
+def test_file_matches_digest(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"abc")
+    st = os.stat(path)
+
+    assert file_matches_digest(str(path), st, hashlib.sha256(b"abc").hexdigest())
+    assert file_matches_digest(str(path), st, hashlib.sha1(b"blob 3\0abc").hexdigest())
+    assert not file_matches_digest(str(path), st, hashlib.sha256(b"abd").hexdigest())
+    assert not file_matches_digest(str(path), st, None)
@@ -0,0 +1,103 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from package import DependencyPruner, elf_debug_size
+
+
+@pytest.fixture
+def site_packages(tmp_path):
+    site = tmp_path / "site"
+    for path, content in [
+        ("pkg/__init__.py", "import pkg.core\n"),
+        ("pkg/core.py", "VALUE = 1\n"),
+        ("pkg/core.pyi", "VALUE: int\n"),
+        ("pkg/py.typed", ""),
+        ("pkg/_speedups.c", "int f(void) { return 1; }\n"),
+        ("pkg/tests/__init__.py", ""),
+        ("pkg/tests/test_core.py", "def test(): pass\n" * 10),
+        ("pkg/__pycache__/core.cpython-312.pyc", "x" * 10),
+        ("pkg/docs/index.rst", "docs\n"),
+        ("pkg-1.0.dist-info/METADATA", "Name: pkg\n"),
+        ("pkg-1.0.dist-info/RECORD", "pkg/__init__.py,,\n"),
+        ("pkg-1.0.dist-info/INSTALLER", "pip\n"),
+        ("tests/conftest.py", ""),
+    ]:
+        (site / path).parent.mkdir(parents=True, exist_ok=True)
+        (site / path).write_text(content)
+    return site
+
+
+def list_tree(path):
+    return sorted(
+        os.path.relpath(os.path.join(root, name), path)
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def test_prune_default_rules(site_packages, make_query):
+    pruner = DependencyPruner()
+    pruner.prune(make_query(), str(site_packages), "python3.12")
+
+    assert list_tree(site_packages) == [
+        "pkg-1.0.dist-info/METADATA",
+        "pkg/__init__.py",
+        "pkg/core.py",
+        "pkg/docs/index.rst",
+        "tests/conftest.py",
+    ]
+    assert pruner.stats["tests"] == [2, 170]
+    assert pruner.stats["metadata"][0] == 2
+
+
+def test_prune_broken_symlink(site_packages, make_query):
+    os.symlink("/nonexistent", site_packages / "pkg" / "tests" / "broken")
+    pruner = DependencyPruner(rules=["tests"])
+    pruner.prune(make_query(), str(site_packages), "python3.12")
+
+    assert not os.path.lexists(site_packages / "pkg" / "tests")
+    assert pruner.stats["tests"] == [2, 170]
+
+
+def test_prune_dry_run(site_packages, make_query):
+    before = list_tree(site_packages)
+    pruner = DependencyPruner.from_config(
+        {"rules": ["docs"], "patterns": ["*.c"], "keep": ["pkg/docs/"], "dry_run": True}
+    )
+    pruner.prune(make_query(), str(site_packages), "python3.12")
+
+    assert list_tree(site_packages) == before
+    assert pruner.stats == {"patterns": [1, 26]}
+
+
+@pytest.mark.parametrize(
+    "config", [False, "all", {"rules": ["unknown"]}, {"unknown": True}]
+)
+def test_prune_invalid_config(config):
+    with pytest.raises((ValueError, TypeError)):
+        DependencyPruner.from_config(config)
+
+
+@pytest.mark.skipif(
+    not (shutil.which("gcc") and shutil.which("strip")),
+    reason="gcc and strip are not installed",
+)
+def test_prune_strips_shared_objects(tmp_path, make_query):
+    src = tmp_path / "ext.c"
+    src.write_text("int f(int x) { return x * 2; }\n")
+    so = tmp_path / "site" / "ext.cpython-312-x86_64-linux-gnu.so"
+    so.parent.mkdir()
+    subprocess.check_call(["gcc", "-g", "-shared", "-fPIC", "-o", str(so), str(src)])
+    size = so.stat().st_size
+    debug_size = elf_debug_size(str(so))
+    assert debug_size > 0
+    assert elf_debug_size(str(src)) is None
+
+    pruner = DependencyPruner(rules=[], strip=True)
+    pruner.prune(make_query(), str(tmp_path / "site"), "python3.12")
+
+    assert elf_debug_size(str(so)) == 0
+    assert pruner.stats["strip"] == [1, size - so.stat().st_size]
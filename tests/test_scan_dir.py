@@ -0,0 +1,152 @@
+import logging
+import os
+import stat
+import zipfile
+from unittest.mock import Mock, patch
+
+import pytest
+
+from package import (
+    BuildPlanManager,
+    ZipContentFilter,
+    ZipWriteStream,
+    datatree,
+    emit_dir_content,
+    generate_content_hash,
+    list_files,
+)
+
+
+log = logging.getLogger("test")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "src"
+    for name in (
+        "a/b/c.txt",
+        "a/z.txt",
+        "a.txt",
+        "a_b/x.py",
+        "A/y.py",
+        "b-c/d.py",
+        "b/d.py",
+        "empty/",
+    ):
+        path = root / name
+        if name.endswith("/"):
+            path.mkdir(parents=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+    os.symlink("a", str(root / "link"))
+    os.symlink("missing", str(root / "broken"))
+    return str(root)
+
+
+def walk_dir_content(base_dir):
+    # The os.walk based implementation used before
+    for root, dirs, files in os.walk(base_dir, followlinks=True):
+        dirs.sort()
+        files.sort()
+        if root != base_dir:
+            yield os.path.normpath(root)
+        for name in files:
+            yield os.path.normpath(os.path.join(root, name))
+
+
+def walk_files(top_path):
+    results = []
+    for root, dirs, files in os.walk(top_path, followlinks=True):
+        dirs.sort()
+        files.sort()
+        for name in files:
+            results.append(os.path.relpath(os.path.join(root, name), top_path))
+    return sorted(results)
+
+
+def test_order_is_the_same_as_os_walk(tree):
+    assert list(emit_dir_content(tree)) == list(walk_dir_content(tree))
+    assert list_files(tree) == walk_files(tree)
+
+
+def test_filter_order_is_the_same_as_os_walk(tree):
+    pf = ZipContentFilter(args=Mock(pattern_comments=False))
+    pf.compile([".*", "!a/z\\.txt"])
+    expected = [
+        p for p in walk_dir_content(tree) if p != os.path.join(tree, "a", "z.txt")
+    ]
+    assert list(pf.filter(tree)) == expected
+
+
+def test_files_are_stat_once(tmp_path, tree):
+    expected = generate_content_hash([(tree, None, None)], log=log).hexdigest()
+    os_stat = os.stat
+    stat_calls = []
+
+    def counting_stat(path, *args, **kwargs):
+        stat_calls.append(path)
+        return os_stat(path, *args, **kwargs)
+
+    with patch("os.stat", side_effect=counting_stat):
+        actual = generate_content_hash([(tree, None, None)], log=log).hexdigest()
+        os.unlink(os.path.join(tree, "broken"))
+        with ZipWriteStream(str(tmp_path / "out.zip"), quiet=True) as zs:
+            zs.write_dirs(tree)
+    assert actual == expected
+    # DirEntry.stat() results are used for everything in the directory
+    assert not [p for p in stat_calls if p.endswith((".py", ".txt"))]
+
+
+def test_symlink_loops_are_not_walked(tree):
+    os.symlink("..", os.path.join(tree, "a", "b", "up"))
+    paths = [os.path.relpath(p, tree) for p in emit_dir_content(tree)]
+    assert "a/b/up" not in paths
+    assert "link/b/up" not in paths
+    assert list_files(tree) == sorted(
+        ["a.txt", "a/b/c.txt", "a/z.txt", "a_b/x.py", "A/y.py", "b-c/d.py"]
+        + ["b/d.py", "broken", "link/b/c.txt", "link/z.txt"]
+    )
+
+
+def build(tmp_path, source_path, manifest=False):
+    query = Mock(runtime="nodejs20.x", docker=None)
+    bpm = BuildPlanManager(args=Mock(pattern_comments=False), log=log)
+    build_plan = bpm.plan(source_path, query, log)
+    content_hash = bpm.hash().hexdigest()
+
+    filename = str(tmp_path / "out.zip")
+    mtimes = None
+    if manifest:
+        manifest, mtimes = bpm.manifest()
+    query = datatree("build_query", manifest=manifest or None)
+    with ZipWriteStream(filename, quiet=True) as zs:
+        bpm.execute(build_plan, zs, query, manifest_mtimes=mtimes)
+    with zipfile.ZipFile(filename) as zf:
+        members = {
+            i.filename: (i.external_attr >> 16, zf.read(i)) for i in zf.infolist()
+        }
+    return content_hash, members
+
+
+@pytest.mark.parametrize("manifest", [False, True])
+def test_symlinks_are_kept(tmp_path, tree, manifest):
+    os.unlink(os.path.join(tree, "broken"))
+    os.symlink(os.path.join(tree, "a", "z.txt"), os.path.join(tree, "abs"))
+    outside = tmp_path / "outside.txt"
+    outside.write_text("outside")
+    os.symlink(str(outside), os.path.join(tree, "out"))
+
+    followed_hash, followed = build(tmp_path, [{"path": tree}])
+    assert "link/z.txt" in followed
+
+    kept_hash, kept = build(tmp_path, [{"path": tree, "symlinks": True}], manifest)
+    assert kept_hash != followed_hash
+    assert not [name for name in kept if name.startswith("link/")]
+    mode, target = kept["link"]
+    assert stat.S_ISLNK(mode) and target == b"a"
+    mode, target = kept["abs"]
+    assert stat.S_ISLNK(mode) and target == b"a/z.txt"
+    # Symlinks outside of the source path are followed
+    mode, content = kept["out"]
+    assert stat.S_ISREG(mode) and content == b"outside"
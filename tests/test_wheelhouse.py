@@ -0,0 +1,107 @@
+import argparse
+import os
+import sys
+import zipfile
+
+import pytest
+
+import package
+from package import args_parser, install_pip_requirements, wheelhouse_dir
+
+
+def make_wheel(wheelhouse, name, version):
+    dist_info = "{}-{}.dist-info".format(name, version)
+    filename = wheelhouse / "{}-{}-py3-none-any.whl".format(name, version)
+    files = {
+        "{}/__init__.py".format(name): "VERSION = {!r}\n".format(version),
+        "{}/METADATA".format(dist_info): (
+            "Metadata-Version: 2.1\nName: {}\nVersion: {}\n".format(name, version)
+        ),
+        "{}/WHEEL".format(dist_info): (
+            "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\n"
+            "Tag: py3-none-any\n"
+        ),
+    }
+    with zipfile.ZipFile(filename, "w") as zf:
+        for path, content in files.items():
+            zf.writestr(path, content)
+        zf.writestr(
+            "{}/RECORD".format(dist_info),
+            "".join("{},,\n".format(path) for path in files)
+            + "{}/RECORD,,\n".format(dist_info),
+        )
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, None),
+        ("false", None),
+        ("true", os.path.abspath(os.path.join("builds", "wheelhouse"))),
+        ("/tmp/wheels", os.path.abspath("/tmp/wheels")),
+    ],
+)
+def test_wheelhouse_dir(value, expected):
+    assert wheelhouse_dir(value, "builds") == expected
+    assert wheelhouse_dir(value) == expected
+
+
+@pytest.mark.parametrize(
+    "argv, env, expected",
+    [
+        ([], None, os.path.join("builds", "wheelhouse")),
+        ([], "false", os.path.join("builds", "wheelhouse")),
+        ([], "wheels", "wheels"),
+        (["-a", "artifacts"], None, os.path.join("artifacts", "wheelhouse")),
+        (["-a", "artifacts", "-d", "wheels"], "true", "wheels"),
+    ],
+)
+def test_wheelhouse_command_dir(tmp_path, monkeypatch, argv, env, expected):
+    commands = []
+    monkeypatch.setattr(package, "check_call", lambda cmd, **_: commands.append(cmd))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "requirements.txt").write_text("tinypkg==1.0\n")
+
+    args = args_parser().parse_args(
+        ["wheelhouse"] + argv + ["requirements.txt"],
+        namespace=argparse.Namespace(wheelhouse=env),
+    )
+    args.command(args)
+
+    wheel_dir = str(tmp_path / expected)
+    assert os.path.isdir(wheel_dir)
+    assert "--wheel-dir={}".format(wheel_dir) in commands[0]
+    # Where prepare looks for the wheelhouse of the same artifacts dir
+    if env in (None, "false") and "-d" not in argv:
+        assert wheel_dir == wheelhouse_dir("true", args.artifacts_dir)
+
+
+def test_install_from_wheelhouse(tmp_path, make_query):
+    wheelhouse = tmp_path / "wheelhouse"
+    wheelhouse.mkdir()
+    make_wheel(wheelhouse, "tinypkg", "1.0")
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("tinypkg==1.0\n")
+
+    query = make_query(
+        runtime=sys.executable,
+        artifacts_dir=str(tmp_path / "builds"),
+        wheelhouse=str(wheelhouse),
+    )
+    with install_pip_requirements(query, str(requirements), str(tmp_path)) as path:
+        with open(os.path.join(path, "tinypkg", "__init__.py")) as f:
+            assert f.read() == "VERSION = '1.0'\n"
+
+
+def test_install_from_missing_wheelhouse(tmp_path, make_query):
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("tinypkg==1.0\n")
+
+    query = make_query(
+        runtime=sys.executable,
+        artifacts_dir=str(tmp_path / "builds"),
+        wheelhouse=str(tmp_path / "missing"),
+    )
+    with pytest.raises(RuntimeError, match="wheelhouse command"):
+        with install_pip_requirements(query, str(requirements), str(tmp_path)):
+            pass
@@ -1,6 +1,11 @@
 import os
+import threading
+from contextlib import contextmanager
 from unittest.mock import MagicMock, Mock
 
+import pytest
+
+import package
 from package import BuildPlanManager
 
 
@@ -48,3 +53,107 @@ def test_zip_source_path():
 
     zip_source_path = zs.write_dirs.call_args_list[0][0][0]
     assert zip_source_path == f"{os.getcwd()}"
+
+
+def fake_installs(monkeypatch, events, started=None):
+    @contextmanager
+    def install_pip_requirements(query, requirements_file, tmp_dir, installer=None):
+        events.append(("install", requirements_file))
+        if started:
+            started[requirements_file].set()
+        events.append(("installed", requirements_file))
+        try:
+            yield requirements_file
+        finally:
+            events.append(("removed", requirements_file))
+
+    monkeypatch.setattr(package, "install_pip_requirements", install_pip_requirements)
+
+
+def pip_step(name):
+    return [["pip", "python3.12", name, None, None]]
+
+
+@pytest.mark.parametrize("install_workers", [None, 2])
+def test_pipelined_installs(monkeypatch, install_workers):
+    events = []
+    started = {name: threading.Event() for name in "abc"}
+    fake_installs(monkeypatch, events, started=started)
+
+    def write_dirs(rd, **kwargs):
+        if install_workers and rd != "c":
+            # The install of the next step overlaps with zipping of this one
+            assert started[chr(ord(rd) + 1)].wait(timeout=30)
+        events.append(("zip", rd))
+
+    zs = Mock()
+    zs.write_dirs = MagicMock(side_effect=write_dirs)
+    query = Mock()
+    query.manifest = None
+
+    bpm = BuildPlanManager(args=Mock())
+    bpm.execute(
+        build_plan=[pip_step("a"), pip_step("b"), pip_step("c")],
+        zip_stream=zs,
+        query=query,
+        install_workers=install_workers,
+    )
+
+    assert [e for e in events if e[0] == "zip"] == [
+        ("zip", "a"),
+        ("zip", "b"),
+        ("zip", "c"),
+    ]
+    assert sorted(e for e in events if e[0] == "removed") == [
+        ("removed", "a"),
+        ("removed", "b"),
+        ("removed", "c"),
+    ]
+    if not install_workers:
+        # Each install starts after the previous step is zipped
+        assert events.index(("install", "b")) > events.index(("zip", "a"))
+        assert events.index(("install", "c")) > events.index(("zip", "b"))
+
+
+def test_pipelined_installs_wait_for_commands(monkeypatch):
+    events = []
+    fake_installs(monkeypatch, events)
+    query = Mock()
+    query.manifest = None
+
+    bpm = BuildPlanManager(args=Mock())
+    bpm.execute(
+        build_plan=[
+            pip_step("a"),
+            [["sh", "true"]],
+            pip_step("b"),
+        ],
+        zip_stream=Mock(),
+        query=query,
+        install_workers=2,
+    )
+
+    # b is installed only after the commands of the previous step are run
+    assert events.index(("install", "b")) > events.index(("removed", "a"))
+
+
+def test_pipelined_installs_cleanup_on_failure(monkeypatch):
+    events = []
+    fake_installs(monkeypatch, events)
+    zs = Mock()
+    zs.write_dirs = MagicMock(side_effect=RuntimeError("zip failed"))
+    query = Mock()
+    query.manifest = None
+
+    bpm = BuildPlanManager(args=Mock())
+    with pytest.raises(RuntimeError):
+        bpm.execute(
+            build_plan=[pip_step("a"), pip_step("b"), pip_step("c")],
+            zip_stream=zs,
+            query=query,
+            install_workers=2,
+        )
+
+    installed = {e[1] for e in events if e[0] == "installed"}
+    removed = {e[1] for e in events if e[0] == "removed"}
+    assert installed == removed
@@ -0,0 +1,420 @@
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+import zlib
+from unittest.mock import Mock
+
+import pytest
+
+from package import (
+    CompressionPolicy,
+    ZipLineage,
+    ZipWriter,
+    ZipMemberCache,
+    ZipSizeProfiler,
+    ZipWriteStream,
+    file_source_code_hash,
+    source_code_hash,
+)
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    src = tmp_path / "src"
+    (src / "lib" / "empty").mkdir(parents=True)
+    (src / "index.py").write_text("print('hello')\n" * 100)
+    (src / "lib" / "random.bin").write_bytes(os.urandom(300 * 1024))
+    (src / "lib" / "zero.txt").write_bytes(b"")
+    (src / "lib" / "big.txt").write_text("abc" * 200 * 1024)
+    return str(src)
+
+
+def write_zip(path, source_dir, **kwargs):
+    with ZipWriteStream(str(path), quiet=True, timestamp=0, **kwargs) as zs:
+        zs.write_dirs(source_dir)
+    with open(str(path), "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("compresslevel", [None, 1, 9])
+def test_parallel_compression_is_identical(tmp_path, source_dir, compresslevel):
+    serial = write_zip(tmp_path / "serial.zip", source_dir, compresslevel=compresslevel)
+    parallel = write_zip(
+        tmp_path / "parallel.zip",
+        source_dir,
+        compresslevel=compresslevel,
+        workers=4,
+        # Exercise the in-flight budget and the serial path for large files
+        max_inflight_bytes=400 * 1024,
+    )
+    assert parallel == serial
+
+    with zipfile.ZipFile(str(tmp_path / "parallel.zip")) as zf:
+        assert zf.testzip() is None
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+@pytest.mark.parametrize("max_buffered_size", [1024 * 1024, 64 * 1024])
+def test_member_cache_is_identical(
+    tmp_path, source_dir, workers, max_buffered_size, monkeypatch
+):
+    # Larger files are read again to be compressed on cache misses
+    monkeypatch.setattr(ZipWriteStream, "max_buffered_size", max_buffered_size)
+    clean = write_zip(tmp_path / "clean.zip", source_dir)
+
+    cache = ZipMemberCache(str(tmp_path / "cache"), 10 * 1024 * 1024)
+    first = write_zip(
+        tmp_path / "first.zip", source_dir, workers=workers, member_cache=cache
+    )
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    cache = ZipMemberCache(str(tmp_path / "cache"), 10 * 1024 * 1024)
+    second = write_zip(
+        tmp_path / "second.zip", source_dir, workers=workers, member_cache=cache
+    )
+    assert (cache.hits, cache.misses) == (2, 0)
+    assert first == second == clean
+
+
+def test_member_cache_eviction(tmp_path):
+    cache = ZipMemberCache(str(tmp_path / "cache"), 3000)
+    keys = [ZipMemberCache.key(bytes([i]) * 32, zipfile.ZIP_DEFLATED) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, b"x" * 1000, 0, 1000)
+        path = cache._path(key)
+        os.utime(path, ns=(i * 10**9, i * 10**9))
+    assert cache.get(keys[0]) is not None  # The oldest one becomes the newest
+
+    cache.evict()
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
+
+
+def put_member(cache, key, payload):
+    cache._log = Mock()
+    for _ in range(20):
+        cache.put(key, payload, 0, len(payload))
+    # Fails when another process has replaced the same temporary file
+    sys.exit(1 if cache._log.warning.called else 0)
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_member_cache_concurrent_puts(tmp_path):
+    cache = ZipMemberCache(str(tmp_path / "cache"), 10 * 1024 * 1024)
+    key = ZipMemberCache.key(b"x" * 32, zipfile.ZIP_DEFLATED)
+    payload = os.urandom(4 * 1024 * 1024)
+    # Main threads of forked builds have the same thread ids
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=put_member, args=(cache, key, payload)) for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    assert cache.get(key) == (payload, 0, len(payload))
+    assert os.listdir(os.path.dirname(cache._path(key))) == [key]
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+@pytest.mark.parametrize("max_buffered_size", [1024 * 1024, 64 * 1024])
+def test_incremental_build_is_identical(
+    tmp_path, source_dir, workers, max_buffered_size, monkeypatch
+):
+    monkeypatch.setattr(ZipWriteStream, "max_buffered_size", max_buffered_size)
+    lineage = ZipLineage(str(tmp_path / "lineage.json"))
+    write_zip(tmp_path / "base.zip", source_dir, lineage=lineage)
+
+    with open(os.path.join(source_dir, "index.py"), "a") as f:
+        f.write("print('changed')\n")
+    # Same size, but a different content
+    with open(os.path.join(source_dir, "lib", "big.txt"), "r+") as f:
+        f.write("cba")
+
+    clean = write_zip(tmp_path / "clean.zip", source_dir)
+    with ZipWriteStream(
+        str(tmp_path / "next.zip"),
+        quiet=True,
+        timestamp=0,
+        workers=workers,
+        lineage=lineage,
+    ) as zs:
+        zs.write_dirs(source_dir)
+    assert zs.reused == 2  # random.bin and zero.txt
+    assert (tmp_path / "next.zip").read_bytes() == clean
+
+    base_filename, digests = lineage.load(zipfile.ZIP_DEFLATED, None)
+    assert base_filename == str(tmp_path / "next.zip")
+    assert len(digests) == 4
+    assert lineage.load(zipfile.ZIP_DEFLATED, 9) == (None, {})
+
+
+def test_compression_policy(tmp_path, source_dir):
+    with open(os.path.join(source_dir, "lib", "model.onnx"), "wb") as f:
+        f.write(b"\0" * 10000)
+
+    policy = CompressionPolicy.from_config({"level": 1, "stored_extensions": [".ONNX"]})
+    with ZipWriteStream(str(tmp_path / "policy.zip"), quiet=True, timestamp=0) as zs:
+        zs.set_compression_policy(policy)
+        zs.write_dirs(source_dir)
+
+    with zipfile.ZipFile(str(tmp_path / "policy.zip")) as zf:
+        assert zf.testzip() is None
+        methods = {i.filename: i.compress_type for i in zf.infolist()}
+    assert methods["lib/model.onnx"] == zipfile.ZIP_STORED
+    assert methods["lib/random.bin"] == zipfile.ZIP_STORED
+    assert methods["lib/big.txt"] == zipfile.ZIP_DEFLATED
+    assert methods["index.py"] == zipfile.ZIP_DEFLATED
+
+    assert policy.stats["stored_files"] == 2
+    assert policy.stats["stored_bytes"] == 10000 + 300 * 1024
+    # Zeros compress well, random data doesn't
+    assert policy.stats["bytes_added"] > 9000
+
+    with pytest.raises(ValueError):
+        CompressionPolicy.from_config({"levle": 1})
+
+
+@pytest.mark.parametrize("compress_type", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_large_members_are_identical(tmp_path, source_dir, monkeypatch, compress_type):
+    regular = write_zip(
+        tmp_path / "regular.zip", source_dir, compress_type=compress_type
+    )
+
+    monkeypatch.setattr(ZipWriteStream, "large_file_size", 1024)
+    monkeypatch.setattr(ZipWriteStream, "large_chunk_size", 100 * 1024)
+    large = write_zip(tmp_path / "large.zip", source_dir, compress_type=compress_type)
+    assert large == regular
+
+    with zipfile.ZipFile(str(tmp_path / "large.zip")) as zf:
+        assert zf.testzip() is None
+
+
+@pytest.mark.parametrize("large_file_size", [None, 1024])
+@pytest.mark.parametrize("workers", [None, 4])
+@pytest.mark.parametrize("compress_type", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_sha256_sidecar(
+    tmp_path, source_dir, monkeypatch, large_file_size, workers, compress_type
+):
+    if large_file_size:
+        monkeypatch.setattr(ZipWriteStream, "large_file_size", large_file_size)
+    # Spill spooled members to a temporary file
+    monkeypatch.setattr(ZipWriter, "spool_size", 1024)
+    filename = str(tmp_path / "archive.zip")
+    with ZipWriteStream(
+        filename,
+        quiet=True,
+        timestamp=0,
+        workers=workers,
+        compress_type=compress_type,
+    ) as zs:
+        zs.write_dirs(source_dir)
+
+    with open(filename, "rb") as f:
+        data = f.read()
+    with open(filename + ".sha256") as f:
+        sidecar = json.load(f)
+    assert sidecar == {
+        "base64sha256": source_code_hash(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+    assert zs.base64sha256 == sidecar["base64sha256"]
+    with open(filename, "rb") as f:
+        assert file_source_code_hash(f) == sidecar["base64sha256"]
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_size_profiler(tmp_path, source_dir, workers):
+    filename = str(tmp_path / "archive.zip")
+    profiler = ZipSizeProfiler()
+    with ZipWriteStream(
+        filename, quiet=True, workers=workers, size_profiler=profiler
+    ) as zs:
+        zs.set_size_claim("src")
+        zs.write_dirs(source_dir)
+        zs.set_size_claim("layer")
+        zs.write_dirs(os.path.join(source_dir, "lib"), prefix="python")
+
+    with open(filename + ".size.json") as f:
+        report = json.load(f)
+    with zipfile.ZipFile(filename) as zf:
+        infos = zf.infolist()
+    assert report["total"] == {
+        "unzipped": sum(i.file_size for i in infos),
+        "zipped": sum(i.compress_size for i in infos),
+        "files": len(infos),
+    }
+    assert report["archive_size"] == os.path.getsize(filename)
+    claims = {c["name"]: c for c in report["claims"]}
+    assert claims["src"]["files"] == 6
+    assert claims["layer"]["files"] == 4
+    prefixes = [p["name"] for p in report["prefixes"]]
+    assert prefixes == ["", "python"]
+    packages = [p["name"] for p in report["packages"]]
+    assert packages == [
+        "lib",
+        "python/big.txt",
+        "python/random.bin",
+        "index.py",
+        "python/empty",
+        "python/zero.txt",
+    ]
+    with open(filename + ".size.txt") as f:
+        assert "python/random.bin" in f.read()
+
+
+@pytest.mark.parametrize(
+    "budget", [{"max_unzipped_size": 500 * 1024}, {"max_zipped_size": 200 * 1024}]
+)
+def test_size_budget(tmp_path, source_dir, budget):
+    filename = str(tmp_path / "archive.zip")
+    profiler = ZipSizeProfiler(**budget)
+    with pytest.raises(SystemExit):
+        with ZipWriteStream(filename, quiet=True, size_profiler=profiler) as zs:
+            zs.write_dirs(source_dir)
+            zs.write_dirs(source_dir, prefix="copy")
+
+    assert not os.path.exists(filename)
+    assert not os.path.exists(filename + ".tmp")
+    # Stopped before the copy of sources
+    assert profiler.total[2] < 6
+    with open(filename + ".size.json") as f:
+        assert "budget" in json.load(f)["exceeded"]
+
+
+MEMBERS = [
+    ("dir/", None, zipfile.ZIP_STORED),
+    ("dir/stored.txt", b"stored " * 100, zipfile.ZIP_STORED),
+    ("dir/deflated.txt", b"deflated " * 100, zipfile.ZIP_DEFLATED),
+    ("\u00fcnicode.txt", b"", zipfile.ZIP_DEFLATED),
+]
+
+
+def zinfo_for(name, compress_type):
+    zinfo = zipfile.ZipInfo(name, (2020, 1, 2, 3, 4, 6))
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = (0o40755 if name.endswith("/") else 0o100644) << 16
+    return zinfo
+
+
+def write_with_zipfile(fp):
+    with zipfile.ZipFile(fp, "w") as zf:
+        for name, data, compress_type in MEMBERS:
+            zinfo = zinfo_for(name, compress_type)
+            if data is None:
+                zinfo.external_attr |= 0x10
+                zf.writestr(zinfo, b"")
+            else:
+                zinfo.file_size = len(data)
+                with zf.open(zinfo, "w") as f:
+                    f.write(data)
+
+
+def write_with_zip_writer(fp, streamed, hash_obj=None):
+    zw = ZipWriter(fp, hash_obj=hash_obj)
+    for name, data, compress_type in MEMBERS:
+        zinfo = zinfo_for(name, compress_type)
+        if data is None:
+            zinfo.external_attr |= 0x10
+            zw.write_dir(zinfo)
+            continue
+        zinfo.file_size = len(data)
+        payload = data
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+            )
+            payload = compressor.compress(data) + compressor.flush()
+        if streamed:
+            zw.start_member(zinfo)
+            zw.write(payload)
+            zw.end_member(zlib.crc32(data), len(data))
+        else:
+            zw.write_member(zinfo, payload, zlib.crc32(data), len(data))
+    zw.close()
+
+
+class Unseekable(io.RawIOBase):
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+@pytest.mark.parametrize("zip64", [False, True])
+@pytest.mark.parametrize("streamed", [False, True])
+def test_zip_writer_is_identical_to_zipfile(monkeypatch, zip64, streamed):
+    if zip64:
+        # Make every member and the central directory require ZIP64 records
+        monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 100)
+        monkeypatch.setattr(zipfile, "ZIP_FILECOUNT_LIMIT", 1)
+        monkeypatch.setattr(ZipWriter, "zip64_limit", 100)
+        monkeypatch.setattr(ZipWriter, "filecount_limit", 1)
+
+    expected = io.BytesIO()
+    write_with_zipfile(expected)
+    actual = io.BytesIO()
+    write_with_zip_writer(actual, streamed)
+    assert actual.getvalue() == expected.getvalue()
+
+
+@pytest.mark.parametrize("seekable", [False, True])
+@pytest.mark.parametrize("streamed", [False, True])
+def test_zip_writer_hash(seekable, streamed):
+    output = io.BytesIO() if seekable else Unseekable()
+    hash_obj = hashlib.sha256()
+    write_with_zip_writer(output, streamed, hash_obj=hash_obj)
+    data = output.getvalue() if seekable else bytes(output.data)
+    assert hash_obj.digest() == hashlib.sha256(data).digest()
+
+
+class WriteOnly(io.BytesIO):
+    def read(self, *args):
+        raise AssertionError("The archive is read back")
+
+
+@pytest.mark.parametrize("spool_size", [16, 1024 * 1024])
+def test_zip_writer_hash_is_streamed(monkeypatch, spool_size):
+    monkeypatch.setattr(ZipWriter, "spool_size", spool_size)
+    output = WriteOnly()
+    hash_obj = hashlib.sha256()
+    write_with_zip_writer(output, streamed=True, hash_obj=hash_obj)
+    assert hash_obj.digest() == hashlib.sha256(output.getvalue()).digest()
+
+    expected = io.BytesIO()
+    write_with_zipfile(expected)
+    assert output.getvalue() == expected.getvalue()
+
+
+def test_zip_writer_unseekable_output():
+    output = Unseekable()
+    write_with_zip_writer(output, streamed=True)
+
+    with zipfile.ZipFile(io.BytesIO(bytes(output.data))) as zf:
+        assert zf.testzip() is None
+        for name, data, _ in MEMBERS:
+            assert zf.getinfo(name).flag_bits & 0x08 == (0 if data is None else 0x08)
+            assert zf.read(name) == (data or b"")
+
+
+@pytest.mark.skipif(not shutil.which("zipinfo"), reason="zipinfo is not installed")
+def test_zip_writer_zipinfo(tmp_path, source_dir):
+    write_zip(tmp_path / "archive.zip", source_dir)
+    output = subprocess.check_output(["zipinfo", str(tmp_path / "archive.zip")])
+    assert b"6 files" in output
@@ -758,6 +758,12 @@ variable "hash_extra" {
   default     = ""
 }
 
+variable "hash_workers" {
+  description = "Number of threads used to hash source files when computing the package content hash. Files are hashed one by one if not set"
+  type        = number
+  default     = null
+}
+
 variable "build_in_docker" {
   description = "Whether to build dependencies in Docker"
   type        = bool
@@ -794,6 +800,12 @@ variable "docker_pip_cache" {
   default     = null
 }
 
+variable "docker_uv_cache" {
+  description = "Whether to mount a shared uv cache folder into docker environment or not"
+  type        = any
+  default     = null
+}
+
 variable "docker_additional_options" {
   description = "Additional options to pass to the docker run command (e.g. to set environment variables, volumes, etc.)"
   type        = list(string)
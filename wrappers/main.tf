@@ -53,6 +53,7 @@ module "wrapper" {
   docker_file                                  = try(each.value.docker_file, var.defaults.docker_file, "")
   docker_image                                 = try(each.value.docker_image, var.defaults.docker_image, "")
   docker_pip_cache                             = try(each.value.docker_pip_cache, var.defaults.docker_pip_cache, null)
+  docker_uv_cache                              = try(each.value.docker_uv_cache, var.defaults.docker_uv_cache, null)
   docker_with_ssh_agent                        = try(each.value.docker_with_ssh_agent, var.defaults.docker_with_ssh_agent, false)
   durable_config_execution_timeout             = try(each.value.durable_config_execution_timeout, var.defaults.durable_config_execution_timeout, null)
   durable_config_retention_period              = try(each.value.durable_config_retention_period, var.defaults.durable_config_retention_period, null)
@@ -65,6 +66,7 @@ module "wrapper" {
   function_tags                                = try(each.value.function_tags, var.defaults.function_tags, {})
   handler                                      = try(each.value.handler, var.defaults.handler, "")
   hash_extra                                   = try(each.value.hash_extra, var.defaults.hash_extra, "")
+  hash_workers                                 = try(each.value.hash_workers, var.defaults.hash_workers, null)
   ignore_source_code_hash                      = try(each.value.ignore_source_code_hash, var.defaults.ignore_source_code_hash, false)
   image_config_command                         = try(each.value.image_config_command, var.defaults.image_config_command, [])
   image_config_entry_point                     = try(each.value.image_config_entry_point, var.defaults.image_config_entry_point, [])